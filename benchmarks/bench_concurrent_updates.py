@@ -0,0 +1,92 @@
+"""
+Prueba de carga del procesamiento concurrente de updates.
+
+Cada usuario sintético envía una secuencia de mensajes; el handler simula una
+búsqueda IMAP bloqueante (time.sleep en un hilo) y verifica que los mensajes
+de cada usuario se procesen en orden. Compara el procesamiento secuencial
+anterior con PerUserOrderedUpdateProcessor a distinta cantidad de usuarios.
+
+Uso (desde la raíz del repo):
+    python benchmarks/bench_concurrent_updates.py [--per-user 5] [--lookup-ms 100]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.chdir(REPO_ROOT)
+
+from telegram import Update  # noqa: E402
+from telegram.ext import SimpleUpdateProcessor  # noqa: E402
+
+import bot  # noqa: E402
+
+
+def make_update(update_id, user_id, text):
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Prueba"},
+            "text": text,
+        },
+    }, None)
+
+
+async def run_load(processor, users, per_user, lookup_seconds):
+    seen = {}
+    out_of_order = 0
+
+    async def handler(update):
+        nonlocal out_of_order
+        user_id = update.effective_user.id
+        sequence = int(update.message.text)
+        if sequence != seen.get(user_id, -1) + 1:
+            out_of_order += 1
+        await asyncio.to_thread(time.sleep, lookup_seconds)
+        seen[user_id] = sequence
+
+    updates = []
+    update_id = 0
+    for sequence in range(per_user):
+        for user in range(users):
+            update_id += 1
+            updates.append(make_update(update_id, 1000 + user, str(sequence)))
+
+    await processor.initialize()
+    start = time.perf_counter()
+    # Igual que Application: una tarea por update, en orden de llegada.
+    tasks = [asyncio.create_task(processor.process_update(update, handler(update))) for update in updates]
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    await processor.shutdown()
+    return len(updates) / elapsed, out_of_order
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--per-user", type=int, default=5)
+    parser.add_argument("--lookup-ms", type=float, default=100)
+    parser.add_argument("--workers", type=int, default=bot.MAX_CONCURRENT_UPDATES)
+    args = parser.parse_args()
+    lookup_seconds = args.lookup_ms / 1000
+    asyncio.get_running_loop().set_default_executor(
+        bot.ThreadPoolExecutor(max_workers=max(args.workers, 1))
+    )
+
+    print(f"{'usuarios':>9}{'secuencial (upd/s)':>20}{'concurrente (upd/s)':>21}{'fuera de orden':>16}")
+    for users in (1, 2, 4, 8, 16, 32, 64):
+        sequential, _ = await run_load(SimpleUpdateProcessor(1), users, args.per_user, lookup_seconds)
+        concurrent, out_of_order = await run_load(
+            bot.PerUserOrderedUpdateProcessor(args.workers), users, args.per_user, lookup_seconds
+        )
+        print(f"{users:>9}{sequential:>20.1f}{concurrent:>21.1f}{out_of_order:>16}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,145 @@
+"""
+Benchmark de rendimiento del parseo según la cantidad de procesos (PARSE_WORKERS).
+
+Simula búsquedas concurrentes (hilos, como las del bot) que parsean sus
+mensajes candidatos con bot.run_parse: cada búsqueda recibe varios mensajes
+de otros servicios y al final uno del tipo buscado. Para cada cantidad de
+procesos (0 = parseo en los hilos) reporta búsquedas/s, mensajes/s, MB/s y
+latencia p50/p95 por búsqueda, y verifica que cada resultado sea idéntico
+al de parsear en el hilo.
+
+Uso (desde la raíz del repo):
+    python benchmarks/bench_parse_pool.py [--workers 0,1,2,4] [--lookups 200] [--threads 16]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bot  # noqa: E402
+from bench_parsers import PARSERS  # noqa: E402
+from corpus import KINDS, VARIANTS, generate_corpus  # noqa: E402
+
+
+def build_lookups(corpus, count, candidates, seed):
+    """Lista de (parser, [crudos], referencia): candidates-1 mensajes ajenos y el buscado al final."""
+    rng = random.Random(seed)
+    by_kind = {kind: [item for item in corpus if item["kind"] == kind] for kind in KINDS}
+    lookups = []
+    for _ in range(count):
+        kind = rng.choice(KINDS)
+        target = rng.choice(by_kind[kind])
+        others = [item for item in corpus if item["kind"].split("_")[0] != kind.split("_")[0]]
+        filler = rng.sample(others, min(candidates - 1, len(others)))
+        raws = [item["raw"] for item in filler] + [target["raw"]]
+        parse_function = PARSERS[kind][1]
+        # Referencia: el resultado de parsear en el hilo (algún mensaje ajeno
+        # puede dar un falso positivo; lo que se compara es que coincidan).
+        lookups.append((parse_function, raws, bot.parse_first(parse_function, raws)))
+    return lookups
+
+
+def run_workers(workers, lookups, threads):
+    bot.PARSE_WORKERS = workers
+    # Se envía todo al pool: interesa el costo del parseo, no el umbral.
+    bot.PARSE_OFFLOAD_MIN_BYTES = 0
+    pool = bot.get_parse_pool()
+    if pool is not None:
+        # Procesos ya arrancados (con bot importado) antes de medir.
+        for future in [pool.submit(bot.parse_first, bot.extract_6_digit_code, []) for _ in range(workers)]:
+            future.result()
+
+    def one(lookup):
+        parse_function, raws, expected = lookup
+        start = time.perf_counter()
+        result = bot.run_parse(parse_function, raws)
+        return (time.perf_counter() - start) * 1000, result == expected
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(one, lookups))
+        elapsed = time.perf_counter() - started
+    finally:
+        bot.shutdown_parse_pool()
+
+    latencies = sorted(ms for ms, _ in results)
+    messages = sum(len(raws) for _, raws, _ in lookups)
+    total_bytes = sum(len(raw) for _, raws, _ in lookups for raw in raws)
+    return {
+        "workers": workers,
+        "lookups": len(lookups),
+        "messages": messages,
+        "seconds": elapsed,
+        "lookups_per_s": len(lookups) / elapsed,
+        "messages_per_s": messages / elapsed,
+        "mb_per_s": total_bytes / 1e6 / elapsed,
+        "p50_ms": latencies[len(latencies) // 2],
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))],
+        "correct": sum(ok for _, ok in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    default_workers = sorted({0, 1, 2, 4, os.cpu_count() or 1})
+    parser.add_argument("--workers", default=",".join(map(str, default_workers)), help="cantidades de procesos a probar")
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=16, help="búsquedas simultáneas")
+    parser.add_argument("--candidates", type=int, default=bot.PARSE_BATCH_SIZE, help="mensajes por búsqueda")
+    parser.add_argument("--per-variant", type=int, default=3)
+    parser.add_argument("--variants", default=",".join(VARIANTS))
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="archivo JSON de salida")
+    args = parser.parse_args()
+
+    corpus = generate_corpus(args.per_variant, args.seed, variants=tuple(args.variants.split(",")))
+    lookups = build_lookups(corpus, args.lookups, args.candidates, args.seed)
+
+    print(f"CPUs: {os.cpu_count()}  búsquedas: {args.lookups}  hilos: {args.threads}  "
+          f"mensajes por búsqueda: {args.candidates}")
+    print(f"{'procesos':>9}{'búsq/s':>9}{'msj/s':>9}{'MB/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'ok':>9}")
+    results = []
+    for workers in [int(w) for w in args.workers.split(",")]:
+        result = run_workers(workers, lookups, args.threads)
+        results.append(result)
+        print(
+            f"{workers:>9}{result['lookups_per_s']:>9.1f}{result['messages_per_s']:>9.1f}"
+            f"{result['mb_per_s']:>8.1f}{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}"
+            f"{result['correct']:>5}/{result['lookups']}"
+        )
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        REPO_ROOT, "benchmarks", "results", f"parse-pool-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados en {output}")
+
+    if any(r["correct"] != r["lookups"] for r in results):
+        print("⚠️ Hubo búsquedas cuyo resultado difiere del parseo en el hilo")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Benchmark de los parsers de correos sobre el corpus sintético (corpus.py).
+
+Para cada parser (extract_6_digit_code, _parse_netflix_*, _parse_max_reset_link)
+y cada variante de mensaje (multipart, html, attachment) mide:
+
+  - parse_ms:  el parser sobre un mensaje ya decodificado.
+  - total_ms:  email.message_from_bytes + parser (lo que hace una búsqueda).
+  - MB/s:      bytes crudos procesados por segundo en total_ms.
+
+y verifica que el valor extraído sea el esperado. Escribe los resultados en
+JSON para comparar entre versiones con --compare.
+
+Uso (desde la raíz del repo):
+    python benchmarks/bench_parsers.py [--per-variant 5] [--repeat 5] [--output resultados.json]
+    python benchmarks/bench_parsers.py --compare antes.json
+"""
+import argparse
+import email
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(REPO_ROOT)
+
+import bot  # noqa: E402
+from corpus import VARIANTS, generate_corpus  # noqa: E402
+
+PARSERS = {
+    "disney_code": ("extract_6_digit_code", bot.extract_6_digit_code),
+    "netflix_code": ("_parse_netflix_code", bot._parse_netflix_code),
+    "netflix_reset_link": ("_parse_netflix_link", bot._parse_netflix_link),
+    "netflix_country": ("_parse_netflix_country", bot._parse_netflix_country),
+    "netflix_travel": ("_parse_netflix_temporary_link", bot._parse_netflix_temporary_link),
+    "netflix_household": ("_parse_netflix_update_household_link", bot._parse_netflix_update_household_link),
+    "max_reset_link": ("_parse_max_reset_link", bot._parse_max_reset_link),
+}
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_group(parse_function, items, repeat):
+    """Mejor tiempo de 'repeat' pasadas sobre cada mensaje del grupo."""
+    parse_times, total_times = [], []
+    correct = 0
+    total_bytes = sum(len(item["raw"]) for item in items)
+    for item in items:
+        best_parse = best_total = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            msg_obj = email.message_from_bytes(item["raw"])
+            middle = time.perf_counter()
+            value = parse_function(msg_obj)
+            end = time.perf_counter()
+            best_parse = min(best_parse, end - middle)
+            best_total = min(best_total, end - start)
+        parse_times.append(best_parse * 1000)
+        total_times.append(best_total * 1000)
+        correct += value == item["expected"]
+
+    total_seconds = sum(total_times) / 1000
+    return {
+        "messages": len(items),
+        "bytes": total_bytes,
+        "correct": correct,
+        "parse_ms_mean": statistics.fmean(parse_times),
+        "parse_ms_p95": sorted(parse_times)[int(0.95 * (len(parse_times) - 1))],
+        "total_ms_mean": statistics.fmean(total_times),
+        "total_ms_p95": sorted(total_times)[int(0.95 * (len(total_times) - 1))],
+        "ms_per_mb": sum(total_times) / (total_bytes / 1e6),
+        "mb_per_s": (total_bytes / 1e6) / total_seconds if total_seconds else None,
+    }
+
+
+def run(per_variant, repeat, seed):
+    corpus = generate_corpus(per_variant, seed)
+    results = []
+    for kind, (name, parse_function) in PARSERS.items():
+        for variant in VARIANTS:
+            items = [item for item in corpus if item["kind"] == kind and item["variant"] == variant]
+            result = bench_group(parse_function, items, repeat)
+            result.update({"parser": name, "kind": kind, "variant": variant})
+            results.append(result)
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "per_variant": per_variant,
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def print_table(report, baseline=None):
+    previous = {}
+    if baseline:
+        previous = {(r["parser"], r["variant"]): r for r in baseline["results"]}
+    header = f"{'parser':<38}{'variante':<12}{'ok':>6}{'parse ms':>10}{'total ms':>10}{'MB/s':>9}"
+    if previous:
+        header += f"{'vs base':>9}"
+    print(header)
+    for r in report["results"]:
+        line = (
+            f"{r['parser']:<38}{r['variant']:<12}{r['correct']:>3}/{r['messages']:<2}"
+            f"{r['parse_ms_mean']:>10.3f}{r['total_ms_mean']:>10.3f}{r['mb_per_s'] or 0:>9.1f}"
+        )
+        old = previous.get((r["parser"], r["variant"]))
+        if old:
+            line += f"{r['total_ms_mean'] / old['total_ms_mean']:>8.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--per-variant", type=int, default=5, help="mensajes por tipo y variante")
+    parser.add_argument("--repeat", type=int, default=5, help="pasadas por mensaje (se toma la mejor)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="archivo JSON de salida")
+    parser.add_argument("--compare", help="JSON de una corrida anterior para comparar")
+    args = parser.parse_args()
+
+    report = run(args.per_variant, args.repeat, args.seed)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_table(report, baseline)
+
+    output = args.output or os.path.join(
+        REPO_ROOT, "benchmarks", "results", f"parsers-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados en {output}")
+
+    failures = sum(r["messages"] - r["correct"] for r in report["results"])
+    if failures:
+        print(f"⚠️ {failures} mensajes no dieron el valor esperado")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
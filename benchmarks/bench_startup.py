@@ -0,0 +1,123 @@
+"""
+Benchmark del tiempo de importar bot.py (arranque en frío).
+
+Importa el módulo en un proceso nuevo, desde una carpeta vacía, varias veces
+y reporta la mediana y el mínimo contra un objetivo (--target-ms). También
+verifica que importar no tenga efectos secundarios: la carpeta sigue vacía
+(no se crean logs/ ni se exigen token.txt o admin_imap_pass.txt) y bs4 no
+queda cargado. Con -X importtime muestra los módulos que más pesan.
+
+Uso (desde la raíz del repo):
+    python benchmarks/bench_startup.py [--runs 10] [--target-ms 220] [--output resultados.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_TARGET_MS = 220
+DEFERRED_MODULES = ("bs4",)
+
+IMPORT_SNIPPET = f"""
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {REPO_ROOT!r})
+import bot
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({{"ms": elapsed, "loaded": [m for m in {DEFERRED_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def measure_once(folder):
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET], cwd=folder,
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def heaviest_imports(folder, top):
+    """Módulos con mayor tiempo acumulado según -X importtime (en ms)."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {REPO_ROOT!r}); import bot"],
+        cwd=folder, capture_output=True, text=True, check=True
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            rows.append((int(cumulative) / 1000, name.rstrip()))
+    # Sólo los que importa bot directamente (una sangría más que "bot").
+    top_level = [(ms, name.strip()) for ms, name in rows if name.startswith("   ") and not name.startswith("    ")]
+    return sorted(top_level, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--target-ms", type=float, default=STARTUP_TARGET_MS, help="objetivo para la mediana")
+    parser.add_argument("--top", type=int, default=8, help="módulos más pesados a mostrar")
+    parser.add_argument("--output", help="archivo JSON de salida")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="arranque-bot-") as folder:
+        measure_once(folder)  # calienta el caché de bytecode y del sistema de archivos
+        runs = [measure_once(folder) for _ in range(args.runs)]
+        leftovers = os.listdir(folder)
+        heaviest = heaviest_imports(folder, args.top)
+
+    times = [run["ms"] for run in runs]
+    loaded = sorted({module for run in runs for module in run["loaded"]})
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "runs": args.runs,
+            "target_ms": args.target_ms,
+        },
+        "median_ms": statistics.median(times),
+        "min_ms": min(times),
+        "max_ms": max(times),
+        "files_created": leftovers,
+        "deferred_modules_loaded": loaded,
+        "heaviest_imports": [{"module": name, "ms": ms} for ms, name in heaviest],
+    }
+
+    print(f"import bot: mediana {report['median_ms']:.1f} ms, mínimo {report['min_ms']:.1f} ms, "
+          f"máximo {report['max_ms']:.1f} ms (objetivo {args.target_ms:.0f} ms)")
+    print("Módulos más pesados:")
+    for ms, name in heaviest:
+        print(f"  {ms:>8.1f} ms  {name}")
+
+    output = args.output or os.path.join(
+        REPO_ROOT, "benchmarks", "results", f"startup-{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados en {output}")
+
+    failures = []
+    if report["median_ms"] > args.target_ms:
+        failures.append(f"la mediana supera el objetivo de {args.target_ms:.0f} ms")
+    if leftovers:
+        failures.append(f"importar creó archivos: {', '.join(leftovers)}")
+    if loaded:
+        failures.append(f"importar cargó módulos diferidos: {', '.join(loaded)}")
+    for failure in failures:
+        print(f"⚠️ {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
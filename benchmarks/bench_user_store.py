@@ -0,0 +1,106 @@
+"""
+Benchmark de memoria: dict de dicts (load_users) vs UserGrantStore.
+
+Uso (desde la raíz del repo):
+    python benchmarks/bench_user_store.py [--grants 100000]
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.chdir(REPO_ROOT)
+
+import bot  # noqa: E402
+
+
+def write_synthetic_db(path, total_grants, seed=42):
+    """
+    Genera un users_db.txt con 'total_grants' accesos. Los correos se
+    reparten entre pocas cuentas (como pasa con los revendedores), así que
+    la misma dirección aparece en muchas líneas.
+    """
+    rng = random.Random(seed)
+    mailboxes = [f"cuenta{i}@dmarcial.com" for i in range(total_grants // 20)]
+    base = date(2025, 1, 1)
+    uid = 100000000
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        while written < total_grants:
+            uid += rng.randint(1, 500)
+            count = min(rng.randint(1, 5), total_grants - written)
+            items = []
+            for _ in range(count):
+                mail = rng.choice(mailboxes)
+                if rng.random() < 0.1:
+                    items.append(mail)
+                else:
+                    items.append(f"{mail}:{(base + timedelta(days=rng.randint(0, 730))).isoformat()}")
+            f.write(f"{uid} {' '.join(items)}\n")
+            written += count
+
+
+def measure(builder):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = builder()
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, elapsed
+
+
+def time_queries(check, queries):
+    start = time.perf_counter()
+    for uid, mail in queries:
+        check(uid, mail)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--grants", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "users_db.txt")
+        write_synthetic_db(db_path, args.grants)
+        bot.USERS_DB_FILE = db_path
+
+        users_dict, dict_bytes, dict_load = measure(bot.load_users)
+        store, store_bytes, store_load = measure(lambda: bot.UserGrantStore.from_file(db_path))
+
+    rng = random.Random(7)
+    uids = list(users_dict)
+    queries = []
+    for _ in range(20000):
+        uid = rng.choice(uids)
+        mail = rng.choice(list(users_dict[uid]))
+        queries.append((uid, mail))
+
+    today = date.today()
+
+    def dict_check(uid, mail):
+        exp_date = users_dict[uid].get(mail, False)
+        return exp_date is None or (exp_date is not False and today <= exp_date)
+
+    dict_query = time_queries(dict_check, queries)
+    store_query = time_queries(store.has_valid_access, queries)
+
+    print(f"Accesos: {args.grants}  Usuarios: {len(users_dict)}")
+    print(f"{'estructura':<18}{'memoria (MB)':>14}{'carga (s)':>12}{'consulta (us)':>16}")
+    print(f"{'dict de dicts':<18}{dict_bytes / 1e6:>14.2f}{dict_load:>12.3f}{dict_query:>16.2f}")
+    print(f"{'UserGrantStore':<18}{store_bytes / 1e6:>14.2f}{store_load:>12.3f}{store_query:>16.2f}")
+    print(f"Ahorro de memoria: {100 * (1 - store_bytes / dict_bytes):.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""
+Corpus sintético de correos de Disney+, Netflix y Max.
+
+Genera mensajes parecidos a los reales (HTML con tablas y estilos en línea,
+parte de texto plano, pie legal) para cada tipo de búsqueda del bot, en tres
+variantes:
+
+  - multipart:  multipart/alternative con text/plain + text/html.
+  - html:       sólo text/html (sin parte de texto).
+  - attachment: multipart/mixed con la alternativa anterior más un adjunto
+                binario grande (PDF falso de ~2 MB).
+
+Cada mensaje trae el valor que el parser correspondiente debería extraer,
+para verificar que el benchmark mide parsers que funcionan. Lo usan
+bench_parsers.py y el servidor IMAP falso.
+
+Uso (desde la raíz del repo), para volcar el corpus a .eml:
+    python benchmarks/corpus.py --out /tmp/corpus [--per-variant 5]
+"""
+import argparse
+import os
+import random
+from email.message import EmailMessage
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+VARIANTS = ("multipart", "html", "attachment")
+ATTACHMENT_BYTES = 2 * 1024 * 1024
+
+SENDERS = {
+    "disney": "disneyplus@mail.disneyplus.com",
+    "netflix": "info@account.netflix.com",
+    "max": "no-reply@marketing.max.com",
+}
+
+# Relleno sin dígitos: los parsers de códigos toman el primer número que
+# encuentran, así que el pie con fechas va siempre después del dato.
+FILLER_SENTENCES = (
+    "Si no solicitaste este cambio, puedes ignorar este mensaje.",
+    "Por tu seguridad, no compartas este correo con nadie.",
+    "Este mensaje se envió a la dirección asociada a tu cuenta.",
+    "Visita el centro de ayuda para obtener más información.",
+    "Gracias por ser parte de nuestra comunidad de suscriptores.",
+    "Puedes administrar tus preferencias de correo desde tu cuenta.",
+)
+
+
+def _filler_html(rng, blocks):
+    rows = []
+    for _ in range(blocks):
+        sentence = rng.choice(FILLER_SENTENCES)
+        rows.append(
+            '<tr><td style="font-family:Helvetica,Arial,sans-serif;font-size:14px;'
+            'color:#333333;padding:8px 24px;line-height:20px">'
+            f'<p style="margin:0">{sentence}</p></td></tr>'
+        )
+    return "\n".join(rows)
+
+
+def _filler_text(rng, blocks):
+    return "\n\n".join(rng.choice(FILLER_SENTENCES) for _ in range(blocks))
+
+
+def _html_document(rng, title, main_html):
+    return (
+        "<!DOCTYPE html><html><head>"
+        '<meta http-equiv="Content-Type" content="text/html; charset=utf-8">'
+        "<style>body{margin:0;padding:0}table{border-collapse:collapse}"
+        ".btn{background:#e50914;color:#ffffff;text-decoration:none}</style>"
+        f"<title>{title}</title></head><body>"
+        '<table width="100%" cellpadding="0" cellspacing="0" role="presentation">'
+        f'\n<tr><td style="padding:24px"><h1 style="font-size:24px">{title}</h1></td></tr>\n'
+        f"{_filler_html(rng, rng.randint(4, 10))}\n"
+        f'<tr><td style="padding:16px 24px">\n{main_html}\n</td></tr>\n'
+        f"{_filler_html(rng, rng.randint(20, 60))}\n"
+        '<tr><td style="font-size:11px;color:#999999;padding:24px">'
+        "© 2025 Todos los derechos reservados.</td></tr>\n"
+        "</table></body></html>"
+    )
+
+
+def _token(rng, length=40):
+    alphabet = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    return "".join(rng.choice(alphabet) for _ in range(length))
+
+
+def _content(kind, rng):
+    """Retorna (service, asunto, texto_plano, html, valor_esperado)."""
+    if kind == "disney_code":
+        code = f"{rng.randint(100000, 999999)}"
+        main = f'<p>Tu código de acceso único es:</p>\n<p style="font-size:32px;letter-spacing:6px"><b>{code}</b></p>'
+        text = f"Tu código de acceso único es:\n\n{code}\n\nEste código vence en quince minutos."
+        return "disney", "Tu código de acceso único para Disney+", text, main, code
+
+    if kind == "netflix_code":
+        code = f"{rng.randint(1000, 9999)}"
+        main = f'<p>Ingresa este código para iniciar sesión:</p>\n<p style="font-size:32px"><b>{code}</b></p>'
+        text = f"Ingresa este código para iniciar sesión:\n\n{code}"
+        return "netflix", "Tu código de inicio de sesión", text, main, code
+
+    if kind == "netflix_reset_link":
+        link = f"https://www.netflix.com/password?g={_token(rng)}&lkid=URL_PASSWORD"
+        main = f'<a class="btn" href="{link}" style="padding:12px 24px">Restablecer contraseña</a>'
+        text = f"Restablecer contraseña: {link}"
+        return "netflix", "Solicitud de restablecimiento de contraseña", text, main, link
+
+    if kind == "netflix_country":
+        lang, country = rng.choice((("es", "AR"), ("es", "MX"), ("pt", "BR"), ("en", "US"), ("es", "CL")))
+        src = f"NFLX_{lang}_{country}_ACCOUNT_ACCESS"
+        main = "<p>Se inició sesión en tu cuenta desde un dispositivo nuevo.</p>"
+        text = f"Se inició sesión en tu cuenta desde un dispositivo nuevo.\n\nSRC: {src}\n"
+        return "netflix", "Nuevo inicio de sesión en tu cuenta", text, main, (lang, country)
+
+    if kind == "netflix_travel":
+        link = f"https://www.netflix.com/account/travel/verify?nftoken={_token(rng, 64)}"
+        main = f'<a class="btn" href="{link}">Obtener código</a>'
+        text = f"Obtener código de acceso temporal: {link}"
+        return "netflix", "Tu código de acceso temporal", text, main, link
+
+    if kind == "netflix_household":
+        link = f"https://www.netflix.com/account/update-primary-location?nftoken={_token(rng, 64)}"
+        main = f'<a class="btn" href="{link}">Sí, la envié yo</a>'
+        text = f"Actualizar tu hogar con Netflix: {link}"
+        return "netflix", "Actualiza tu hogar con Netflix", text, main, link
+
+    if kind == "max_reset_link":
+        link = f"https://links.marketing.max.com/ls/click?upn={_token(rng, 80)}"
+        main = f'<a href="{link}" style="color:#002be7">Restablecer contraseña</a>'
+        text = f"Restablecer contraseña: {link}"
+        return "max", "Restablece tu contraseña de Max", text, main, link
+
+    raise ValueError(f"Tipo desconocido: {kind}")
+
+
+KINDS = (
+    "disney_code",
+    "netflix_code",
+    "netflix_reset_link",
+    "netflix_country",
+    "netflix_travel",
+    "netflix_household",
+    "max_reset_link",
+)
+
+
+def make_message(kind, variant, rng, to_address="cliente@example.com", date=None):
+    """Retorna (bytes_rfc822, valor_esperado)."""
+    service, subject, text, main_html, expected = _content(kind, rng)
+    html = _html_document(rng, subject, main_html)
+    if kind == "netflix_country":
+        # El SRC viaja como texto en el HTML también (así aparece en los reales).
+        html = html.replace("</body>", f"\nSRC: {text.split('SRC: ')[1].strip()}\n</body>")
+
+    msg = EmailMessage()
+    msg["From"] = SENDERS[service]
+    msg["To"] = to_address
+    msg["Subject"] = subject
+    msg["Date"] = format_datetime(date or datetime.now(timezone.utc) - timedelta(minutes=rng.randint(0, 30)))
+    msg["Message-ID"] = f"<{_token(rng, 24)}@{SENDERS[service].split('@')[1]}>"
+
+    if variant == "html":
+        msg.set_content(html, subtype="html")
+    else:
+        msg.set_content(text + "\n\n" + _filler_text(rng, rng.randint(5, 15)))
+        msg.add_alternative(html, subtype="html")
+        if variant == "attachment":
+            msg.make_mixed()
+            msg.add_attachment(
+                rng.randbytes(ATTACHMENT_BYTES), maintype="application", subtype="pdf",
+                filename="comprobante.pdf"
+            )
+    return msg.as_bytes(), expected
+
+
+def generate_corpus(per_variant=5, seed=1234, kinds=KINDS, variants=VARIANTS):
+    """Lista de dicts {kind, variant, raw, expected}, reproducible con 'seed'."""
+    rng = random.Random(seed)
+    corpus = []
+    for kind in kinds:
+        for variant in variants:
+            for _ in range(per_variant):
+                raw, expected = make_message(kind, variant, rng)
+                corpus.append({"kind": kind, "variant": variant, "raw": raw, "expected": expected})
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", required=True, help="carpeta donde escribir los .eml")
+    parser.add_argument("--per-variant", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    corpus = generate_corpus(args.per_variant, args.seed)
+    for i, item in enumerate(corpus):
+        path = os.path.join(args.out, f"{i:04d}-{item['kind']}-{item['variant']}.eml")
+        with open(path, "wb") as f:
+            f.write(item["raw"])
+    print(f"{len(corpus)} mensajes en {args.out}")
+
+
+if __name__ == "__main__":
+    main()
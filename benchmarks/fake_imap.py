@@ -0,0 +1,415 @@
+"""
+Servidor IMAP4 falso y local para pruebas de carga de las búsquedas.
+
+Habla lo justo de IMAP4rev1 (sin TLS) para que el bot funcione contra él
+igual que contra el servidor real: LOGIN, SELECT/EXAMINE, NOOP, LOGOUT,
+CAPABILITY, SEARCH y FETCH (también con UID) e IDLE. Los buzones se llenan
+con mensajes del corpus sintético (corpus.py) dirigidos a un conjunto de
+correos de clientes, y se puede controlar:
+
+  - la latencia de cada comando (--latency-ms y --jitter-ms),
+  - la proporción de SEARCH/FETCH que responden NO (--error-rate),
+  - el tamaño de los buzones (--messages) y de los mensajes (--attachment-ratio),
+  - la llegada de mensajes nuevos (--arrival-interval), que se avisa con
+    "* n EXISTS" a las sesiones en IDLE,
+  - la proporción de respuestas FETCH con el UID después del literal
+    (--uid-last-ratio), que RFC 3501 permite y algunos servidores hacen.
+
+Para apuntar el bot a él: IMAP_HOST=127.0.0.1 IMAP_PORT=<puerto> IMAP_SSL=0,
+y en admin_imap_pass.txt las líneas que imprime al arrancar.
+
+Uso (desde la raíz del repo):
+    python benchmarks/fake_imap.py [--port 1143] [--accounts 3] [--messages 200] [--latency-ms 20]
+"""
+import argparse
+import asyncio
+import logging
+import random
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from email import message_from_bytes
+
+from corpus import KINDS, make_message
+
+CAPABILITIES = "IMAP4rev1 IDLE"
+UIDVALIDITY = 1
+
+
+class FakeMessage:
+    __slots__ = ("uid", "raw", "sender", "recipient")
+
+    def __init__(self, uid, raw):
+        self.uid = uid
+        self.raw = raw
+        headers = message_from_bytes(raw.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n")
+        self.sender = (headers.get("From") or "").lower()
+        self.recipient = (headers.get("To") or "").lower()
+
+
+class Mailbox:
+    """INBOX de una cuenta; avisa a las sesiones en IDLE cuando llega algo."""
+
+    def __init__(self):
+        self.messages = []
+        self.next_uid = 1
+        self.idle_sessions = set()
+
+    def append(self, raw):
+        self.messages.append(FakeMessage(self.next_uid, raw))
+        self.next_uid += 1
+        for session in list(self.idle_sessions):
+            session.notify_exists(len(self.messages))
+
+
+def customer_emails(count):
+    return [f"cliente{i}@example.com" for i in range(count)]
+
+
+def build_mailboxes(accounts, messages, customers, attachment_ratio=0.0, seed=1234):
+    """
+    Retorna { cuenta: (clave, Mailbox) }. El cliente i recibe sus correos en la
+    cuenta i % accounts, como si cada cuenta reenviara un grupo de clientes.
+    """
+    rng = random.Random(seed)
+    mailboxes = {}
+    for a in range(accounts):
+        mailbox = Mailbox()
+        own_customers = customers[a::accounts] or customers
+        for _ in range(messages):
+            mailbox.append(_random_message(rng, own_customers, attachment_ratio))
+        mailboxes[f"cuenta{a}@fake.test"] = (f"clave{a}", mailbox)
+    return mailboxes
+
+
+def _random_message(rng, customers, attachment_ratio):
+    variant = "attachment" if rng.random() < attachment_ratio else rng.choice(("multipart", "html"))
+    date = datetime.now(timezone.utc) - timedelta(seconds=rng.randint(0, 300))
+    raw, _ = make_message(rng.choice(KINDS), variant, rng, to_address=rng.choice(customers), date=date)
+    return raw.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+
+
+# =============================================================================
+# PARSEO DE COMANDOS
+# =============================================================================
+
+_TOKEN_RE = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()]+')
+
+
+def tokenize(text):
+    tokens = []
+    for token in _TOKEN_RE.findall(text):
+        if token.startswith('"'):
+            token = re.sub(r'\\(.)', r'\1', token[1:-1])
+        tokens.append(token)
+    return tokens
+
+
+def parse_sequence_set(text, maximum):
+    """'1,3:5,9:*' → conjunto de enteros (números de secuencia o UIDs)."""
+    values = set()
+    for part in text.split(","):
+        if ":" in part:
+            low, high = part.split(":", 1)
+            low = maximum if low == "*" else int(low)
+            high = maximum if high == "*" else int(high)
+            values.update(range(min(low, high), max(low, high) + 1))
+        else:
+            values.add(maximum if part == "*" else int(part))
+    return values
+
+
+def _parse_criteria(tokens):
+    """Consume un criterio de SEARCH de 'tokens' y retorna una función mensaje → bool."""
+    token = tokens.pop(0)
+    key = token.upper()
+    if token == "(":
+        parts = []
+        while tokens[0] != ")":
+            parts.append(_parse_criteria(tokens))
+        tokens.pop(0)
+        return lambda m: all(p(m) for p in parts)
+    if key == "OR":
+        left, right = _parse_criteria(tokens), _parse_criteria(tokens)
+        return lambda m: left(m) or right(m)
+    if key == "NOT":
+        inner = _parse_criteria(tokens)
+        return lambda m: not inner(m)
+    if key == "ALL":
+        return lambda m: True
+    if key in ("FROM", "TO"):
+        value = tokens.pop(0).lower()
+        field = "sender" if key == "FROM" else "recipient"
+        return lambda m: value in getattr(m, field)
+    if key in ("SINCE", "BEFORE", "ON", "CHARSET"):
+        tokens.pop(0)
+        return lambda m: True
+    raise ValueError(f"criterio no soportado: {token}")
+
+
+def parse_search(tokens):
+    tokens = list(tokens)
+    parts = []
+    while tokens:
+        parts.append(_parse_criteria(tokens))
+    return lambda m: all(p(m) for p in parts)
+
+
+# =============================================================================
+# SESIÓN
+# =============================================================================
+
+class Session:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.account = None
+        self.mailbox = None
+        self.idle_tag = None
+
+    def send(self, line):
+        self.writer.write(line.encode() + b"\r\n")
+
+    def notify_exists(self, count):
+        self.send(f"* {count} EXISTS")
+
+    async def run(self):
+        self.send(f"* OK [CAPABILITY {CAPABILITIES}] Servidor IMAP falso listo")
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                text = line.decode(errors="replace").rstrip("\r\n")
+                if self.idle_tag:
+                    if text.upper() == "DONE":
+                        self.mailbox.idle_sessions.discard(self)
+                        self.send(f"{self.idle_tag} OK IDLE terminado")
+                        self.idle_tag = None
+                        await self.writer.drain()
+                    continue
+                if not await self.handle(text):
+                    break
+                await self.writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if self.mailbox:
+                self.mailbox.idle_sessions.discard(self)
+            self.writer.close()
+
+    async def handle(self, text):
+        parts = text.split(" ", 2)
+        if len(parts) < 2:
+            self.send("* BAD comando vacío")
+            return True
+        tag, command = parts[0], parts[1].upper()
+        rest = parts[2] if len(parts) > 2 else ""
+        use_uid = command == "UID"
+        if use_uid:
+            command, _, rest = rest.partition(" ")
+            command = command.upper()
+
+        await self.server.delay()
+        try:
+            if command == "CAPABILITY":
+                self.send(f"* CAPABILITY {CAPABILITIES}")
+            elif command == "LOGIN":
+                user, password = tokenize(rest)[:2]
+                account = self.server.mailboxes.get(user.lower())
+                if not account or account[0] != password:
+                    self.send(f"{tag} NO [AUTHENTICATIONFAILED] credenciales inválidas")
+                    return True
+                self.account = user.lower()
+                self.server.stats["logins"] += 1
+            elif command in ("SELECT", "EXAMINE"):
+                self.mailbox = self.server.mailboxes[self.account][1]
+                self.send(f"* {len(self.mailbox.messages)} EXISTS")
+                self.send("* 0 RECENT")
+                self.send(f"* OK [UIDVALIDITY {UIDVALIDITY}] UIDs válidos")
+                self.send(f"* OK [UIDNEXT {self.mailbox.next_uid}] próximo UID")
+                mode = "READ-ONLY" if command == "EXAMINE" else "READ-WRITE"
+                self.send(f"{tag} OK [{mode}] {command} completado")
+                return True
+            elif command == "NOOP":
+                pass
+            elif command == "LOGOUT":
+                self.send("* BYE cerrando")
+                self.send(f"{tag} OK LOGOUT completado")
+                await self.writer.drain()
+                return False
+            elif command == "IDLE":
+                self.idle_tag = tag
+                self.mailbox.idle_sessions.add(self)
+                self.send("+ esperando")
+                return True
+            elif command == "SEARCH":
+                if self.server.fail():
+                    self.send(f"{tag} NO [UNAVAILABLE] error simulado")
+                    return True
+                self.search(rest, use_uid)
+            elif command == "FETCH":
+                if self.server.fail():
+                    self.send(f"{tag} NO [UNAVAILABLE] error simulado")
+                    return True
+                self.fetch(rest, use_uid)
+            else:
+                self.send(f"{tag} BAD comando no soportado: {command}")
+                return True
+        except (ValueError, IndexError, KeyError, AttributeError) as e:
+            self.send(f"{tag} BAD {e}")
+            return True
+        self.send(f"{tag} OK {command} completado")
+        return True
+
+    def search(self, rest, use_uid):
+        self.server.stats["searches"] += 1
+        matches = parse_search(tokenize(rest))
+        found = [
+            str(message.uid if use_uid else seq)
+            for seq, message in enumerate(self.mailbox.messages, start=1)
+            if matches(message)
+        ]
+        self.send("* SEARCH" + ("" if not found else " " + " ".join(found)))
+
+    def fetch(self, rest, use_uid):
+        sequence_text, _, items = rest.partition(" ")
+        items = items.upper()
+        messages = self.mailbox.messages
+        if use_uid:
+            wanted = parse_sequence_set(sequence_text, self.mailbox.next_uid - 1)
+            selected = [(seq, m) for seq, m in enumerate(messages, start=1) if m.uid in wanted]
+        else:
+            wanted = parse_sequence_set(sequence_text, len(messages))
+            selected = [(seq, messages[seq - 1]) for seq in sorted(wanted) if 1 <= seq <= len(messages)]
+
+        for seq, message in selected:
+            fields = [f"UID {message.uid}"]
+            if "RFC822.SIZE" in items:
+                fields.append(f"RFC822.SIZE {len(message.raw)}")
+            body_name = None
+            if re.search(r"\bRFC822\b(?![.])", items):
+                body_name = "RFC822"
+            elif "BODY[]" in items or "BODY.PEEK[]" in items:
+                body_name = "BODY[]"
+            if body_name:
+                self.server.stats["bytes"] += len(message.raw)
+                literal = f"{body_name} {{{len(message.raw)}}}\r\n".encode() + message.raw
+                if self.server.uid_last():
+                    # "* n FETCH (RFC822 {...}<crudo> UID x)": el UID llega después del literal.
+                    self.writer.write(f"* {seq} FETCH (".encode() + literal + f" {' '.join(fields)})\r\n".encode())
+                else:
+                    self.writer.write(f"* {seq} FETCH ({' '.join(fields)} ".encode() + literal + b")\r\n")
+            else:
+                self.send(f"* {seq} FETCH ({' '.join(fields)})")
+        self.server.stats["fetches"] += 1
+
+
+# =============================================================================
+# SERVIDOR
+# =============================================================================
+
+class FakeIMAPServer:
+    def __init__(self, accounts=3, messages=200, customers=30, latency_ms=0.0, jitter_ms=0.0,
+                 error_rate=0.0, attachment_ratio=0.0, arrival_interval=0.0, seed=1234, uid_last_ratio=0.5):
+        self.customers = customer_emails(customers)
+        self.mailboxes = build_mailboxes(accounts, messages, self.customers, attachment_ratio, seed)
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.attachment_ratio = attachment_ratio
+        self.arrival_interval = arrival_interval
+        self.uid_last_ratio = uid_last_ratio
+        self.rng = random.Random(seed + 1)
+        self.stats = {"connections": 0, "logins": 0, "searches": 0, "fetches": 0, "bytes": 0}
+        self.port = None
+        self._server = None
+        self._arrivals = None
+
+    def account_lines(self):
+        """Líneas para admin_imap_pass.txt."""
+        return [f"{acc}|{password}" for acc, (password, _) in self.mailboxes.items()]
+
+    async def delay(self):
+        seconds = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+    def fail(self):
+        return self.error_rate and self.rng.random() < self.error_rate
+
+    def uid_last(self):
+        return self.uid_last_ratio and self.rng.random() < self.uid_last_ratio
+
+    async def _handle_connection(self, reader, writer):
+        self.stats["connections"] += 1
+        await Session(self, reader, writer).run()
+
+    async def _deliver_messages(self):
+        mailboxes = list(self.mailboxes.values())
+        while True:
+            await asyncio.sleep(self.arrival_interval)
+            _, mailbox = self.rng.choice(mailboxes)
+            mailbox.append(_random_message(self.rng, self.customers, self.attachment_ratio))
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._handle_connection, host, port, limit=2 ** 20)
+        self.port = self._server.sockets[0].getsockname()[1]
+        if self.arrival_interval > 0:
+            self._arrivals = asyncio.create_task(self._deliver_messages())
+        return self.port
+
+    async def stop(self):
+        if self._arrivals:
+            self._arrivals.cancel()
+        self._server.close()
+        await self._server.wait_closed()
+
+
+async def serve(args):
+    server = FakeIMAPServer(
+        args.accounts, args.messages, args.customers, args.latency_ms, args.jitter_ms,
+        args.error_rate, args.attachment_ratio, args.arrival_interval, args.seed, args.uid_last_ratio
+    )
+    port = await server.start(args.host, args.port)
+    print(f"IMAP falso en {args.host}:{port} (IMAP_HOST={args.host} IMAP_PORT={port} IMAP_SSL=0)")
+    print("admin_imap_pass.txt:")
+    for line in server.account_lines():
+        print(f"  {line}")
+    print(f"Clientes: {server.customers[0]} … {server.customers[-1]}")
+    started = time.monotonic()
+    try:
+        while True:
+            await asyncio.sleep(60)
+            logging.info(f"{time.monotonic() - started:.0f} s: {server.stats}")
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1143)
+    parser.add_argument("--accounts", type=int, default=3, help="cuentas IMAP")
+    parser.add_argument("--messages", type=int, default=200, help="mensajes iniciales por cuenta")
+    parser.add_argument("--customers", type=int, default=30, help="correos de clientes distintos")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latencia fija por comando")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="latencia extra aleatoria por comando")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="proporción de SEARCH/FETCH que fallan")
+    parser.add_argument("--attachment-ratio", type=float, default=0.0, help="proporción de mensajes con adjunto de 2 MB")
+    parser.add_argument("--arrival-interval", type=float, default=0.0, help="segundos entre mensajes nuevos (0 = ninguno)")
+    parser.add_argument("--uid-last-ratio", type=float, default=0.5,
+                        help="proporción de FETCH con el UID después del literal")
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
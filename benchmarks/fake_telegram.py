@@ -0,0 +1,214 @@
+"""
+Cliente de Telegram de reemplazo para pruebas locales.
+
+Levanta una API de Bot falsa (getMe, getUpdates, setWebhook, sendMessage,
+editMessageText, ...) en 127.0.0.1, arranca bot.py apuntando a ella con
+TELEGRAM_BASE_URL y le inyecta comandos /start de usuarios sintéticos:
+
+  - modo polling: los updates se sirven por getUpdates.
+  - modo webhook: los updates se envían por POST al webhook del bot,
+    con el header X-Telegram-Bot-Api-Secret-Token.
+
+Mide la latencia de punta a punta (update inyectado -> sendMessage recibido).
+
+Uso (desde la raíz del repo):
+    python benchmarks/fake_telegram.py --mode polling --updates 200
+    python benchmarks/fake_telegram.py --mode webhook --updates 200
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_USER_ID = 900000000
+
+
+class FakeTelegramAPI:
+    """Estado compartido de la API falsa."""
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.pending_updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.sent_at = {}
+        self.replied_at = {}
+        self.webhook_url = None
+        self.calls = {}
+
+    def add_update(self, user_id, text):
+        with self.lock:
+            update_id = self.next_update_id
+            self.next_update_id += 1
+            update = {
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": "Prueba"},
+                    "text": text,
+                    "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+                    if text.startswith("/") else [],
+                },
+            }
+            self.sent_at[user_id] = time.perf_counter()
+            self.pending_updates.append(update)
+            self.lock.notify_all()
+            return update
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + min(timeout, 1.0)
+        with self.lock:
+            while True:
+                updates = [u for u in self.pending_updates if u["update_id"] >= offset]
+                self.pending_updates = updates
+                remaining = deadline - time.monotonic()
+                if updates or remaining <= 0:
+                    return updates
+                self.lock.wait(remaining)
+
+    def message(self, chat_id, text):
+        with self.lock:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            if chat_id not in self.replied_at:
+                self.replied_at[chat_id] = time.perf_counter()
+            self.lock.notify_all()
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        }
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _params(self):
+            length = int(self.headers.get("Content-Length", "0"))
+            body = self.rfile.read(length) if length else b""
+            content_type = self.headers.get("Content-Type", "")
+            if "json" in content_type:
+                return json.loads(body or b"{}")
+            params = {}
+            for key, values in urllib.parse.parse_qs(body.decode()).items():
+                try:
+                    params[key] = json.loads(values[0])
+                except ValueError:
+                    params[key] = values[0]
+            return params
+
+        def do_POST(self):
+            method = self.path.rsplit("/", 1)[-1]
+            params = self._params()
+            api.calls[method] = api.calls.get(method, 0) + 1
+
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "Bot", "username": "fake_bot",
+                          "can_join_groups": True, "can_read_all_group_messages": False,
+                          "supports_inline_queries": False}
+            elif method == "getUpdates":
+                result = api.get_updates(int(params.get("offset", 0) or 0), float(params.get("timeout", 0) or 0))
+            elif method == "setWebhook":
+                api.webhook_url = params.get("url")
+                api.webhook_secret = params.get("secret_token")
+                result = True
+            elif method in ("sendMessage", "editMessageText"):
+                result = api.message(int(params.get("chat_id", 0)), params.get("text", ""))
+            else:
+                result = True
+
+            payload = json.dumps({"ok": True, "result": result}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST
+
+    return Handler
+
+
+def post_webhook(api, update):
+    request = urllib.request.Request(
+        api.webhook_url,
+        data=json.dumps(update).encode(),
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": api.webhook_secret},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        response.read()
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--updates", type=int, default=100)
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--webhook-port", type=int, default=8443)
+    parser.add_argument("--interval", type=float, default=0.02, help="segundos entre updates")
+    args = parser.parse_args()
+
+    api = FakeTelegramAPI()
+    server = ThreadingHTTPServer(("127.0.0.1", args.api_port), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_BASE_URL": f"http://127.0.0.1:{args.api_port}",
+        "BOT_MODE": args.mode,
+        "WEBHOOK_URL": f"http://127.0.0.1:{args.webhook_port}/telegram",
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(args.webhook_port),
+    })
+    bot_process = subprocess.Popen([sys.executable, "bot.py"], cwd=REPO_ROOT, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        ready_call = "setWebhook" if args.mode == "webhook" else "getUpdates"
+        while api.calls.get(ready_call, 0) == 0:
+            if time.monotonic() > deadline or bot_process.poll() is not None:
+                raise SystemExit("El bot no arrancó")
+            time.sleep(0.05)
+        time.sleep(0.5)
+
+        for i in range(args.updates):
+            update = api.add_update(FIRST_USER_ID + i, "/start")
+            if args.mode == "webhook":
+                post_webhook(api, update)
+            time.sleep(args.interval)
+
+        deadline = time.monotonic() + 30
+        while len(api.replied_at) < args.updates and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        latencies = [(api.replied_at[uid] - api.sent_at[uid]) * 1000
+                     for uid in api.sent_at if uid in api.replied_at]
+        print(f"Modo: {args.mode}  Updates: {args.updates}  Respondidos: {len(latencies)}")
+        print(f"Latencia update -> respuesta: p50 {percentile(latencies, 0.5):.1f} ms  "
+              f"p95 {percentile(latencies, 0.95):.1f} ms  max {max(latencies, default=0):.1f} ms")
+    finally:
+        bot_process.terminate()
+        bot_process.wait(10)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""
+Prueba de carga de punta a punta de las búsquedas, sin Telegram ni IMAP reales.
+
+Levanta el servidor IMAP falso (fake_imap.py), prepara una carpeta de trabajo
+temporal con token, cuentas, usuarios y permisos, importa bot.py apuntando a
+ese servidor (IMAP_HOST/IMAP_PORT/IMAP_SSL=0) y arma la Application con los
+handlers reales (add_handlers). Las llamadas a la API de Telegram las
+responde localmente LocalBotRequest.
+
+Cada usuario virtual repite: pulsar el botón del servicio y mandar un correo.
+Se mide el tiempo de procesar el update del correo (del handler a la
+respuesta final) y se reporta, para cada nivel de concurrencia, búsquedas
+por segundo y latencias p50/p95/p99.
+
+Uso (desde la raíz del repo):
+    python benchmarks/load_test.py [--concurrency 1,2,4,8,16,32] [--lookups 20] [--latency-ms 20]
+    python benchmarks/load_test.py --error-rate 0.05 --attachment-ratio 0.1 --output carga.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_imap import FakeIMAPServer  # noqa: E402
+
+# Botón que se pulsa antes de mandar el correo, por tipo de búsqueda.
+SERVICE_BUTTONS = {
+    "disney": "obtener_codigo_disney",
+    "netflix_access_code": "netflix_access_code",
+    "netflix_reset_link": "netflix_reset_link",
+    "max_reset_link": "max_reset_link",
+}
+PERMISSION_FILES = ("disney_code_db.txt", "netflix_code_db.txt", "max_link_db.txt")
+USER_ID_BASE = 100000
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bot de carga", "username": "carga_bot"}
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def prepare_workdir(folder, server, users):
+    """Escribe los archivos de configuración del bot; retorna { uid: [correos] }."""
+    user_emails = {}
+    customers = server.customers
+    for i in range(users):
+        user_emails[USER_ID_BASE + i] = [customers[(i + k) % len(customers)] for k in range(3)]
+
+    files = {
+        "token.txt": "123456:TOKEN-DE-PRUEBA\n",
+        "admin_ids.txt": "",
+        "admin_imap_pass.txt": "".join(f"{line}\n" for line in server.account_lines()),
+        "users_db.txt": "".join(f"{uid} {' '.join(emails)}\n" for uid, emails in user_emails.items()),
+    }
+    for name in PERMISSION_FILES:
+        files[name] = "".join(f"{uid} None\n" for uid in user_emails)
+    for name, content in files.items():
+        with open(os.path.join(folder, name), "w", encoding="utf-8") as f:
+            f.write(content)
+    return user_emails
+
+
+def make_local_request_class():
+    from telegram.request import BaseRequest
+
+    class LocalBotRequest(BaseRequest):
+        """Responde la API de Telegram en memoria y cuenta las llamadas por método."""
+
+        def __init__(self):
+            self.calls = {}
+            self._message_ids = itertools.count(1)
+
+        @property
+        def read_timeout(self):
+            return None
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None,
+                             write_timeout=None, connect_timeout=None, pool_timeout=None):
+            api_method = url.rsplit("/", 1)[-1]
+            self.calls[api_method] = self.calls.get(api_method, 0) + 1
+            params = request_data.parameters if request_data else {}
+            if api_method == "getMe":
+                result = BOT_USER
+            elif api_method in ("sendMessage", "editMessageText"):
+                result = {
+                    "message_id": params.get("message_id") or next(self._message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                    "from": BOT_USER,
+                    "text": params.get("text", ""),
+                }
+            else:
+                result = True
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return LocalBotRequest
+
+
+class UpdateFactory:
+    def __init__(self, bot_instance):
+        self.bot = bot_instance
+        self._ids = itertools.count(1)
+
+    def _user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"Usuario {uid}"}
+
+    def _chat(self, uid):
+        return {"id": uid, "type": "private"}
+
+    def button(self, uid, data):
+        from telegram import Update
+        update_id = next(self._ids)
+        return Update.de_json({
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(uid),
+                "chat_instance": str(uid),
+                "data": data,
+                "message": {
+                    "message_id": update_id, "date": int(time.time()), "chat": self._chat(uid),
+                    "from": BOT_USER, "text": "Selecciona un servicio:",
+                },
+            },
+        }, self.bot)
+
+    def text(self, uid, text):
+        from telegram import Update
+        update_id = next(self._ids)
+        return Update.de_json({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id, "date": int(time.time()), "chat": self._chat(uid),
+                "from": self._user(uid), "text": text,
+            },
+        }, self.bot)
+
+
+async def virtual_user(application, updates, uid, emails, services, lookups, latencies):
+    for i in range(lookups):
+        service = services[(uid + i) % len(services)]
+        await application.process_update(updates.button(uid, SERVICE_BUTTONS[service]))
+        start = time.perf_counter()
+        await application.process_update(updates.text(uid, emails[i % len(emails)]))
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+def _outcomes(bot):
+    counts = {}
+    for (service, outcome), value in list(bot.LOOKUPS_TOTAL._values.items()):
+        counts[outcome] = counts.get(outcome, 0) + value
+    return counts
+
+
+async def run_level(application, bot, updates, user_emails, concurrency, services, lookups):
+    latencies = []
+    before = _outcomes(bot)
+    users = list(user_emails.items())[:concurrency]
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        virtual_user(application, updates, uid, emails, services, lookups, latencies)
+        for uid, emails in users
+    ))
+    elapsed = time.perf_counter() - started
+    after = _outcomes(bot)
+    return {
+        "concurrency": concurrency,
+        "lookups": len(latencies),
+        "seconds": elapsed,
+        "lookups_per_s": len(latencies) / elapsed,
+        "p50_ms": _percentile(latencies, 0.50),
+        "p95_ms": _percentile(latencies, 0.95),
+        "p99_ms": _percentile(latencies, 0.99),
+        "mean_ms": statistics.fmean(latencies),
+        "outcomes": {k: after.get(k, 0) - before.get(k, 0) for k in after if after.get(k, 0) != before.get(k, 0)},
+    }
+
+
+async def run(args):
+    levels = [int(level) for level in args.concurrency.split(",")]
+    services = args.services.split(",")
+    for service in services:
+        if service not in SERVICE_BUTTONS:
+            raise SystemExit(f"Servicio desconocido: {service} (opciones: {', '.join(SERVICE_BUTTONS)})")
+
+    server = FakeIMAPServer(
+        args.accounts, args.messages, args.customers, args.latency_ms, args.jitter_ms,
+        args.error_rate, args.attachment_ratio, args.arrival_interval, args.seed, args.uid_last_ratio
+    )
+    port = await server.start()
+
+    workdir = tempfile.mkdtemp(prefix="carga-bot-")
+    user_emails = prepare_workdir(workdir, server, max(levels))
+    os.environ.update({"IMAP_HOST": "127.0.0.1", "IMAP_PORT": str(port), "IMAP_SSL": "0"})
+    os.chdir(workdir)
+    import bot  # noqa: E402
+
+    from telegram.ext import Application
+    bot.configure(bot.load_config())
+    bot.LOOKUP_LIMITER.configure(10 ** 6, 10 ** 6)
+    request = make_local_request_class()()
+    application = (
+        Application.builder()
+        .token(bot.CONFIG.token)
+        .request(request)
+        .get_updates_request(make_local_request_class()())
+        .concurrent_updates(bot.PerUserOrderedUpdateProcessor(bot.MAX_CONCURRENT_UPDATES))
+        .build()
+    )
+    bot.add_handlers(application)
+
+    results = []
+    await application.initialize()
+    await bot.post_init(application)
+    try:
+        updates = UpdateFactory(application.bot)
+        print(f"IMAP falso en 127.0.0.1:{port}, carpeta de trabajo {workdir}")
+        print(f"{'conc.':>6}{'búsq.':>8}{'búsq/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}  resultados")
+        for concurrency in levels:
+            result = await run_level(
+                application, bot, updates, user_emails, concurrency, services, args.lookups
+            )
+            results.append(result)
+            outcomes = ", ".join(f"{k}={v}" for k, v in sorted(result["outcomes"].items()))
+            print(
+                f"{concurrency:>6}{result['lookups']:>8}{result['lookups_per_s']:>9.1f}"
+                f"{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}  {outcomes}"
+            )
+    finally:
+        await bot.post_shutdown(application)
+        await application.shutdown()
+        await server.stop()
+
+    print(f"\nIMAP: {server.stats}")
+    print(f"API de Telegram: {request.calls}")
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "imap": server.stats,
+        "telegram_calls": request.calls,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32", help="niveles de usuarios simultáneos")
+    parser.add_argument("--lookups", type=int, default=20, help="búsquedas por usuario en cada nivel")
+    parser.add_argument("--services", default="disney,netflix_access_code,max_reset_link")
+    parser.add_argument("--accounts", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--customers", type=int, default=30)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--attachment-ratio", type=float, default=0.0)
+    parser.add_argument("--arrival-interval", type=float, default=0.5)
+    parser.add_argument("--uid-last-ratio", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="archivo JSON de salida")
+    args = parser.parse_args()
+
+    # run() cambia a la carpeta de trabajo temporal: la ruta de salida se fija antes.
+    output = os.path.abspath(args.output or os.path.join(
+        REPO_ROOT, "benchmarks", "results", f"load-{datetime.now():%Y%m%d-%H%M%S}.json"
+    ))
+    report = asyncio.run(run(args))
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Resultados en {output}")
+
+
+if __name__ == "__main__":
+    main()
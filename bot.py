@@ -1,25 +1,61 @@
 import os
-import socket
+import asyncio
 import imaplib
 import email
 import re
-from bs4 import BeautifulSoup
-from datetime import datetime, timezone, timedelta
+import csv
+import json
+import hmac
+import secrets
+import signal
+import ssl
+import socket
+import io
+import sys
+import gzip
+import shutil
+import queue
+import atexit
+import contextlib
+import contextvars
+import bisect
+import math
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import CancelledError as FutureCancelledError
+from concurrent.futures.process import BrokenProcessPool
+from array import array
+from datetime import datetime, date, timezone, timedelta
 
 import colorama
 from colorama import Fore, Style
 import logging
+import logging.handlers
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup
 )
+from telegram.constants import ChatAction
+from telegram.error import (
+    BadRequest,
+    Forbidden,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+    TimedOut
+)
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes
 )
@@ -28,9 +64,18 @@ from telegram.ext import (
 # 1. CONFIGURACIÓN INICIAL
 # =============================================================================
 
-IMAP_HOST = "mail.privateemail.com"
+IMAP_HOST = os.environ.get("IMAP_HOST", "mail.privateemail.com")
+IMAP_PORT = int(os.environ.get("IMAP_PORT", "993"))
+# IMAP_SSL=0 para servidores locales sin TLS (p. ej. benchmarks/fake_imap.py).
+IMAP_SSL = os.environ.get("IMAP_SSL", "1") != "0"
+ADMIN_IDS_FILE = 'admin_ids.txt'
+EMAIL_ACCOUNTS_FILE = 'admin_imap_pass.txt'
+TOKEN_FILE = 'token.txt'
+HELP_PHONE_FILE = 'help_phone.txt'
+USERS_DB_FILE = 'users_db.txt'
+LOGS_FOLDER = "logs"
 
-def load_email_accounts(filename='admin_imap_pass.txt'):
+def load_email_accounts(filename=EMAIL_ACCOUNTS_FILE):
     """
     Cada línea: 'correo@dominio.com|password'
     """
@@ -49,48 +94,70 @@ def load_email_accounts(filename='admin_imap_pass.txt'):
             accounts.append((email_str.strip(), password_str.strip()))
     return accounts
 
-EMAIL_ACCOUNTS = load_email_accounts()
-
-def load_admin_ids(filename='admin_ids.txt'):
-    admin_ids = []
+def load_admin_ids(filename=ADMIN_IDS_FILE):
+    """
+    Retorna un frozenset: is_admin es una búsqueda O(1) y el conjunto se
+    reemplaza entero (nunca se modifica) cuando cambia el archivo.
+    """
+    admin_ids = set()
     try:
         with open(filename, 'r', encoding='utf-8') as f:
             for line in f:
                 line = line.strip()
                 if line.isdigit():
-                    admin_ids.append(int(line))
+                    admin_ids.add(int(line))
     except FileNotFoundError:
         pass
-    return admin_ids
+    return frozenset(admin_ids)
 
-ADMIN_IDS = load_admin_ids()
+class BotConfig:
+    """
+    Configuración que viene de archivos: token, cuentas IMAP, administradores
+    y teléfono de ayuda. La arma load_config() al arrancar; importar el módulo
+    no lee ni crea nada.
+    """
 
-def is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_IDS
+    def __init__(self, token="", email_accounts=(), admin_ids=frozenset(), phone_number=""):
+        self.token = token
+        self.email_accounts = list(email_accounts)
+        self.admin_ids = frozenset(admin_ids)
+        self.phone_number = phone_number
 
-USERS_DB_FILE = 'users_db.txt'
-LOGS_FOLDER = "logs"
-if not os.path.exists(LOGS_FOLDER):
-    os.makedirs(LOGS_FOLDER)
-
-with open('token.txt', 'r', encoding='utf-8') as token_file:
-    TELEGRAM_BOT_TOKEN = token_file.read().strip()
-
-PHONE_NUMBER = ""
-if os.path.exists('help_phone.txt'):
-    with open('help_phone.txt', 'r', encoding='utf-8') as phone_file:
-        PHONE_NUMBER = phone_file.read().strip()
-
-HELP_TEXT = (
-    "ℹ️ *Ayuda del Bot*\n\n"
-    "Este bot te permite obtener códigos de *Disney+* o *Netflix* (o links para Max), "
-    "si tienes permiso sobre el correo. Para extraer ciertos datos, "
-    "debes contar con un permiso especial (o ser admin).\n\n"
-    "1. Pulsa un botón en el menú principal.\n"
-    "2. Ingresa tu correo.\n"
-    "3. Te enviaremos el código o link si lo encontramos (y tienes permiso).\n\n"
-    f"Si necesitas más ayuda, contáctanos por WhatsApp: {PHONE_NUMBER} 💬"
-)
+def load_config():
+    with open(TOKEN_FILE, 'r', encoding='utf-8') as token_file:
+        token = token_file.read().strip()
+
+    phone_number = ""
+    if os.path.exists(HELP_PHONE_FILE):
+        with open(HELP_PHONE_FILE, 'r', encoding='utf-8') as phone_file:
+            phone_number = phone_file.read().strip()
+
+    return BotConfig(token, load_email_accounts(), load_admin_ids(), phone_number)
+
+# Vacía hasta que main() (o quien arme la Application) llame a configure().
+CONFIG = BotConfig()
+
+def configure(config):
+    global CONFIG
+    CONFIG = config
+
+def is_admin(user_id: int) -> bool:
+    return user_id in CONFIG.admin_ids
+
+def set_admin_ids(admin_ids):
+    CONFIG.admin_ids = frozenset(admin_ids)
+
+def help_text():
+    return (
+        "ℹ️ *Ayuda del Bot*\n\n"
+        "Este bot te permite obtener códigos de *Disney+* o *Netflix* (o links para Max), "
+        "si tienes permiso sobre el correo. Para extraer ciertos datos, "
+        "debes contar con un permiso especial (o ser admin).\n\n"
+        "1. Pulsa un botón en el menú principal.\n"
+        "2. Ingresa tu correo.\n"
+        "3. Te enviaremos el código o link si lo encontramos (y tienes permiso).\n\n"
+        f"Si necesitas más ayuda, contáctanos por WhatsApp: {CONFIG.phone_number} 💬"
+    )
 
 # =============================================================================
 # 2. LOGS CON COLORES
@@ -110,15 +177,607 @@ class ColorfulFormatter(logging.Formatter):
         message = super().format(record)
         return f"{log_color}{message}{Style.RESET_ALL}"
 
-def user_log(user_id: int, message: str):
-    log_file = os.path.join(LOGS_FOLDER, f"{user_id}.txt")
-    with open(log_file, "a", encoding='utf-8') as f:
-        f.write(f"{datetime.now()}: {message}\n")
+LOG_MAX_BYTES = 1_000_000
+LOG_MAX_AGE_DAYS = 30
+LOG_MAX_OPEN_FILES = 64
+LOG_FLUSH_INTERVAL = 1.0
+LOG_BATCH_SIZE = 1000
+
+class UserLogWriter:
+    """
+    Escribe los logs por usuario desde un hilo propio: user_log sólo encola
+    la línea, el hilo agrupa los pendientes por usuario, mantiene abiertos
+    los últimos LOG_MAX_OPEN_FILES archivos (LRU) y hace flush cada
+    LOG_FLUSH_INTERVAL segundos. Cuando un archivo supera LOG_MAX_BYTES o
+    LOG_MAX_AGE_DAYS se renombra con fecha y se comprime en .gz.
+
+    Junto a cada log se mantiene '<user_id>.idx' con una línea
+    'YYYY-MM-DD offset' por día: el offset en bytes del primer evento de ese
+    día, para que /userlog pueda saltar directo a una fecha.
+    """
+    _STOP = object()
+
+    def __init__(self, folder, extension=".jsonl"):
+        self.folder = folder
+        self.extension = extension
+        self._queue = queue.SimpleQueue()
+        self._handles = OrderedDict()
+        self._segment_day = {}
+        self._indexed_day = {}
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def write(self, user_id, day, line):
+        if self._thread is None:
+            self._start()
+        self._queue.put((user_id, day, line))
+
+    def flush(self, timeout=5.0):
+        """Espera a que todo lo encolado hasta ahora esté escrito en disco."""
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def stop(self, timeout=5.0):
+        if self._thread is None:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                os.makedirs(self.folder, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name="user-log-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                batch = [self._queue.get(timeout=LOG_FLUSH_INTERVAL)]
+            except queue.Empty:
+                self._flush_all()
+                last_flush = time.monotonic()
+                continue
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            pending = {}
+            waiters = []
+            stop = False
+            for item in batch:
+                if item is self._STOP:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    user_id, day, line = item
+                    pending.setdefault(user_id, []).append((day, line))
+
+            for user_id, lines in pending.items():
+                try:
+                    self._write_lines(user_id, lines)
+                except Exception as e:
+                    logging.error(f"Error al escribir el log del usuario {user_id}: {e}")
+
+            if waiters or stop or time.monotonic() - last_flush >= LOG_FLUSH_INTERVAL:
+                self._flush_all()
+                last_flush = time.monotonic()
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                self._close_all()
+                return
+
+    def _path(self, user_id):
+        return os.path.join(self.folder, f"{user_id}{self.extension}")
+
+    def index_path(self, user_id):
+        return os.path.join(self.folder, f"{user_id}.idx")
+
+    def log_path(self, user_id):
+        return self._path(user_id)
+
+    def _last_indexed_day(self, user_id):
+        try:
+            with open(self.index_path(user_id), "rb") as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - 64))
+                lines = f.read().split()
+        except FileNotFoundError:
+            return None
+        return lines[-2].decode() if len(lines) >= 2 else None
+
+    def _segment_start_day(self, user_id):
+        """
+        Día del primer evento del segmento actual: la primera línea del .idx
+        o, si falta, el 'ts' del primer evento. (La fecha de modificación no
+        sirve: es la de la última escritura.)
+        """
+        try:
+            with open(self.index_path(user_id), "r", encoding='utf-8') as f:
+                return date.fromisoformat(f.readline().split()[0])
+        except (FileNotFoundError, IndexError, ValueError):
+            pass
+        try:
+            with open(self._path(user_id), "rb") as f:
+                return datetime.fromisoformat(json.loads(f.readline())["ts"]).date()
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            return None
+
+    def _handle(self, user_id):
+        f = self._handles.get(user_id)
+        if f is not None:
+            self._handles.move_to_end(user_id)
+            return f
+
+        path = self._path(user_id)
+        self._segment_day[user_id] = self._segment_start_day(user_id) or date.today()
+        self._indexed_day[user_id] = self._last_indexed_day(user_id)
+        f = open(path, "ab")
+        self._handles[user_id] = f
+        if len(self._handles) > LOG_MAX_OPEN_FILES:
+            old_user_id, old_f = self._handles.popitem(last=False)
+            old_f.close()
+            self._segment_day.pop(old_user_id, None)
+            self._indexed_day.pop(old_user_id, None)
+        return f
+
+    def _write_lines(self, user_id, items):
+        f = self._handle(user_id)
+        age_days = (date.today() - self._segment_day[user_id]).days
+        if f.tell() > 0 and age_days >= LOG_MAX_AGE_DAYS:
+            f = self._rotate(user_id)
+        for day, line in items:
+            if self._indexed_day.get(user_id) != day:
+                with open(self.index_path(user_id), "a", encoding='utf-8') as index_file:
+                    index_file.write(f"{day} {f.tell()}\n")
+                self._indexed_day[user_id] = day
+            f.write(line.encode('utf-8'))
+        if f.tell() >= LOG_MAX_BYTES:
+            self._rotate(user_id)
+
+    def _rotate(self, user_id):
+        f = self._handles.pop(user_id)
+        f.close()
+        self._segment_day.pop(user_id, None)
+        self._indexed_day.pop(user_id, None)
+        path = self._path(user_id)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        archived = os.path.join(self.folder, f"{user_id}.{stamp}{self.extension}")
+        os.replace(path, archived)
+        if os.path.exists(self.index_path(user_id)):
+            os.replace(self.index_path(user_id), os.path.join(self.folder, f"{user_id}.{stamp}.idx"))
+        with open(archived, "rb") as src, gzip.open(archived + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(archived)
+        return self._handle(user_id)
+
+    def _flush_all(self):
+        for f in self._handles.values():
+            f.flush()
+
+    def _close_all(self):
+        for f in self._handles.values():
+            f.close()
+        self._handles.clear()
+        self._segment_day.clear()
+        self._indexed_day.clear()
+
+USER_LOG_WRITER = UserLogWriter(LOGS_FOLDER)
+
+def user_log(user_id: int, message: str, **fields):
+    """
+    Registra un evento de auditoría en logs/<user_id>.jsonl. Campos opcionales
+    habituales: service, email, outcome, latency_ms.
+    """
+    now = datetime.now()
+    event = {"ts": now.isoformat(timespec="milliseconds"), "user": user_id, "action": message}
+    event.update(fields)
+    USER_LOG_WRITER.write(user_id, now.date().isoformat(), json.dumps(event, ensure_ascii=False) + "\n")
+    # Toda búsqueda termina en un evento con 'outcome': se cuenta aquí.
+    if "outcome" in fields and "service" in fields:
+        LOOKUPS_TOTAL.inc(fields["service"], fields["outcome"])
+        if "latency_ms" in fields:
+            LOOKUP_STATS.record_lookup(fields["service"], fields["latency_ms"])
+
+def _elapsed_ms(start):
+    return int((time.perf_counter() - start) * 1000)
+
+# =============================================================================
+# MÉTRICAS (FORMATO DE TEXTO DE PROMETHEUS)
+# =============================================================================
+
+# METRICS_PORT: si se define, se sirve GET /metrics en METRICS_LISTEN:METRICS_PORT.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = []
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """Contador con etiquetas; inc() es seguro entre hilos."""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_label_text(self.labelnames, labels)} {value}")
+        return lines
+
+class Histogram:
+    """Histograma con buckets fijos (en segundos) y etiquetas."""
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        names = self.labelnames + ("le",)
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_label_text(names, labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class CallbackGauge:
+    """Gauge cuyo valor se calcula al exportar: function() -> { etiquetas: valor }."""
+
+    def __init__(self, name, help_text, function, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        self.labelnames = labelnames
+        METRICS.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self.function().items()):
+            lines.append(f"{self.name}{_label_text(self.labelnames, labels)} {value}")
+        return lines
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return ("\n".join(lines) + "\n").encode()
+
+IMAP_STAGE_SECONDS = Histogram(
+    "bot_imap_stage_seconds", "Duración de cada etapa de una búsqueda IMAP.",
+    ("stage", "account", "service")
+)
+IMAP_MESSAGES_SCANNED = Counter(
+    "bot_imap_messages_scanned_total", "Mensajes revisados al buscar un correo.", ("account", "service")
+)
+IMAP_BYTES_FETCHED = Counter(
+    "bot_imap_bytes_fetched_total", "Bytes de mensajes descargados por IMAP.", ("account", "service")
+)
+CACHE_REQUESTS = Counter(
+    "bot_cache_requests_total", "Aciertos y fallos de caché (índice de mensajes y prefetch).",
+    ("cache", "result")
+)
+LOOKUPS_TOTAL = Counter("bot_lookups_total", "Búsquedas por servicio y resultado.", ("service", "outcome"))
+TELEGRAM_SEND_FAILURES = Counter(
+    "bot_telegram_send_failures_total", "Llamadas a Telegram que fallaron.", ("method", "error")
+)
+
+@contextlib.contextmanager
+def lookup_stage(stage, account, service):
+    """Mide una etapa de la búsqueda (connect, login, select, search, fetch, parse)."""
+    start = time.perf_counter()
+    with trace_span(stage):
+        try:
+            yield
+        finally:
+            IMAP_STAGE_SECONDS.observe(time.perf_counter() - start, stage, account, service)
+
+def count_telegram_failure(method, error):
+    TELEGRAM_SEND_FAILURES.inc(method, type(error).__name__)
+
+# ---- ESTADÍSTICAS EN PROCESO (/stats) ----
+
+STATS_WINDOWS = (("5 min", 5), ("1 h", 60), ("24 h", 1440))
+SKETCH_GAMMA = 1.04                # error relativo de los cuantiles: ~2%
+
+class QuantileSketch:
+    """
+    Sketch de cuantiles con buckets logarítmicos: cada bucket cubre un
+    factor SKETCH_GAMMA, así el error relativo es acotado y la cantidad de
+    buckets crece con el logaritmo del rango, no con las muestras.
+    """
+    __slots__ = ("counts", "count")
+    LOG_GAMMA = math.log(SKETCH_GAMMA)
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+
+    def add(self, value):
+        key = math.ceil(math.log(value) / self.LOG_GAMMA) if value > 1 else 0
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.count += other.count
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen > rank:
+                return 2 * SKETCH_GAMMA ** key / (SKETCH_GAMMA + 1) if key else 1.0
+        return SKETCH_GAMMA ** max(self.counts)
+
+class RollingStats:
+    """
+    Estadísticas por minuto (latencia por servicio, búsquedas, errores por
+    cuenta IMAP) en una ventana de 24 h. Las ventanas se arman uniendo los
+    minutos que correspondan, por lo que la memoria no depende del tráfico.
+    """
+
+    def __init__(self, minutes=1440):
+        self._slots = deque(maxlen=minutes)
+        self._lock = threading.Lock()
+
+    def _current_slot(self):
+        minute = int(time.time() // 60)
+        if not self._slots or self._slots[-1][0] != minute:
+            self._slots.append((minute, {"latency": {}, "accounts": {}}))
+        return self._slots[-1][1]
+
+    def record_lookup(self, service, latency_ms):
+        with self._lock:
+            latency = self._current_slot()["latency"]
+            sketch = latency.get(service)
+            if sketch is None:
+                sketch = latency[service] = QuantileSketch()
+            sketch.add(latency_ms)
+
+    def record_account(self, account, ok):
+        with self._lock:
+            accounts = self._current_slot()["accounts"]
+            counts = accounts.setdefault(account, [0, 0])
+            counts[0 if ok else 1] += 1
+
+    def summary(self, minutes):
+        """Retorna ({servicio: sketch}, {cuenta: [ok, errores]}) de los últimos 'minutes'."""
+        since = int(time.time() // 60) - minutes
+        latency, accounts = {}, {}
+        with self._lock:
+            slots = [data for minute, data in self._slots if minute > since]
+            for data in slots:
+                for service, sketch in data["latency"].items():
+                    latency.setdefault(service, QuantileSketch()).merge(sketch)
+                for account, (ok, errors) in data["accounts"].items():
+                    counts = accounts.setdefault(account, [0, 0])
+                    counts[0] += ok
+                    counts[1] += errors
+        return latency, accounts
+
+LOOKUP_STATS = RollingStats()
+
+# =============================================================================
+# TRAZAS POR BÚSQUEDA (/explain)
+# =============================================================================
+
+TRACE_BUFFER_SIZE = 200            # últimas trazas guardadas en memoria
+TRACE_MAX_SPANS = 500              # spans por traza (el resto se descarta)
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "start", "end", "attrs")
+
+    def __init__(self, span_id, parent_id, name, start, attrs):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = start
+        self.end = None
+        self.attrs = attrs
+
+class Trace:
+    """Traza de una búsqueda: spans con inicio/fin relativos (perf_counter)."""
+
+    def __init__(self, name, **attrs):
+        self.trace_id = secrets.token_hex(4)
+        self.name = name
+        self.attrs = attrs
+        self.created = datetime.now()
+        self.start = time.perf_counter()
+        self.end = None
+        self.spans = []
+        self._ids = iter(range(1, 1 << 62))
+
+    def add_span(self, parent_id, name, start, attrs):
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            return None
+        span = Span(next(self._ids), parent_id, name, start, attrs)
+        self.spans.append(span)
+        return span
+
+TRACES = deque(maxlen=TRACE_BUFFER_SIZE)
+_CURRENT_TRACE = contextvars.ContextVar("current_trace", default=None)
+_CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+
+@contextlib.contextmanager
+def start_trace(name, **attrs):
+    """Abre una traza para la tarea actual (y los hilos que lance) y la guarda en TRACES."""
+    trace = Trace(name, **attrs)
+    trace_token = _CURRENT_TRACE.set(trace)
+    span_token = _CURRENT_SPAN.set(None)
+    try:
+        yield trace
+    finally:
+        trace.end = time.perf_counter()
+        _CURRENT_SPAN.reset(span_token)
+        _CURRENT_TRACE.reset(trace_token)
+        TRACES.append(trace)
+
+@contextlib.contextmanager
+def trace_span(name, **attrs):
+    """
+    Span hijo del span actual. Sin traza activa no hace nada. Retorna el
+    dict de atributos para completarlo dentro del bloque.
+    """
+    trace = _CURRENT_TRACE.get()
+    if trace is None:
+        yield attrs
+        return
+    parent = _CURRENT_SPAN.get()
+    span = trace.add_span(parent.span_id if parent else None, name, time.perf_counter(), attrs)
+    if span is None:
+        yield attrs
+        return
+    token = _CURRENT_SPAN.set(span)
+    try:
+        yield attrs
+    except Exception as e:
+        attrs["error"] = type(e).__name__
+        raise
+    finally:
+        span.end = time.perf_counter()
+        _CURRENT_SPAN.reset(token)
+
+def record_span(name, start, end, **attrs):
+    """Agrega un span ya terminado (p. ej. el tiempo en la cola)."""
+    trace = _CURRENT_TRACE.get()
+    if trace is not None:
+        parent = _CURRENT_SPAN.get()
+        span = trace.add_span(parent.span_id if parent else None, name, start, attrs)
+        if span is not None:
+            span.end = end
+
+def find_trace(trace_id):
+    for trace in reversed(TRACES):
+        if trace.trace_id == trace_id:
+            return trace
+    return None
+
+def current_trace_id():
+    trace = _CURRENT_TRACE.get()
+    return trace.trace_id if trace else None
+
+def render_trace(trace, limit=4000):
+    """Árbol de spans en texto plano, con tiempos en ms relativos al inicio."""
+    def ms(value):
+        return f"{(value - trace.start) * 1000:.0f}"
+
+    def describe(attrs):
+        return " ".join(f"{key}={value}" for key, value in attrs.items())
+
+    total = f"{(trace.end - trace.start) * 1000:.0f} ms" if trace.end else "en curso"
+    lines = [f"traza {trace.trace_id} {trace.name} {describe(trace.attrs)} — {total}"]
+    children = {}
+    for span in list(trace.spans):
+        children.setdefault(span.parent_id, []).append(span)
+
+    def walk(parent_id, depth):
+        for span in sorted(children.get(parent_id, []), key=lambda s: s.start):
+            duration = f"{(span.end - span.start) * 1000:.1f} ms" if span.end else "sin terminar"
+            lines.append(f"{'  ' * depth}{span.name} @{ms(span.start)} {duration} {describe(span.attrs)}".rstrip())
+            walk(span.span_id, depth + 1)
+
+    walk(None, 1)
+    text = "\n".join(lines)
+    if len(text) > limit:
+        text = text[:limit] + "\n…"
+    return text
+
+def make_metrics_handler():
+    async def handle_request(method, path, headers, body):
+        if path != "/metrics":
+            return 404, "text/plain", b"not found"
+        return 200, "text/plain; version=0.0.4; charset=utf-8", render_metrics()
+    return handle_request
 
 # =============================================================================
 # 3. BASE DE DATOS DE USUARIOS (ACCESO A CORREOS)
 # =============================================================================
 
+def commit_files(contents):
+    """
+    Escribe varios archivos como una sola transacción: primero se generan
+    todos los '.tmp' y sólo si todos se escribieron bien se reemplazan los
+    originales (os.replace es atómico), así nunca quedan archivos a medias.
+    contents: { nombre_archivo: iterable de líneas }
+    """
+    written = []
+    try:
+        for filename, lines in contents.items():
+            tmp_name = f"{filename}.tmp"
+            with open(tmp_name, 'w', encoding='utf-8') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            written.append((tmp_name, filename))
+    except Exception:
+        for tmp_name, _ in written:
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
+        raise
+
+    for tmp_name, filename in written:
+        os.replace(tmp_name, filename)
+
 def load_users():
     """
     Retorna un dict { user_id: { 'email': date or None, ...}, ...}
@@ -154,40 +813,179 @@ def load_users():
                     users_dict[uid][item.lower()] = None
     return users_dict
 
+def _format_users_lines(users_dict):
+    for uid, emails_dict in users_dict.items():
+        if not emails_dict:
+            yield str(uid) + "\n"
+            continue
+
+        items = []
+        for mail, exp_date in emails_dict.items():
+            if exp_date is None:
+                items.append(mail)
+            else:
+                items.append(f"{mail}:{exp_date.isoformat()}")
+        yield f"{uid} {' '.join(items)}\n"
+
 def save_users(users_dict):
-    with open(USERS_DB_FILE, 'w', encoding='utf-8') as f:
+    global _USER_STORE, _USER_STORE_SIGNATURE
+    commit_files({USERS_DB_FILE: _format_users_lines(users_dict)})
+    _USER_STORE = UserGrantStore.from_users_dict(users_dict)
+    _USER_STORE_SIGNATURE = _file_signature(USERS_DB_FILE)
+
+# Ordinal 0 = acceso ilimitado (date.toordinal() siempre es >= 1).
+UNLIMITED_ORDINAL = 0
+
+class UserGrantStore:
+    """
+    Versión compacta de users_db.txt que se mantiene en memoria.
+    Las filas de cada usuario son contiguas: el usuario en el slot k ocupa
+    las filas offsets[k]:offsets[k+1]. Los correos se internan (un solo str
+    por dirección) y la expiración se guarda como ordinal entero.
+    """
+    __slots__ = ("_slot_of", "_uids", "_offsets", "_emails", "_expiries")
+
+    def __init__(self):
+        self._slot_of = {}
+        self._uids = array('q')
+        self._offsets = array('l', [0])
+        self._emails = []
+        self._expiries = array('l')
+
+    @classmethod
+    def from_users_dict(cls, users_dict):
+        store = cls()
         for uid, emails_dict in users_dict.items():
-            if not emails_dict:
-                f.write(str(uid) + "\n")
-                continue
+            store._append_user(uid, (
+                (mail, exp_date.toordinal() if exp_date else UNLIMITED_ORDINAL)
+                for mail, exp_date in emails_dict.items()
+            ))
+        return store
+
+    @classmethod
+    def from_file(cls, filename):
+        """Lee el archivo directamente, sin crear dicts ni objetos date intermedios."""
+        store = cls()
+        if not os.path.exists(filename):
+            return store
+
+        ordinal_cache = {}
+        with open(filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if not parts:
+                    continue
+                try:
+                    uid = int(parts[0])
+                except ValueError:
+                    continue
 
-            items = []
-            for mail, exp_date in emails_dict.items():
-                if exp_date is None:
-                    items.append(mail)
-                else:
-                    items.append(f"{mail}:{exp_date.isoformat()}")
-            line = f"{uid} {' '.join(items)}"
-            f.write(line + "\n")
+                grants = []
+                for item in parts[1:]:
+                    if ':' in item:
+                        mail_part, date_str = item.split(':', 1)
+                        ordinal = ordinal_cache.get(date_str)
+                        if ordinal is None:
+                            try:
+                                ordinal = datetime.strptime(date_str, "%Y-%m-%d").date().toordinal()
+                            except ValueError:
+                                ordinal = UNLIMITED_ORDINAL
+                            ordinal_cache[date_str] = ordinal
+                        grants.append((mail_part.lower(), ordinal))
+                    else:
+                        grants.append((item.lower(), UNLIMITED_ORDINAL))
+                store._append_user(uid, grants)
+        return store
+
+    def _append_user(self, uid, grants):
+        # Si el user_id se repite, gana la última línea (igual que load_users).
+        self._slot_of[uid] = len(self._uids)
+        self._uids.append(uid)
+        for mail, ordinal in grants:
+            self._emails.append(sys.intern(mail))
+            self._expiries.append(ordinal)
+        self._offsets.append(len(self._emails))
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def __contains__(self, uid):
+        return uid in self._slot_of
+
+    def _rows(self, uid):
+        slot = self._slot_of.get(uid)
+        if slot is None:
+            return range(0)
+        return range(self._offsets[slot], self._offsets[slot + 1])
+
+    def expiry_ordinal(self, uid, mail):
+        """Ordinal de expiración, UNLIMITED_ORDINAL si es ilimitado, o None si no hay acceso."""
+        emails = self._emails
+        for row in reversed(self._rows(uid)):
+            if emails[row] == mail:
+                return self._expiries[row]
+        return None
 
-def user_has_valid_access(user_id: int, email_address: str) -> bool:
-    if is_admin(user_id):
-        return True
+    def has_valid_access(self, uid, mail, today_ordinal=None):
+        ordinal = self.expiry_ordinal(uid, mail)
+        if ordinal is None:
+            return False
+        if ordinal == UNLIMITED_ORDINAL:
+            return True
+        if today_ordinal is None:
+            today_ordinal = datetime.now().date().toordinal()
+        return today_ordinal <= ordinal
+
+    def has_any_valid_access(self, uid, today_ordinal=None):
+        if today_ordinal is None:
+            today_ordinal = datetime.now().date().toordinal()
+        return any(
+            self._expiries[row] == UNLIMITED_ORDINAL or today_ordinal <= self._expiries[row]
+            for row in self._rows(uid)
+        )
 
-    users_dict = load_users()
-    if user_id not in users_dict:
-        return False
+    def grants(self, uid):
+        """Lista [(correo, date o None), ...] del usuario, como en load_users()."""
+        result = {}
+        for row in self._rows(uid):
+            ordinal = self._expiries[row]
+            result[self._emails[row]] = None if ordinal == UNLIMITED_ORDINAL else date.fromordinal(ordinal)
+        return list(result.items())
 
-    mail = email_address.lower()
-    if mail not in users_dict[user_id]:
-        return False
+    def user_rows(self, uid):
+        """Lista [(correo, ordinal), ...] del usuario, sin convertir a date."""
+        return [(self._emails[row], self._expiries[row]) for row in self._rows(uid)]
 
-    exp_date = users_dict[user_id][mail]
-    if exp_date is None:
+    def user_ids(self):
+        return list(self._slot_of)
+
+_USER_STORE = None
+_USER_STORE_SIGNATURE = None
+
+def _file_signature(filename):
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def get_user_store() -> UserGrantStore:
+    """
+    Retorna el UserGrantStore en memoria, recargándolo sólo si
+    users_db.txt cambió en disco.
+    """
+    global _USER_STORE, _USER_STORE_SIGNATURE
+    signature = _file_signature(USERS_DB_FILE)
+    if _USER_STORE is None or signature != _USER_STORE_SIGNATURE:
+        _USER_STORE = UserGrantStore.from_file(USERS_DB_FILE)
+        _USER_STORE_SIGNATURE = signature
+    return _USER_STORE
+
+def user_has_valid_access(user_id: int, email_address: str) -> bool:
+    if is_admin(user_id):
         return True
 
-    today = datetime.now().date()
-    return today <= exp_date
+    return get_user_store().has_valid_access(user_id, email_address.lower())
 
 # =============================================================================
 # 4. BASE DE DATOS DE PERMISO DE CÓDIGOS (Netflix, Disney) y LINKS (Max)
@@ -197,6 +995,17 @@ NETFLIX_CODE_FILE = "netflix_code_db.txt"
 DISNEY_CODE_FILE = "disney_code_db.txt"
 MAX_LINK_FILE = "max_link_db.txt"
 
+# Copia en memoria de cada archivo de permisos; la recarga el vigilante de
+# archivos (ver watch_config_files) y la actualizan los save_*.
+_PERMISSION_CACHE = {}
+
+def _format_expiry_lines(code_dict):
+    for uid, exp_date in code_dict.items():
+        if exp_date is None:
+            yield f"{uid} None\n"
+        else:
+            yield f"{uid} {exp_date.isoformat()}\n"
+
 def load_netflix_code_access():
     code_dict = {}
     if not os.path.exists(NETFLIX_CODE_FILE):
@@ -225,12 +1034,8 @@ def load_netflix_code_access():
     return code_dict
 
 def save_netflix_code_access(code_dict):
-    with open(NETFLIX_CODE_FILE, 'w', encoding='utf-8') as f:
-        for uid, exp_date in code_dict.items():
-            if exp_date is None:
-                f.write(f"{uid} None\n")
-            else:
-                f.write(f"{uid} {exp_date.isoformat()}\n")
+    commit_files({NETFLIX_CODE_FILE: _format_expiry_lines(code_dict)})
+    _PERMISSION_CACHE["netflix"] = dict(code_dict)
 
 def load_disney_code_access():
     code_dict = {}
@@ -260,12 +1065,8 @@ def load_disney_code_access():
     return code_dict
 
 def save_disney_code_access(code_dict):
-    with open(DISNEY_CODE_FILE, 'w', encoding='utf-8') as f:
-        for uid, exp_date in code_dict.items():
-            if exp_date is None:
-                f.write(f"{uid} None\n")
-            else:
-                f.write(f"{uid} {exp_date.isoformat()}\n")
+    commit_files({DISNEY_CODE_FILE: _format_expiry_lines(code_dict)})
+    _PERMISSION_CACHE["disney"] = dict(code_dict)
 
 # --- MAX ---
 
@@ -297,89 +1098,611 @@ def load_max_link_access():
     return link_dict
 
 def save_max_link_access(link_dict):
-    with open(MAX_LINK_FILE, 'w', encoding='utf-8') as f:
-        for uid, exp_date in link_dict.items():
-            if exp_date is None:
-                f.write(f"{uid} None\n")
-            else:
-                f.write(f"{uid} {exp_date.isoformat()}\n")
+    commit_files({MAX_LINK_FILE: _format_expiry_lines(link_dict)})
+    _PERMISSION_CACHE["max"] = dict(link_dict)
+
+PERMISSION_LOADERS = {
+    "disney": load_disney_code_access,
+    "netflix": load_netflix_code_access,
+    "max": load_max_link_access,
+}
+
+def get_permission_dict(kind):
+    """Permisos de 'disney', 'netflix' o 'max' desde la copia en memoria."""
+    code_dict = _PERMISSION_CACHE.get(kind)
+    if code_dict is None:
+        code_dict = PERMISSION_LOADERS[kind]()
+        _PERMISSION_CACHE[kind] = code_dict
+    return code_dict
 
 # =============================================================================
-# 5. FUNCIONES PARA DISNEY (códigos), NETFLIX (códigos), MAX (link)
+# RECARGA EN CALIENTE DE CONFIGURACIÓN
 # =============================================================================
 
-# ---- DISNEY ----
-def user_has_disney_code_permission(user_id: int) -> bool:
-    if is_admin(user_id):
-        return True
+CONFIG_POLL_INTERVAL = 5
 
-    code_dict = load_disney_code_access()
-    if user_id not in code_dict:
-        return False
+def _reload_admin_ids():
+    new_admin_ids = load_admin_ids()
+    if new_admin_ids != CONFIG.admin_ids:
+        logging.info(f"admin_ids recargado: {len(new_admin_ids)} administradores")
+    CONFIG.admin_ids = new_admin_ids
 
-    exp_date = code_dict[user_id]
-    if exp_date is None:
-        return True
+def _reload_email_accounts():
+    try:
+        new_accounts = load_email_accounts(EMAIL_ACCOUNTS_FILE)
+    except FileNotFoundError:
+        logging.error(f"{EMAIL_ACCOUNTS_FILE} no existe; se mantienen las cuentas IMAP actuales")
+        return
 
-    today = datetime.now().date()
-    return today <= exp_date
+    changed = set(CONFIG.email_accounts) ^ set(new_accounts)
+    CONFIG.email_accounts = new_accounts
+    if changed:
+        changed_emails = sorted({acc_email for acc_email, _ in changed})
+        logging.info(f"Cuentas IMAP recargadas, cambiaron: {', '.join(changed_emails)}")
+        current_emails = {acc_email for acc_email, _ in new_accounts}
+        for acc_email in changed_emails:
+            IMAP_POOL.reset_account(acc_email)
+            if acc_email not in current_emails:
+                drop_mailbox_indexes(acc_email)
+
+def _reload_permissions(kind):
+    _PERMISSION_CACHE[kind] = PERMISSION_LOADERS[kind]()
+    logging.info(f"Permisos de {kind} recargados")
+
+WATCHED_FILES = {
+    ADMIN_IDS_FILE: _reload_admin_ids,
+    EMAIL_ACCOUNTS_FILE: _reload_email_accounts,
+    USERS_DB_FILE: lambda: get_user_store(),
+    DISNEY_CODE_FILE: lambda: _reload_permissions("disney"),
+    NETFLIX_CODE_FILE: lambda: _reload_permissions("netflix"),
+    MAX_LINK_FILE: lambda: _reload_permissions("max"),
+}
+# Se toma al arrancar watch_config_files: lo que había al cargar la configuración.
+_WATCHED_SIGNATURES = {}
+
+def check_config_files():
+    """
+    Recarga los archivos vigilados cuyo mtime/tamaño cambió. Cada recarga
+    construye los datos nuevos completos y luego los asigna de una vez,
+    así las búsquedas en curso siguen viendo la versión anterior.
+    """
+    for filename, reload_function in WATCHED_FILES.items():
+        signature = _file_signature(filename)
+        if signature == _WATCHED_SIGNATURES.get(filename):
+            continue
+        _WATCHED_SIGNATURES[filename] = signature
+        try:
+            reload_function()
+        except Exception as e:
+            logging.error(f"Error al recargar {filename}: {e}")
 
-def get_disney_code(requested_email: str):
-    socket.setdefaulttimeout(15)
+async def watch_config_files():
+    """
+    Vigila los archivos de configuración con inotify (paquete opcional
+    'watchfiles'); si no está instalado, revisa cada CONFIG_POLL_INTERVAL s.
+    """
+    for filename in WATCHED_FILES:
+        _WATCHED_SIGNATURES.setdefault(filename, _file_signature(filename))
+    try:
+        from watchfiles import awatch
+    except ImportError:
+        awatch = None
 
-    for (acc_email, acc_password) in EMAIL_ACCOUNTS:
-        try:
-            server = imaplib.IMAP4_SSL(IMAP_HOST)
+    if awatch is None:
+        logging.info(f"watchfiles no disponible, revisando configuración cada {CONFIG_POLL_INTERVAL}s")
+        while True:
+            await asyncio.sleep(CONFIG_POLL_INTERVAL)
+            check_config_files()
+
+    watched_names = {os.path.basename(filename) for filename in WATCHED_FILES}
+    async for changes in awatch(".", recursive=False, debounce=500):
+        if any(os.path.basename(path) in watched_names for _, path in changes):
+            check_config_files()
+
+# =============================================================================
+# 5. FUNCIONES PARA DISNEY (códigos), NETFLIX (códigos), MAX (link)
+# =============================================================================
+
+# ---- POOL DE CONEXIONES E ÍNDICE DE MENSAJES RECIENTES ----
+
+IMAP_TIMEOUT = 15
+IMAP_POOL_MAX_IDLE = 2         # conexiones ociosas guardadas por cuenta
+IMAP_NOOP_AFTER = 60           # segundos ociosa tras los cuales se verifica con NOOP
+RECENT_MESSAGES = 50           # mensajes recientes por servicio que se revisan
+
+SERVICE_SEARCH_CRITERIA = {
+    "disney": '(OR FROM "disneyplus@mail.disneyplus.com" (OR FROM "disneyplus@mail2.disneyplus.com" FROM "disneyplus@trx.mail2.disneyplus.com"))',
+    "netflix": '(OR FROM "info@account.netflix.com" FROM "no-reply@netflix.com")',
+    "max": '(FROM "no-reply@marketing.max.com")',
+}
+SERVICE_NAMES = {"disney": "Disney+", "netflix": "Netflix", "max": "Max"}
+RECIPIENT_HEADERS = ("to", "cc", "bcc", "delivered-to", "x-original-to")
+
+class IMAPConnectionPool:
+    """
+    Conexiones IMAP ya autenticadas y con INBOX seleccionado, reutilizables
+    entre búsquedas. Cada conexión la usa un solo hilo a la vez.
+    """
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self._idle = {}
+        self._busy = set()
+        self._lock = threading.Lock()
+
+    def _connect(self, acc_email, acc_password, service):
+        with lookup_stage("connect", acc_email, service):
+            imap_class = imaplib.IMAP4_SSL if IMAP_SSL else imaplib.IMAP4
+            server = imap_class(IMAP_HOST, IMAP_PORT, timeout=IMAP_TIMEOUT)
+        with lookup_stage("login", acc_email, service):
             server.login(acc_email, acc_password)
+        with lookup_stage("select", acc_email, service):
             server.select("INBOX")
-
-            status, messages = server.search(
-                None,
-                '(OR FROM "disneyplus@mail.disneyplus.com" (OR FROM "disneyplus@mail2.disneyplus.com" FROM "disneyplus@trx.mail2.disneyplus.com"))'
-            )
-            if status != "OK" or not messages or not messages[0]:
-                server.logout()
+        return server
+
+    def _checkout(self, acc_email, acc_password, service):
+        while True:
+            with self._lock:
+                idle = self._idle.get(acc_email)
+                if not idle:
+                    break
+                server, password, last_used = idle.pop()
+            if password != acc_password:
+                _logout_quietly(server)
                 continue
+            if time.monotonic() - last_used > IMAP_NOOP_AFTER:
+                try:
+                    server.noop()
+                except Exception:
+                    _logout_quietly(server)
+                    continue
+            return server
+        return self._connect(acc_email, acc_password, service)
+
+    def _checkin(self, acc_email, acc_password, server):
+        with self._lock:
+            idle = self._idle.setdefault(acc_email, [])
+            if len(idle) < self.max_idle:
+                idle.append((server, acc_password, time.monotonic()))
+                return
+        _logout_quietly(server)
+
+    @contextlib.contextmanager
+    def connection(self, acc_email, acc_password, service=""):
+        server = self._checkout(acc_email, acc_password, service)
+        with self._lock:
+            self._busy.add(server)
+        try:
+            yield server
+        except Exception:
+            _logout_quietly(server)
+            raise
+        else:
+            self._checkin(acc_email, acc_password, server)
+        finally:
+            with self._lock:
+                self._busy.discard(server)
+
+    def reset_account(self, acc_email):
+        """Cierra las conexiones ociosas de una cuenta (p. ej. cambió su contraseña)."""
+        with self._lock:
+            idle = self._idle.pop(acc_email, [])
+        for server, _, _ in idle:
+            _logout_quietly(server)
+
+    def close_all(self):
+        with self._lock:
+            all_idle = list(self._idle.values())
+            self._idle.clear()
+        for idle in all_idle:
+            for server, _, _ in idle:
+                _logout_quietly(server)
+
+    def abort_busy(self):
+        """
+        Cierra el socket de las conexiones en uso: el hilo que estaba leyendo
+        recibe un error y termina en lugar de esperar IMAP_TIMEOUT.
+        """
+        with self._lock:
+            busy = list(self._busy)
+        for server in busy:
+            try:
+                # Sólo shutdown del socket: close() esperaría el lock del hilo lector.
+                server.sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+        return len(busy)
 
-            email_ids = messages[0].split()
-            if len(email_ids) > 50:
-                email_ids = email_ids[-50:]
+def _logout_quietly(server):
+    try:
+        server.logout()
+    except Exception:
+        pass
 
-            for email_id in reversed(email_ids):
-                status_msg, msg_data = server.fetch(email_id, "(RFC822)")
-                if status_msg != "OK":
-                    continue
+IMAP_POOL = IMAPConnectionPool(IMAP_POOL_MAX_IDLE)
+
+class IndexedMessage:
+    __slots__ = ("uid", "recipients", "date", "raw")
 
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg_obj = email.message_from_bytes(response_part[1])
+    def __init__(self, uid, recipients, date, raw):
+        self.uid = uid
+        self.recipients = recipients
+        self.date = date
+        self.raw = raw
 
-                        recipients = []
-                        for header_key, header_value in msg_obj.items():
-                            if header_key.lower() in ["to", "cc", "bcc", "delivered-to", "x-original-to"]:
-                                if header_value:
-                                    recipients.extend([addr.strip().lower() for addr in header_value.split(",")])
+def _message_recipients(msg_obj):
+    recipients = []
+    for header_key, header_value in msg_obj.items():
+        if header_key.lower() in RECIPIENT_HEADERS:
+            if header_value:
+                recipients.extend([addr.strip().lower() for addr in header_value.split(",")])
+    return frozenset(recipients)
 
-                        if not any(recipient == requested_email for recipient in recipients):
-                            continue
+def _index_message(uid, raw):
+    msg_obj = email.message_from_bytes(raw)
+    try:
+        parsed_date = email.utils.parsedate_to_datetime(msg_obj["Date"]).astimezone(timezone.utc)
+    except (TypeError, ValueError):
+        parsed_date = None
+    return IndexedMessage(uid, _message_recipients(msg_obj), parsed_date, raw)
+
+_FETCH_UID_RE = re.compile(rb"UID (\d+)")
+
+def _fetch_uids(server, uids):
+    """
+    FETCH de varios UIDs en un solo comando; retorna { uid: bytes }. El UID
+    puede venir antes del literal (en la tupla) o después (RFC 3501 lo
+    permite): imaplib deja ese resto, p. ej. b' UID 42)', como el elemento
+    siguiente de 'data'.
+    """
+    status, data = server.uid("FETCH", ",".join(str(uid) for uid in uids), "(RFC822)")
+    if status != "OK":
+        return {}
+    fetched = {}
+    missing = 0
+    pending = None              # literal cuyo UID todavía no apareció
+    for response_part in data:
+        if isinstance(response_part, tuple):
+            if pending is not None:
+                missing += 1
+            match = _FETCH_UID_RE.search(response_part[0])
+            if match:
+                fetched[int(match.group(1))] = response_part[1]
+                pending = None
+            else:
+                pending = response_part[1]
+        elif pending is not None and isinstance(response_part, bytes):
+            match = _FETCH_UID_RE.search(response_part)
+            if match:
+                fetched[int(match.group(1))] = pending
+            else:
+                missing += 1
+            pending = None
+    if pending is not None:
+        missing += 1
+    if missing:
+        logging.warning(f"FETCH: {missing} mensajes llegaron sin UID y no se indexaron")
+    return fetched
+
+class MailboxIndex:
+    """
+    Últimos RECENT_MESSAGES mensajes de un servicio en una cuenta, con los
+    destinatarios y la fecha ya extraídos. refresh() sólo descarga los UIDs
+    que todavía no están en el índice.
+    """
 
-                        date_header = msg_obj["Date"]
-                        parsed_date = email.utils.parsedate_to_datetime(date_header).astimezone(timezone.utc)
-                        now = datetime.now(timezone.utc)
-                        diff = now - parsed_date
-                        total_minutes = int(diff.total_seconds() // 60)
+    def __init__(self, acc_email, service):
+        self.acc_email = acc_email
+        self.service = service
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.refresh_started_at = 0.0
+        self.last_fetched = 0
+        self.prefetched_at = None
+        self.prefetch_ms = 0.0
+
+    def refresh(self, server):
+        started_at = time.monotonic()
+        with lookup_stage("search", self.acc_email, self.service):
+            status, data = server.uid("SEARCH", None, SERVICE_SEARCH_CRITERIA[self.service])
+        uids = []
+        if status == "OK" and data and data[0]:
+            uids = [int(uid) for uid in data[0].split()][-RECENT_MESSAGES:]
+
+        new_uids = [uid for uid in uids if uid not in self.entries]
+        fetched = {}
+        if new_uids:
+            with lookup_stage("fetch", self.acc_email, self.service):
+                fetched = _fetch_uids(server, new_uids)
+            IMAP_BYTES_FETCHED.inc(self.acc_email, self.service, amount=sum(len(raw) for raw in fetched.values()))
+        self.last_fetched = len(fetched)
+        CACHE_REQUESTS.inc("index", "hit", amount=len(uids) - len(new_uids))
+        CACHE_REQUESTS.inc("index", "miss", amount=len(new_uids))
+
+        entries = OrderedDict()
+        new_entries = []
+        for uid in uids:
+            if uid in self.entries:
+                entries[uid] = self.entries[uid]
+            elif uid in fetched:
+                entries[uid] = _index_message(uid, fetched[uid])
+                new_entries.append(entries[uid])
+        first_refresh = not self.refresh_started_at
+        self.entries = entries
+        self.refresh_started_at = started_at
+        # En la primera carga todo es "nuevo"; sólo se avisa de lo que llega después.
+        if new_entries and not first_refresh:
+            for listener in INDEX_LISTENERS:
+                listener(self.service, new_entries, started_at)
+        return list(entries.values())
+
+# Funciones listener(service, new_entries, refresh_started_at) a las que se
+# avisa, desde el hilo de la búsqueda, cuando un refresh trae mensajes nuevos.
+INDEX_LISTENERS = []
+
+_MAILBOX_INDEXES = {}
+_MAILBOX_INDEXES_LOCK = threading.Lock()
+
+def get_mailbox_index(acc_email, service):
+    key = (acc_email, service)
+    index = _MAILBOX_INDEXES.get(key)
+    if index is None:
+        with _MAILBOX_INDEXES_LOCK:
+            index = _MAILBOX_INDEXES.setdefault(key, MailboxIndex(acc_email, service))
+    return index
+
+def drop_mailbox_indexes(acc_email):
+    with _MAILBOX_INDEXES_LOCK:
+        for key in [key for key in _MAILBOX_INDEXES if key[0] == acc_email]:
+            del _MAILBOX_INDEXES[key]
+
+def refresh_mailbox_index(acc_email, acc_password, service, requested_at=None, purpose="lookup"):
+    """
+    Actualiza el índice (acc_email, service) y retorna sus mensajes, del más
+    viejo al más nuevo. Si otro hilo ya hizo un refresh que empezó después de
+    'requested_at', se reutiliza ese resultado en lugar de volver a consultar.
+    """
+    index = get_mailbox_index(acc_email, service)
+    with trace_span("refresh") as span_attrs, index.lock:
+        if requested_at is not None and index.refresh_started_at >= requested_at:
+            span_attrs["reutilizado"] = True
+            return list(index.entries.values())
+
+        started = time.perf_counter()
+        with IMAP_POOL.connection(acc_email, acc_password, service) as server:
+            entries = index.refresh(server)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        span_attrs["mensajes"] = len(entries)
+        span_attrs["descargados"] = index.last_fetched
+
+        if purpose == "prefetch":
+            index.prefetched_at = time.monotonic()
+            index.prefetch_ms = elapsed_ms
+        elif purpose == "lookup":
+            _record_prefetch_result(index, elapsed_ms)
+        return entries
+
+# Marca de inicio compartida por las búsquedas de un lote: así todas reutilizan
+# el mismo escaneo de cada buzón (ver refresh_mailbox_index).
+_SCAN_REQUESTED_AT = contextvars.ContextVar("scan_requested_at", default=None)
+
+def _minutes_since(parsed_date):
+    diff = datetime.now(timezone.utc) - parsed_date
+    return int(diff.total_seconds() // 60)
+
+# ---- PARSEO EN PROCESOS ----
+
+# Procesos que decodifican el MIME y extraen con bs4 (0 = en el hilo de la
+# búsqueda). Con varios núcleos evita que el GIL limite el parseo a uno.
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", "0"))
+PARSE_BATCH_SIZE = 8           # mensajes candidatos por tarea enviada a un proceso
+PARSE_OFFLOAD_MIN_BYTES = 64 * 1024   # lotes más chicos se parsean en el hilo
+_PARSE_POOL = None
+_PARSE_POOL_CLOSED = False     # tras el apagado no se vuelve a crear
+_PARSE_POOL_LOCK = threading.Lock()
+
+def parse_first(parse_function, raw_messages):
+    """
+    Parsea los mensajes en orden y retorna (posición, valor) del primero del
+    que parse_function extrae algo, o (None, None). Corre en un proceso del
+    pool: recibe los bytes crudos y sólo devuelve el resultado.
+    """
+    for position, raw in enumerate(raw_messages):
+        value = parse_function(email.message_from_bytes(raw))
+        if value:
+            return position, value
+    return None, None
 
-                        code = extract_6_digit_code(msg_obj)
-                        if code:
-                            server.logout()
-                            return code, total_minutes
+def get_parse_pool():
+    """
+    Pool de procesos con 'spawn' (no fork: el bot tiene hilos); cada proceso
+    importa bot.py, que no tiene efectos secundarios al importarse.
+    """
+    global _PARSE_POOL
+    if PARSE_WORKERS <= 0:
+        return None
+    with _PARSE_POOL_LOCK:
+        if _PARSE_POOL is None and not _PARSE_POOL_CLOSED:
+            _PARSE_POOL = ProcessPoolExecutor(
+                max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _PARSE_POOL
+
+def start_parse_pool():
+    """Arranca los procesos ya (importar bot en cada uno tarda) sin esperarlos."""
+    pool = get_parse_pool()
+    if pool is not None:
+        for _ in range(PARSE_WORKERS):
+            pool.submit(parse_first, extract_6_digit_code, [])
+
+def _discard_parse_pool(closed=False):
+    global _PARSE_POOL, _PARSE_POOL_CLOSED
+    with _PARSE_POOL_LOCK:
+        pool, _PARSE_POOL = _PARSE_POOL, None
+        _PARSE_POOL_CLOSED = _PARSE_POOL_CLOSED or closed
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def shutdown_parse_pool():
+    """Cierra el pool para siempre: las búsquedas que sigan parsean en su hilo."""
+    _discard_parse_pool(closed=True)
+
+def run_parse(parse_function, raw_messages):
+    """parse_first en lotes de PARSE_BATCH_SIZE, en el pool si conviene."""
+    pool = get_parse_pool()
+    for start in range(0, len(raw_messages), PARSE_BATCH_SIZE):
+        batch = raw_messages[start:start + PARSE_BATCH_SIZE]
+        if pool is None or sum(len(raw) for raw in batch) < PARSE_OFFLOAD_MIN_BYTES:
+            position, value = parse_first(parse_function, batch)
+        else:
+            try:
+                position, value = pool.submit(parse_first, parse_function, batch).result()
+            except BrokenProcessPool:
+                logging.error("El pool de parseo se rompió; se recrea y este lote se parsea en el hilo")
+                _discard_parse_pool()
+                pool = get_parse_pool()
+                position, value = parse_first(parse_function, batch)
+            except (RuntimeError, FutureCancelledError):
+                # El pool se cerró (apagado) mientras esta búsqueda seguía.
+                pool = None
+                position, value = parse_first(parse_function, batch)
+        if value:
+            return start + position, value
+    return None, None
 
-            server.logout()
+def _search_service_email(service, requested_email, parse_function):
+    """
+    Busca en cada cuenta, del mensaje más nuevo al más viejo, el primero
+    dirigido a requested_email del que parse_function extraiga algo.
+    Retorna (valor, minutos_desde_recibido) o (None, None).
+    """
+    requested_at = _SCAN_REQUESTED_AT.get() or time.monotonic()
+    for (acc_email, acc_password) in CONFIG.email_accounts:
+        try:
+            with trace_span("cuenta", cuenta=acc_email) as span_attrs:
+                entries = refresh_mailbox_index(acc_email, acc_password, service, requested_at)
+                LOOKUP_STATS.record_account(acc_email, ok=True)
+                newest_first = entries[::-1]
+                candidates = [
+                    (scanned, entry) for scanned, entry in enumerate(newest_first, start=1)
+                    if requested_email in entry.recipients and entry.date is not None
+                ]
+                scanned = len(newest_first)
+                try:
+                    if not candidates:
+                        continue
+                    with lookup_stage("parse", acc_email, service):
+                        position, extracted_value = run_parse(parse_function, [entry.raw for _, entry in candidates])
+                    if extracted_value:
+                        scanned, entry = candidates[position]
+                        span_attrs["encontrado"] = True
+                        return extracted_value, _minutes_since(entry.date)
+                finally:
+                    span_attrs["revisados"] = scanned
+                    IMAP_MESSAGES_SCANNED.inc(acc_email, service, amount=scanned)
         except Exception as e:
-            logging.error(f"Error con la cuenta {acc_email} al buscar Disney+: {e}")
+            LOOKUP_STATS.record_account(acc_email, ok=False)
+            logging.error(f"Error con la cuenta {acc_email} al buscar {SERVICE_NAMES[service]}: {e}")
 
     return None, None
 
+# ---- PREFETCH ESPECULATIVO ----
+
+PREFETCH_MIN_INTERVAL = 10     # no repetir el prefetch de un servicio antes de esto (s)
+PREFETCH_WINDOW = 180          # un prefetch cuenta como acierto si se usa dentro de esto (s)
+PREFETCH_STATS = {"prefetches": 0, "hits": 0, "misses": 0, "saved_ms": 0.0}
+_prefetch_last_started = {}
+_prefetch_lock = threading.Lock()
+
+def _record_prefetch_result(index, elapsed_ms):
+    with _prefetch_lock:
+        prefetched_at = index.prefetched_at
+        if prefetched_at is not None and time.monotonic() - prefetched_at <= PREFETCH_WINDOW:
+            PREFETCH_STATS["hits"] += 1
+            PREFETCH_STATS["saved_ms"] += max(0.0, index.prefetch_ms - elapsed_ms)
+            index.prefetched_at = None
+            CACHE_REQUESTS.inc("prefetch", "hit")
+        else:
+            PREFETCH_STATS["misses"] += 1
+            CACHE_REQUESTS.inc("prefetch", "miss")
+
+def prefetch_service(service):
+    """Calienta conexiones y el índice de mensajes recientes de un servicio."""
+    for (acc_email, acc_password) in CONFIG.email_accounts:
+        try:
+            refresh_mailbox_index(acc_email, acc_password, service, purpose="prefetch")
+        except Exception as e:
+            logging.warning(f"Prefetch de {SERVICE_NAMES[service]} falló en {acc_email}: {e}")
+    with _prefetch_lock:
+        PREFETCH_STATS["prefetches"] += 1
+        hits, misses = PREFETCH_STATS["hits"], PREFETCH_STATS["misses"]
+    if hits + misses:
+        logging.debug(
+            f"Prefetch: aciertos {hits}/{hits + misses}, "
+            f"ahorro medio {PREFETCH_STATS['saved_ms'] / max(hits, 1):.0f} ms"
+        )
+
+def refresh_service_indexes(service):
+    """Refresca el índice del servicio en todas las cuentas (lo usa el poller de esperas)."""
+    for (acc_email, acc_password) in CONFIG.email_accounts:
+        try:
+            refresh_mailbox_index(acc_email, acc_password, service, purpose="watch")
+        except Exception as e:
+            logging.warning(f"No se pudo revisar {SERVICE_NAMES[service]} en {acc_email}: {e}")
+
+def user_may_prefetch(user_id, awaiting):
+    """Sólo prefetch para quien podría hacer la búsqueda: permiso y algún correo vigente."""
+    if is_admin(user_id):
+        return True
+    lookup = EMAIL_LOOKUPS[awaiting]
+    if lookup["permission"] and not lookup["permission"](user_id):
+        return False
+    return get_user_store().has_any_valid_access(user_id)
+
+def schedule_prefetch(user_id, awaiting):
+    """
+    Encola (con PRIORITY_BACKGROUND, detrás de las búsquedas) el prefetch del
+    servicio de la búsqueda que el usuario acaba de elegir, mientras escribe
+    su correo. Si la cola está llena no se hace.
+    """
+    service = EMAIL_LOOKUPS[awaiting]["service"]
+    now = time.monotonic()
+    if now - _prefetch_last_started.get(service, 0.0) < PREFETCH_MIN_INTERVAL:
+        return
+    if not user_may_prefetch(user_id, awaiting):
+        return
+    try:
+        job = LOOKUP_QUEUE.submit(PRIORITY_BACKGROUND, prefetch_service, (service,))
+    except LookupQueueFull:
+        return
+    _prefetch_last_started[service] = now
+    # Nadie espera el resultado: se consume para que no quede una excepción sin leer.
+    job.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+# ---- DISNEY ----
+def user_has_disney_code_permission(user_id: int) -> bool:
+    if is_admin(user_id):
+        return True
+
+    code_dict = get_permission_dict("disney")
+    if user_id not in code_dict:
+        return False
+
+    exp_date = code_dict[user_id]
+    if exp_date is None:
+        return True
+
+    today = datetime.now().date()
+    return today <= exp_date
+
+def _parse_html(content):
+    """bs4 se importa recién aquí: es la dependencia más lenta de cargar."""
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(content, "html.parser")
+
+def get_disney_code(requested_email: str):
+    return _search_service_email("disney", requested_email, extract_6_digit_code)
+
 def extract_6_digit_code(msg_obj):
     regex_6 = r'\b\d{6}\b'
     if msg_obj.is_multipart():
@@ -387,7 +1710,7 @@ def extract_6_digit_code(msg_obj):
             ctype = part.get_content_type()
             if ctype == "text/html":
                 html_content = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                text = BeautifulSoup(html_content, "html.parser").get_text()
+                text = _parse_html(html_content).get_text()
                 match = re.search(regex_6, text)
                 if match:
                     return match.group(0)
@@ -400,7 +1723,7 @@ def extract_6_digit_code(msg_obj):
         ctype = msg_obj.get_content_type()
         payload = msg_obj.get_payload(decode=True).decode('utf-8', errors='ignore')
         if ctype == "text/html":
-            text = BeautifulSoup(payload, "html.parser").get_text()
+            text = _parse_html(payload).get_text()
             match = re.search(regex_6, text)
             if match:
                 return match.group(0)
@@ -415,7 +1738,7 @@ def user_has_netflix_code_permission(user_id: int) -> bool:
     if is_admin(user_id):
         return True
 
-    code_dict = load_netflix_code_access()
+    code_dict = get_permission_dict("netflix")
     if user_id not in code_dict:
         return False
 
@@ -442,60 +1765,7 @@ def get_netflix_update_household_link(requested_email: str):
     return _search_netflix_email(requested_email, _parse_netflix_update_household_link)
 
 def _search_netflix_email(requested_email: str, parse_function):
-    socket.setdefaulttimeout(15)
-
-    for (acc_email, acc_password) in EMAIL_ACCOUNTS:
-        try:
-            server = imaplib.IMAP4_SSL(IMAP_HOST)
-            server.login(acc_email, acc_password)
-            server.select("INBOX")
-
-            status, messages = server.search(
-                None,
-                '(OR FROM "info@account.netflix.com" FROM "no-reply@netflix.com")'
-            )
-            if status != "OK" or not messages or not messages[0]:
-                server.logout()
-                continue
-
-            email_ids = messages[0].split()
-            if len(email_ids) > 50:
-                email_ids = email_ids[-50:]
-
-            for email_id in reversed(email_ids):
-                status_msg, msg_data = server.fetch(email_id, "(RFC822)")
-                if status_msg != "OK":
-                    continue
-
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg_obj = email.message_from_bytes(response_part[1])
-
-                        recipients = []
-                        for header_key, header_value in msg_obj.items():
-                            if header_key.lower() in ["to", "cc", "bcc", "delivered-to", "x-original-to"]:
-                                if header_value:
-                                    recipients.extend([addr.strip().lower() for addr in header_value.split(",")])
-
-                        if not any(recipient == requested_email for recipient in recipients):
-                            continue
-
-                        date_header = msg_obj["Date"]
-                        parsed_date = email.utils.parsedate_to_datetime(date_header).astimezone(timezone.utc)
-                        now = datetime.now(timezone.utc)
-                        diff = now - parsed_date
-                        total_minutes = int(diff.total_seconds() // 60)
-
-                        extracted_value = parse_function(msg_obj)
-                        if extracted_value:
-                            server.logout()
-                            return extracted_value, total_minutes
-
-            server.logout()
-        except Exception as e:
-            logging.error(f"Error con la cuenta {acc_email} al buscar Netflix: {e}")
-
-    return None, None
+    return _search_service_email("netflix", requested_email, parse_function)
 
 def _parse_netflix_link(msg_obj):
     if msg_obj.is_multipart():
@@ -516,7 +1786,7 @@ def _parse_netflix_link(msg_obj):
 
 def _find_reset_link_in_text(content, ctype):
     if ctype == "text/html":
-        soup = BeautifulSoup(content, "html.parser")
+        soup = _parse_html(content)
         link_tag = soup.find("a", string=re.compile(r"restablecer contraseña", re.IGNORECASE))
         if link_tag and link_tag.get("href"):
             return link_tag["href"]
@@ -536,7 +1806,7 @@ def _parse_netflix_code(msg_obj):
             ctype = part.get_content_type()
             if ctype == "text/html":
                 html_content = part.get_payload(decode=True).decode('utf-8', errors='ignore')
-                code = re.search(regex_4, BeautifulSoup(html_content, "html.parser").get_text())
+                code = re.search(regex_4, _parse_html(html_content).get_text())
                 if code:
                     return code.group(0)
             elif ctype == "text/plain":
@@ -548,7 +1818,7 @@ def _parse_netflix_code(msg_obj):
         ctype = msg_obj.get_content_type()
         text = msg_obj.get_payload(decode=True).decode('utf-8', errors='ignore')
         if ctype == "text/html":
-            code = re.search(regex_4, BeautifulSoup(text, "html.parser").get_text())
+            code = re.search(regex_4, _parse_html(text).get_text())
             if code:
                 return code.group(0)
         else:
@@ -625,7 +1895,7 @@ def user_has_max_link_permission(user_id: int) -> bool:
     if is_admin(user_id):
         return True
 
-    link_dict = load_max_link_access()
+    link_dict = get_permission_dict("max")
     if user_id not in link_dict:
         return False
 
@@ -640,60 +1910,7 @@ def get_max_reset_link(requested_email: str):
     return _search_max_email(requested_email, _parse_max_reset_link)
 
 def _search_max_email(requested_email: str, parse_function):
-    socket.setdefaulttimeout(15)
-
-    for (acc_email, acc_password) in EMAIL_ACCOUNTS:
-        try:
-            server = imaplib.IMAP4_SSL(IMAP_HOST)
-            server.login(acc_email, acc_password)
-            server.select("INBOX")
-
-            status, messages = server.search(
-                None,
-                '(FROM "no-reply@marketing.max.com")'
-            )
-            if status != "OK" or not messages or not messages[0]:
-                server.logout()
-                continue
-
-            email_ids = messages[0].split()
-            if len(email_ids) > 50:
-                email_ids = email_ids[-50:]
-
-            for email_id in reversed(email_ids):
-                status_msg, msg_data = server.fetch(email_id, "(RFC822)")
-                if status_msg != "OK":
-                    continue
-
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg_obj = email.message_from_bytes(response_part[1])
-
-                        recipients = []
-                        for header_key, header_value in msg_obj.items():
-                            if header_key.lower() in ["to", "cc", "bcc", "delivered-to", "x-original-to"]:
-                                if header_value:
-                                    recipients.extend([addr.strip().lower() for addr in header_value.split(",")])
-
-                        if not any(recipient == requested_email for recipient in recipients):
-                            continue
-
-                        date_header = msg_obj["Date"]
-                        parsed_date = email.utils.parsedate_to_datetime(date_header).astimezone(timezone.utc)
-                        now = datetime.now(timezone.utc)
-                        diff = now - parsed_date
-                        total_minutes = int(diff.total_seconds() // 60)
-
-                        extracted_link = parse_function(msg_obj)
-                        if extracted_link:
-                            server.logout()
-                            return extracted_link, total_minutes
-
-            server.logout()
-        except Exception as e:
-            logging.error(f"Error con la cuenta {acc_email} al buscar Max: {e}")
-
-    return None, None
+    return _search_service_email("max", requested_email, parse_function)
 
 def _parse_max_reset_link(msg_obj):
     max_link_regex = r'(https?://[^"\s]+marketing\.max\.com[^"\s]+)'
@@ -715,6 +1932,330 @@ def _parse_max_reset_link(msg_obj):
                 return match.group(1)
     return None
 
+# =============================================================================
+# LÍMITE DE BÚSQUEDAS (POR USUARIO Y GLOBAL)
+# =============================================================================
+
+LOOKUP_BUCKET_CAPACITY = 3         # búsquedas seguidas que se permiten
+LOOKUP_REFILL_PER_MINUTE = 6       # búsquedas por minuto a largo plazo
+LOOKUP_MAX_CONCURRENT = 8          # workers de búsqueda (búsquedas IMAP simultáneas)
+# Updates que se procesan a la vez (de usuarios distintos); ver PerUserOrderedUpdateProcessor.
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "32"))
+
+class LookupRateLimiter:
+    """
+    Token bucket por usuario. Sólo se guardan los buckets que no están
+    llenos, así la memoria es O(usuarios activos). Los límites se pueden
+    cambiar en caliente.
+    """
+    SWEEP_EVERY = 256
+
+    def __init__(self, capacity, refill_per_minute):
+        self._buckets = {}
+        self._calls = 0
+        self.configure(capacity, refill_per_minute)
+
+    def configure(self, capacity, refill_per_minute):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_minute / 60
+
+    def try_consume(self, user_id):
+        """Retorna 0 si se permite la búsqueda, o los segundos a esperar."""
+        now = time.monotonic()
+        self._calls += 1
+        if self._calls % self.SWEEP_EVERY == 0:
+            self._sweep(now)
+
+        tokens, updated = self._buckets.get(user_id, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - updated) * self.refill_per_second)
+        if tokens >= 1:
+            self._buckets[user_id] = (tokens - 1, now)
+            return 0
+        self._buckets[user_id] = (tokens, now)
+        return (1 - tokens) / self.refill_per_second
+
+    def _sweep(self, now):
+        full = [
+            user_id for user_id, (tokens, updated) in self._buckets.items()
+            if tokens + (now - updated) * self.refill_per_second >= self.capacity
+        ]
+        for user_id in full:
+            del self._buckets[user_id]
+
+LOOKUP_LIMITER = LookupRateLimiter(LOOKUP_BUCKET_CAPACITY, LOOKUP_REFILL_PER_MINUTE)
+
+# =============================================================================
+# COLA DE BÚSQUEDAS CON PRIORIDAD
+# =============================================================================
+
+# Cada búsqueda ocupa un cupo de update mientras espera en la cola, así que
+# la cola tiene que llenarse antes que los cupos (si no, con carga alta los
+# updates nuevos, /start y /cancel incluidos, esperan en silencio en el
+# semáforo) y dejar UPDATE_SLOTS_RESERVED libres para el resto de updates.
+UPDATE_SLOTS_RESERVED = 8
+
+def lookup_queue_capacity(workers):
+    """Búsquedas en espera antes de rechazar nuevas, para 'workers' en curso."""
+    return max(1, MAX_CONCURRENT_UPDATES - workers - UPDATE_SLOTS_RESERVED)
+
+LOOKUP_QUEUE_SIZE = lookup_queue_capacity(LOOKUP_MAX_CONCURRENT)
+LOOKUP_POSITION_INTERVAL = 2       # cada cuántos segundos se actualiza la posición
+LOOKUP_QUEUE_FULL_TEXT = (
+    "🚦 El bot está muy ocupado en este momento y no puede aceptar más búsquedas. "
+    "Intenta de nuevo en unos minutos."
+)
+
+PRIORITY_ADMIN = 0
+PRIORITY_SHORT_LIVED = 1           # códigos que caducan en pocos minutos
+PRIORITY_NORMAL = 2
+PRIORITY_BACKGROUND = 3            # prefetch y revisiones de las esperas de códigos
+
+class LookupQueueFull(Exception):
+    pass
+
+class LookupQueueClosed(LookupQueueFull):
+    """El bot se está apagando: la búsqueda no se aceptó o se canceló."""
+
+LOOKUP_SHUTDOWN_TEXT = (
+    "🔧 El bot se está reiniciando y no pudo completar tu búsqueda. "
+    "Intenta de nuevo en un minuto."
+)
+
+def lookup_priority(user_id, lookup):
+    if is_admin(user_id):
+        return PRIORITY_ADMIN
+    if lookup.get("short_lived"):
+        return PRIORITY_SHORT_LIVED
+    return PRIORITY_NORMAL
+
+class LookupJob:
+    __slots__ = ("priority", "sequence", "function", "args", "future", "status_message", "position",
+                 "context", "submitted_at")
+
+    def __init__(self, priority, sequence, function, args, future, status_message):
+        self.priority = priority
+        self.sequence = sequence
+        self.function = function
+        self.args = args
+        self.future = future
+        self.status_message = status_message
+        self.position = 0
+        # Contexto de quien encoló (traza, marca de escaneo) para el hilo de la búsqueda.
+        self.context = contextvars.copy_context()
+        self.submitted_at = time.perf_counter()
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+class LookupQueue:
+    """
+    Cola acotada con prioridad (admins, luego códigos de vida corta, luego
+    el resto; FIFO dentro de cada prioridad) atendida por un número fijo de
+    workers, que es el límite global de búsquedas IMAP simultáneas. Los que
+    esperan ven su posición en el mensaje "🔄 Buscando", editado en el lugar.
+    """
+
+    def __init__(self, maxsize, workers):
+        self.maxsize = maxsize
+        self.target_workers = workers
+        self._queue = None
+        self._pending = set()
+        self._sequence = 0
+        self._workers = set()
+        self._idle = set()
+        self._reporter = None
+        self._active = 0
+        self._running = set()
+        self.closed = False
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def queued(self):
+        return len(self._pending)
+
+    def start(self):
+        self._queue = asyncio.PriorityQueue()
+        self.resize(self.target_workers)
+        self._reporter = asyncio.create_task(self._report_positions())
+
+    async def stop(self):
+        tasks = list(self._workers) + ([self._reporter] if self._reporter else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers.clear()
+        self._idle.clear()
+        self._reporter = None
+
+    def resize(self, workers):
+        """
+        Cambia la cantidad de workers (los que sobran terminan al quedar
+        libres) y con ella la capacidad de la cola.
+        """
+        self.target_workers = workers
+        self.maxsize = lookup_queue_capacity(workers)
+        if self._queue is None:
+            return
+        while len(self._workers) < workers:
+            task = asyncio.create_task(self._worker())
+            self._workers.add(task)
+        excess = len(self._workers) - workers
+        for task in list(self._idle)[:max(0, excess)]:
+            task.cancel()
+            self._idle.discard(task)
+            self._workers.discard(task)
+
+    def submit(self, priority, function, args, status_message=None):
+        if self.closed:
+            raise LookupQueueClosed()
+        if self._queue is None:
+            self.start()
+        self._sequence += 1
+        job = LookupJob(priority, self._sequence, function, args,
+                        asyncio.get_running_loop().create_future(), status_message)
+        if len(self._pending) >= self.maxsize:
+            raise LookupQueueFull()
+        self._queue.put_nowait(job)
+        self._pending.add(job)
+        return job
+
+    def position(self, job):
+        return 1 + sum(1 for other in self._pending if other < job)
+
+    def close(self):
+        """No acepta búsquedas nuevas; las encoladas y en curso siguen."""
+        self.closed = True
+
+    async def drain(self, timeout):
+        """Espera hasta 'timeout' s a que se vacíe; retorna cuántas quedan."""
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._running) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        return len(self._pending) + len(self._running)
+
+    def cancel_all(self):
+        """Falla con LookupQueueClosed cada búsqueda encolada o en curso."""
+        jobs = list(self._pending) + list(self._running)
+        for job in jobs:
+            if not job.future.done():
+                job.future.set_exception(LookupQueueClosed())
+        return len(jobs)
+
+    async def _worker(self):
+        task = asyncio.current_task()
+        while True:
+            self._idle.add(task)
+            job = await self._queue.get()
+            self._idle.discard(task)
+            self._pending.discard(job)
+            if job.future.done():
+                continue
+            self._active += 1
+            self._running.add(job)
+            job.context.run(record_span, "cola", job.submitted_at, time.perf_counter(), posicion=job.position)
+            try:
+                result = await asyncio.to_thread(job.context.run, job.function, *job.args)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self._active -= 1
+                self._running.discard(job)
+            if len(self._workers) > self.target_workers:
+                self._workers.discard(task)
+                return
+
+    async def _report_positions(self):
+        while True:
+            await asyncio.sleep(LOOKUP_POSITION_INTERVAL)
+            updates = []
+            for job in list(self._pending):
+                position = self.position(job)
+                if position != job.position and job.status_message is not None:
+                    job.position = position
+                    updates.append(_show_queue_position(job.status_message, position))
+            if updates:
+                await asyncio.gather(*updates)
+
+async def _show_queue_position(status_message, position):
+    try:
+        await status_message.edit_text(
+            f"🕐 Hay mucha demanda. Estás en la posición {position} de la cola, por favor espera..."
+        )
+    except TelegramError as e:
+        count_telegram_failure("editMessageText", e)
+
+LOOKUP_QUEUE = LookupQueue(LOOKUP_QUEUE_SIZE, LOOKUP_MAX_CONCURRENT)
+
+CallbackGauge(
+    "bot_lookup_queue_jobs", "Búsquedas en curso y en espera en la cola.",
+    lambda: {("active",): LOOKUP_QUEUE.active, ("queued",): LOOKUP_QUEUE.queued}, ("state",)
+)
+
+async def run_lookup(lookup_function, requested_email, status_message=None, priority=PRIORITY_NORMAL):
+    """
+    Encola una búsqueda IMAP (se ejecuta en un hilo) y espera el resultado.
+    Lanza LookupQueueFull si la cola está llena.
+    """
+    return await _run_lookup_job(lookup_function, (requested_email,), status_message, priority)
+
+async def _run_lookup_job(function, args, status_message, priority):
+    job = LOOKUP_QUEUE.submit(priority, function, args, status_message)
+    # Si hay un worker libre la toma en este mismo ciclo; si no, mostrar la posición.
+    await asyncio.sleep(0)
+    if job in LOOKUP_QUEUE._pending and status_message is not None:
+        job.position = LOOKUP_QUEUE.position(job)
+        await _show_queue_position(status_message, job.position)
+    try:
+        return await job.future
+    finally:
+        if not job.future.done():
+            job.future.cancel()
+
+# ---- BÚSQUEDAS EN LOTE ----
+
+BATCH_MAX_EMAILS = 15              # correos por mensaje (el resultado debe caber en un mensaje)
+BATCH_MAX_PARALLEL = 8             # búsquedas simultáneas dentro de un lote
+
+def lookup_batch(lookup_function, requested_emails, on_result):
+    """
+    Ejecuta lookup_function para varios correos en paralelo. Todas comparten
+    la misma marca de inicio, así el primer hilo que llega a cada buzón hace
+    el escaneo y el resto lo reutiliza. on_result(correo, resultado) se llama
+    al terminar cada una; resultado es (valor, minutos) o la excepción.
+    """
+    _SCAN_REQUESTED_AT.set(time.monotonic())
+    with ThreadPoolExecutor(max_workers=min(len(requested_emails), BATCH_MAX_PARALLEL)) as pool:
+        futures = {
+            pool.submit(contextvars.copy_context().run, lookup_function, requested_email): requested_email
+            for requested_email in requested_emails
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            on_result(futures[future], result)
+
+async def run_lookup_batch(lookup_function, requested_emails, on_result, status_message=None,
+                           priority=PRIORITY_NORMAL):
+    """
+    Encola un lote de búsquedas como un solo trabajo (ocupa un worker).
+    on_result se invoca en el event loop a medida que llega cada resultado.
+    """
+    loop = asyncio.get_running_loop()
+
+    def notify(requested_email, result):
+        loop.call_soon_threadsafe(on_result, requested_email, result)
+
+    await _run_lookup_job(lookup_batch, (lookup_function, requested_emails, notify), status_message, priority)
+
 # =============================================================================
 # 6. ESCAPAR TEXTO PARA MARKDOWN
 # =============================================================================
@@ -767,6 +2308,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
         context.user_data['awaiting_email_for'] = 'disney'
+        schedule_prefetch(user_id, 'disney')
 
     elif query.data == "submenu_netflix":
         user_log(user_id, "Seleccionó Netflix (submenú)")
@@ -800,6 +2342,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
         context.user_data['awaiting_email_for'] = 'netflix_reset_link'
+        schedule_prefetch(user_id, 'netflix_reset_link')
 
     elif query.data == "netflix_access_code":
         user_log(user_id, "Netflix => Código Único (4 díg.)")
@@ -817,6 +2360,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
         context.user_data['awaiting_email_for'] = 'netflix_access_code'
+        schedule_prefetch(user_id, 'netflix_access_code')
 
     elif query.data == "netflix_country_info":
         user_log(user_id, "Netflix => País/Idioma (no requiere permiso)")
@@ -827,6 +2371,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
         context.user_data['awaiting_email_for'] = 'netflix_country_info'
+        schedule_prefetch(user_id, 'netflix_country_info')
 
     elif query.data == "netflix_temporary_access":
         user_log(user_id, "Netflix => Enlace de Acceso Temporal (no requiere permiso)")
@@ -837,6 +2382,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
         context.user_data['awaiting_email_for'] = 'netflix_temporary_access'
+        schedule_prefetch(user_id, 'netflix_temporary_access')
 
     elif query.data == "netflix_update_household":
         user_log(user_id, "Netflix => Enlace Actualiza Hogar (no requiere permiso)")
@@ -847,6 +2393,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
         context.user_data['awaiting_email_for'] = 'netflix_update_household'
+        schedule_prefetch(user_id, 'netflix_update_household')
 
     elif query.data == "submenu_max":
         user_log(user_id, "Seleccionó Max (submenú)")
@@ -876,6 +2423,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
         context.user_data['awaiting_email_for'] = 'max_reset_link'
+        schedule_prefetch(user_id, 'max_reset_link')
 
     elif query.data == "info_user":
         user_log(user_id, "Info user")
@@ -901,7 +2449,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Permisos Disney
         if user_has_disney_code_permission(user_id):
-            disney_dict = load_disney_code_access()
+            disney_dict = get_permission_dict("disney")
             if user_id in disney_dict:
                 exp_date = disney_dict[user_id]
                 if exp_date is None:
@@ -919,7 +2467,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Permisos Netflix
         if user_has_netflix_code_permission(user_id):
-            netflix_dict = load_netflix_code_access()
+            netflix_dict = get_permission_dict("netflix")
             if user_id in netflix_dict:
                 exp_date = netflix_dict[user_id]
                 if exp_date is None:
@@ -937,7 +2485,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Permisos Max
         if user_has_max_link_permission(user_id):
-            link_dict = load_max_link_access()
+            link_dict = get_permission_dict("max")
             if user_id in link_dict:
                 exp_date = link_dict[user_id]
                 if exp_date is None:
@@ -964,7 +2512,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = [[InlineKeyboardButton("Volver ↩️", callback_data="volver_menu")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(
-            text=HELP_TEXT,
+            text=help_text(),
             parse_mode="Markdown",
             reply_markup=reply_markup
         )
@@ -993,159 +2541,394 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         context.user_data['awaiting_email_for'] = None
 
+# Cómo se resuelve cada búsqueda de email_input, según 'awaiting_email_for'.
+# En los textos, {value} es el resultado (escapado para Markdown en found_text);
+# para país/idioma también están {lang} y {country}.
+EMAIL_LOOKUPS = {
+    "disney": {
+        "lookup": get_disney_code,
+        "service": "disney",
+        "permission": user_has_disney_code_permission,
+        "denied_log": "Denegado. No tiene code access para Disney",
+        "denied_text": "❌ No tienes permiso para extraer códigos de Disney+. Contacta a un administrador.",
+        "short_lived": True,
+        "found_log": "Código Disney: {value}",
+        "found_text": "✅ Tu código Disney+ es:\n`{value}`\n\n⌛ Recibido hace {minutes} minutos.",
+        "not_found_text": "⚠️ No se encontró un código reciente de Disney+",
+    },
+    "netflix_reset_link": {
+        "lookup": get_netflix_reset_link,
+        "service": "netflix",
+        "permission": user_has_netflix_code_permission,
+        "denied_log": "Denegado. No tiene code access para Netflix (reset link)",
+        "denied_text": "❌ No tienes permiso para extraer códigos o links de Netflix.",
+        "short_lived": False,
+        "found_log": "Link Netflix: {value}",
+        "found_text": "🔗 Link de restablecimiento:\n`{value}`\n\n⌛ Recibido hace {minutes} minutos.",
+        "not_found_text": "⚠️ No se encontró un link reciente de Netflix",
+    },
+    "netflix_access_code": {
+        "lookup": get_netflix_access_code,
+        "service": "netflix",
+        "permission": user_has_netflix_code_permission,
+        "denied_log": "Denegado. No tiene code access para Netflix code (4 díg).",
+        "denied_text": "❌ No tienes permiso para extraer códigos de Netflix.",
+        "short_lived": True,
+        "found_log": "Código Netflix 4 díg.: {value}",
+        "found_text": "✅ Código de acceso (4 díg.):\n`{value}`\n\n⌛ Recibido hace {minutes} minutos.",
+        "not_found_text": "⚠️ No se encontró ningún código reciente de Netflix",
+    },
+    "netflix_country_info": {
+        "lookup": get_netflix_country_info,
+        "service": "netflix",
+        "permission": None,
+        "short_lived": False,
+        "found_log": "País/Idioma Netflix: {lang}, {country}",
+        "found_text": "🌎 País: `{country}`\n💬 Idioma: `{lang}`\n⌛ Info extraída hace {minutes} minutos.",
+        "not_found_text": "⚠️ No se encontró país/idioma en el correo de Netflix.",
+    },
+    "netflix_temporary_access": {
+        "lookup": get_netflix_temporary_access_link,
+        "service": "netflix",
+        "permission": None,
+        "short_lived": True,
+        "found_log": "Link Netflix (Acceso Temporal): {value}",
+        "found_text": "🔗 Aquí tienes tu enlace de acceso temporal:\n`{value}`\n\n⌛ Recibido hace {minutes} minutos.",
+        "not_found_text": "⚠️ No se encontró ningún enlace de acceso temporal en tu correo de Netflix.",
+    },
+    "netflix_update_household": {
+        "lookup": get_netflix_update_household_link,
+        "service": "netflix",
+        "permission": None,
+        "short_lived": False,
+        "found_log": "Link Netflix (Actualizar Hogar): {value}",
+        "found_text": "🔗 Aquí tienes tu enlace de 'Actualizar Hogar':\n`{value}`\n\n⌛ Recibido hace {minutes} minutos.",
+        "not_found_text": "⚠️ No se encontró ningún enlace de 'Actualizar Hogar' en tu correo de Netflix.",
+    },
+    "max_reset_link": {
+        "lookup": get_max_reset_link,
+        "service": "max",
+        "permission": user_has_max_link_permission,
+        "denied_log": "Denegado. No tiene acceso para extraer link de Max",
+        "denied_text": "❌ No tienes permiso para extraer enlaces de Max.",
+        "short_lived": False,
+        "found_log": "Link Max: {value}",
+        "found_text": "🔗 Link de restablecimiento Max:\n`{value}`\n\n⌛ Recibido hace {minutes} minutos.",
+        "not_found_text": "⚠️ No se encontró un link reciente de Max.",
+    },
+}
+
+def _format_lookup_result(template, value, minutes, escape):
+    if isinstance(value, tuple):
+        lang, country = value
+        fields = {"lang": lang or "", "country": country or ""}
+    else:
+        fields = {"value": value}
+    if escape:
+        fields = {key: escape_markdown(field) for key, field in fields.items()}
+    return template.format(minutes=minutes, **fields)
+
+LOOKUP_STATUS_DELAY = 1.0          # s antes de mostrar "Buscando" si no hay resultado
+TYPING_REFRESH_INTERVAL = 4.0      # s entre acciones "escribiendo" mientras se busca
+
+# Llamadas a la API de Telegram hechas por las búsquedas (kind="calls") y
+# búsquedas terminadas (kind="lookups"); el cociente de sus rate() da las
+# llamadas por búsqueda.
+TELEGRAM_API_CALLS = Counter(
+    "bot_telegram_calls_total", "Búsquedas terminadas y llamadas a Telegram que usaron.", ("kind",)
+)
+
+class LookupReply:
+    """
+    Mensaje único de una búsqueda: se envía recién cuando hay algo que
+    mostrar (demora, posición en la cola o resultado) y luego se edita en el
+    lugar. Cuenta las llamadas a la API de Telegram que hace.
+    """
+
+    def __init__(self, request_message):
+        self.request_message = request_message
+        self.message = None
+        self.api_calls = 0
+        self._lock = asyncio.Lock()
+
+    async def typing(self):
+        self.api_calls += 1
+        try:
+            with trace_span("telegram.sendChatAction"):
+                await self.request_message.chat.send_action(ChatAction.TYPING)
+        except TelegramError as e:
+            count_telegram_failure("sendChatAction", e)
+
+    async def keep_typing(self):
+        """Repite la acción 'escribiendo' (Telegram la borra a los ~5 s) hasta que se cancele."""
+        while True:
+            await self.typing()
+            await asyncio.sleep(TYPING_REFRESH_INTERVAL)
+
+    async def show(self, text, if_empty=False, **kwargs):
+        async with self._lock:
+            if self.message is not None and if_empty:
+                return
+            with trace_span("telegram.mensaje"):
+                await self._send_or_edit(text, **kwargs)
+
+    async def _send_or_edit(self, text, **kwargs):
+        self.api_calls += 1
+        if self.message is None:
+            self.message = await self.request_message.reply_text(text, **kwargs)
+            return
+        try:
+            await self.message.edit_text(text, **kwargs)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            count_telegram_failure("editMessageText", e)
+            # El mensaje ya no se puede editar (p. ej. lo borraron): enviar uno nuevo.
+            self.api_calls += 1
+            self.message = await self.request_message.reply_text(text, **kwargs)
+
+    async def edit_text(self, text, **kwargs):
+        # Interfaz de un Message para LookupQueue (posición en la cola).
+        await self.show(text, **kwargs)
+
+    def count_lookup(self):
+        TELEGRAM_API_CALLS.inc("lookups")
+        TELEGRAM_API_CALLS.inc("calls", amount=self.api_calls)
+
+def _split_requested_emails(text):
+    """Correos separados por saltos de línea o comas, en minúsculas y sin repetidos."""
+    requested_emails = []
+    for part in re.split(r"[,\n]+", text):
+        part = part.strip().lower()
+        if part and part not in requested_emails:
+            requested_emails.append(part)
+    return requested_emails
+
 async def email_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    requested_email = update.message.text.strip()
     awaiting = context.user_data.get('awaiting_email_for', None)
-
     if not awaiting:
         return
 
+    # Cada búsqueda lleva una traza (ver /explain); su id queda en el log de auditoría.
+    with start_trace("email_input", usuario=update.effective_user.id, servicio=awaiting):
+        requested_emails = _split_requested_emails(update.message.text)
+        if len(requested_emails) > 1:
+            await email_batch_input(update, context, awaiting, requested_emails)
+        elif requested_emails:
+            await email_single_input(update, context, awaiting, requested_emails[0])
+        else:
+            await update.message.reply_text("❌ El formato del correo es incorrecto.")
+
+async def email_single_input(update, context, awaiting, requested_email):
+    user_id = update.effective_user.id
+
     if "@" not in requested_email:
         await update.message.reply_text("❌ El formato del correo es incorrecto.")
         return
 
     requested_email = requested_email.lower().strip()
-    user_log(user_id, f"Ingresó correo '{requested_email}' para {awaiting}")
+    log_fields = {"service": awaiting, "email": requested_email, "trace_id": current_trace_id()}
+    user_log(user_id, f"Ingresó correo '{requested_email}' para {awaiting}", **log_fields)
     context.user_data['awaiting_email_for'] = None
 
     if not user_has_valid_access(user_id, requested_email):
-        user_log(user_id, "Acceso denegado o expirado al correo")
+        user_log(user_id, "Acceso denegado o expirado al correo", **log_fields, outcome="denegado")
         await update.message.reply_text(
             "❌ No tienes permiso (o expiró tu acceso) para ese correo."
         )
         return
 
-    await update.message.reply_text("🔄 Buscando, por favor espera...")
+    lookup = EMAIL_LOOKUPS.get(awaiting)
+    if lookup is None:
+        return
+
+    if lookup["permission"] and not lookup["permission"](user_id):
+        user_log(user_id, lookup["denied_log"], **log_fields, outcome="denegado")
+        await update.message.reply_text(lookup["denied_text"])
+        return
 
-    # DISNEY
-    if awaiting == "disney":
-        if not user_has_disney_code_permission(user_id):
-            user_log(user_id, "Denegado. No tiene code access para Disney")
+    # Sólo consume un token la búsqueda que de verdad se va a hacer.
+    if not is_admin(user_id):
+        wait_seconds = LOOKUP_LIMITER.try_consume(user_id)
+        if wait_seconds:
+            user_log(user_id, "Búsqueda limitada por exceso de solicitudes", **log_fields, outcome="limitado")
             await update.message.reply_text(
-                "❌ No tienes permiso para extraer códigos de Disney+. Contacta a un administrador."
+                f"⏳ Hiciste demasiadas búsquedas seguidas. Intenta de nuevo en {int(wait_seconds) + 1} s."
             )
             return
 
-        code, minutes = get_disney_code(requested_email)
-        if code:
-            user_log(user_id, f"Código Disney: {code}")
-            code_esc = escape_markdown(code)
-            await update.message.reply_text(
-                f"✅ Tu código Disney+ es:\n`{code_esc}`\n\n"
-                f"⌛ Recibido hace {minutes} minutos.",
-                parse_mode="Markdown"
-            )
-        else:
-            await update.message.reply_text("⚠️ No se encontró un código reciente de Disney+")
+    reply = LookupReply(update.message)
+    typing = asyncio.create_task(reply.keep_typing())
+    lookup_start = time.perf_counter()
+    try:
+        try:
+            with trace_span("busqueda", correo=requested_email):
+                lookup_task = asyncio.ensure_future(
+                    run_lookup(lookup["lookup"], requested_email, reply, lookup_priority(user_id, lookup))
+                )
+                # Si la búsqueda es rápida (índice ya caliente) no hace falta el "Buscando".
+                done, _ = await asyncio.wait({lookup_task}, timeout=LOOKUP_STATUS_DELAY)
+                if not done:
+                    await reply.show("🔄 Buscando, por favor espera...", if_empty=True)
+                value, minutes = await lookup_task
+        finally:
+            # Se deja de "escribir" antes de mostrar el resultado.
+            typing.cancel()
+    except LookupQueueClosed:
+        user_log(user_id, "Búsqueda cancelada: el bot se está apagando", **log_fields, outcome="cancelado")
+        await reply.show(LOOKUP_SHUTDOWN_TEXT)
+        reply.count_lookup()
+        return
+    except LookupQueueFull:
+        user_log(user_id, "Búsqueda rechazada: cola llena", **log_fields, outcome="rechazado")
+        await reply.show(LOOKUP_QUEUE_FULL_TEXT)
+        reply.count_lookup()
+        return
+    except asyncio.CancelledError:
+        lookup_task.cancel()
+        raise
 
-    # NETFLIX
-    elif awaiting == "netflix_reset_link":
-        if not user_has_netflix_code_permission(user_id):
-            user_log(user_id, "Denegado. No tiene code access para Netflix (reset link)")
-            await update.message.reply_text(
-                "❌ No tienes permiso para extraer códigos o links de Netflix."
-            )
-            return
+    if value:
+        await reply.show(
+            _format_lookup_result(lookup["found_text"], value, minutes, escape=True),
+            parse_mode="Markdown"
+        )
+        user_log(user_id, _format_lookup_result(lookup["found_log"], value, minutes, escape=False),
+                 **log_fields, outcome="ok", latency_ms=_elapsed_ms(lookup_start), telegram_calls=reply.api_calls)
+    else:
+        await reply.show(lookup["not_found_text"], reply_markup=wait_keyboard())
+        remember_wait_request(context.user_data, reply.message, awaiting, requested_email)
+        user_log(user_id, "Sin resultados", **log_fields, outcome="no_encontrado",
+                 latency_ms=_elapsed_ms(lookup_start), telegram_calls=reply.api_calls)
+    reply.count_lookup()
 
-        link, minutes = get_netflix_reset_link(requested_email)
-        if link:
-            link_esc = escape_markdown(link)
-            user_log(user_id, f"Link Netflix: {link}")
-            await update.message.reply_text(
-                f"🔗 Link de restablecimiento:\n`{link_esc}`\n\n"
-                f"⌛ Recibido hace {minutes} minutos.",
-                parse_mode="Markdown"
-            )
-        else:
-            await update.message.reply_text("⚠️ No se encontró un link reciente de Netflix")
+BATCH_EDIT_INTERVAL = 1.0         # mínimo entre ediciones del mensaje combinado (s)
 
-    elif awaiting == "netflix_access_code":
-        if not user_has_netflix_code_permission(user_id):
-            user_log(user_id, "Denegado. No tiene code access para Netflix code (4 díg).")
-            await update.message.reply_text(
-                "❌ No tienes permiso para extraer códigos de Netflix."
-            )
-            return
+def _batch_block(requested_email, text):
+    return f"📧 *{escape_markdown(requested_email)}*\n{text}"
 
-        code, minutes = get_netflix_access_code(requested_email)
-        if code:
-            user_log(user_id, f"Código Netflix 4 díg.: {code}")
-            code_esc = escape_markdown(code)
-            await update.message.reply_text(
-                f"✅ Código de acceso (4 díg.):\n`{code_esc}`\n\n"
-                f"⌛ Recibido hace {minutes} minutos.",
-                parse_mode="Markdown"
-            )
-        else:
-            await update.message.reply_text("⚠️ No se encontró ningún código reciente de Netflix")
-
-    elif awaiting == "netflix_country_info":
-        info, minutes = get_netflix_country_info(requested_email)
-        if info:
-            lang, country = info
-            lang_esc = escape_markdown(lang if lang else "")
-            country_esc = escape_markdown(country if country else "")
-            user_log(user_id, f"País/Idioma Netflix: {lang}, {country}")
-            await update.message.reply_text(
-                f"🌎 País: `{country_esc}`\n"
-                f"💬 Idioma: `{lang_esc}`\n"
-                f"⌛ Info extraída hace {minutes} minutos.",
-                parse_mode="Markdown"
-            )
-        else:
-            await update.message.reply_text("⚠️ No se encontró país/idioma en el correo de Netflix.")
+async def email_batch_input(update, context, awaiting, requested_emails):
+    """
+    Varios correos en un mensaje: cada uno pasa su propio control de acceso,
+    las búsquedas corren en paralelo como un solo trabajo de la cola y los
+    resultados se van mostrando en un único mensaje a medida que llegan.
+    """
+    user_id = update.effective_user.id
+    context.user_data['awaiting_email_for'] = None
 
-    elif awaiting == "netflix_temporary_access":
-        link, minutes = get_netflix_temporary_access_link(requested_email)
-        if link:
-            link_esc = escape_markdown(link)
-            user_log(user_id, f"Link Netflix (Acceso Temporal): {link}")
-            await update.message.reply_text(
-                f"🔗 Aquí tienes tu enlace de acceso temporal:\n`{link_esc}`\n\n"
-                f"⌛ Recibido hace {minutes} minutos.",
-                parse_mode="Markdown"
-            )
-        else:
-            await update.message.reply_text(
-                "⚠️ No se encontró ningún enlace de acceso temporal en tu correo de Netflix."
-            )
+    if len(requested_emails) > BATCH_MAX_EMAILS:
+        await update.message.reply_text(
+            f"❌ Puedes consultar hasta {BATCH_MAX_EMAILS} correos por mensaje."
+        )
+        return
 
-    elif awaiting == "netflix_update_household":
-        link, minutes = get_netflix_update_household_link(requested_email)
-        if link:
-            link_esc = escape_markdown(link)
-            user_log(user_id, f"Link Netflix (Actualizar Hogar): {link}")
-            await update.message.reply_text(
-                f"🔗 Aquí tienes tu enlace de 'Actualizar Hogar':\n`{link_esc}`\n\n"
-                f"⌛ Recibido hace {minutes} minutos.",
-                parse_mode="Markdown"
-            )
+    lookup = EMAIL_LOOKUPS.get(awaiting)
+    if lookup is None:
+        return
+
+    user_log(user_id, f"Ingresó {len(requested_emails)} correos para {awaiting}",
+             service=awaiting, emails=requested_emails)
+
+    blocks = {}
+    to_search = []
+    for requested_email in requested_emails:
+        log_fields = {"service": awaiting, "email": requested_email}
+        if "@" not in requested_email:
+            blocks[requested_email] = "❌ El formato del correo es incorrecto."
+        elif not user_has_valid_access(user_id, requested_email):
+            user_log(user_id, "Acceso denegado o expirado al correo", **log_fields, outcome="denegado")
+            blocks[requested_email] = "❌ No tienes permiso (o expiró tu acceso) para ese correo."
         else:
-            await update.message.reply_text(
-                "⚠️ No se encontró ningún enlace de 'Actualizar Hogar' en tu correo de Netflix."
-            )
+            blocks[requested_email] = "🔄 Buscando..."
+            to_search.append(requested_email)
 
-    # MAX
-    elif awaiting == "max_reset_link":
-        if not user_has_max_link_permission(user_id):
-            user_log(user_id, "Denegado. No tiene acceso para extraer link de Max")
+    def render():
+        return "\n\n".join(_batch_block(e, blocks[e]) for e in requested_emails)
+
+    if not to_search:
+        await update.message.reply_text(render(), parse_mode="Markdown")
+        return
+
+    if lookup["permission"] and not lookup["permission"](user_id):
+        user_log(user_id, lookup["denied_log"], service=awaiting, outcome="denegado")
+        await update.message.reply_text(lookup["denied_text"])
+        return
+
+    # Un lote comparte un escaneo de cada buzón: consume un solo token.
+    if not is_admin(user_id):
+        wait_seconds = LOOKUP_LIMITER.try_consume(user_id)
+        if wait_seconds:
+            user_log(user_id, "Búsqueda limitada por exceso de solicitudes", service=awaiting, outcome="limitado")
             await update.message.reply_text(
-                "❌ No tienes permiso para extraer enlaces de Max."
+                f"⏳ Hiciste demasiadas búsquedas seguidas. Intenta de nuevo en {int(wait_seconds) + 1} s."
             )
             return
 
-        link, minutes = get_max_reset_link(requested_email)
-        if link:
-            link_esc = escape_markdown(link)
-            user_log(user_id, f"Link Max: {link}")
-            await update.message.reply_text(
-                f"🔗 Link de restablecimiento Max:\n`{link_esc}`\n\n"
-                f"⌛ Recibido hace {minutes} minutos.",
-                parse_mode="Markdown"
-            )
+    status_message = LookupReply(update.message)
+    await status_message.show(render(), parse_mode="Markdown")
+    lookup_start = time.perf_counter()
+    trace_id = current_trace_id()
+    changed = asyncio.Event()
+    shown = {"text": render()}
+
+    def on_result(requested_email, result):
+        log_fields = {"service": awaiting, "email": requested_email, "latency_ms": _elapsed_ms(lookup_start),
+                      "trace_id": trace_id}
+        if isinstance(result, Exception):
+            logging.error(f"Error buscando {requested_email} para {awaiting}: {result}")
+            result = (None, None)
+        value, minutes = result
+        if value:
+            user_log(user_id, _format_lookup_result(lookup["found_log"], value, minutes, escape=False),
+                     **log_fields, outcome="ok")
+            blocks[requested_email] = _format_lookup_result(lookup["found_text"], value, minutes, escape=True)
         else:
-            await update.message.reply_text("⚠️ No se encontró un link reciente de Max.")
+            user_log(user_id, "Sin resultados", **log_fields, outcome="no_encontrado")
+            blocks[requested_email] = lookup["not_found_text"]
+        changed.set()
+
+    async def show_progress():
+        while True:
+            await changed.wait()
+            changed.clear()
+            text = render()
+            if text != shown["text"]:
+                shown["text"] = text
+                try:
+                    await status_message.edit_text(text, parse_mode="Markdown")
+                except RetryAfter as e:
+                    count_telegram_failure("editMessageText", e)
+                    await asyncio.sleep(_retry_after_seconds(e.retry_after))
+                    changed.set()
+                    continue
+                except TelegramError as e:
+                    count_telegram_failure("editMessageText", e)
+            await asyncio.sleep(BATCH_EDIT_INTERVAL)
+
+    progress = asyncio.create_task(show_progress())
+    try:
+        await run_lookup_batch(lookup["lookup"], to_search, on_result, status_message,
+                               lookup_priority(user_id, lookup))
+    except LookupQueueClosed:
+        user_log(user_id, "Búsqueda cancelada: el bot se está apagando", service=awaiting, outcome="cancelado")
+        await status_message.show(LOOKUP_SHUTDOWN_TEXT)
+        status_message.count_lookup()
+        return
+    except LookupQueueFull:
+        user_log(user_id, "Búsqueda rechazada: cola llena", service=awaiting, outcome="rechazado")
+        await status_message.show(LOOKUP_QUEUE_FULL_TEXT)
+        status_message.count_lookup()
+        return
+    finally:
+        progress.cancel()
+        await asyncio.gather(progress, return_exceptions=True)
+
+    if render() != shown["text"]:
+        try:
+            await status_message.show(render(), parse_mode="Markdown")
+        except TelegramError as e:
+            count_telegram_failure("editMessageText", e)
+    status_message.count_lookup()
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -1197,10 +2980,426 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await update.message.reply_text("No hay ninguna operación activa que cancelar.")
 
+# =============================================================================
+# ESPERA DE CÓDIGOS ("AVÍSAME CUANDO LLEGUE")
+# =============================================================================
+
+WAIT_MINUTES_OPTIONS = (5, 15)
+WAIT_POLL_INTERVAL = 10            # segundos entre revisiones de los buzones con esperas
+WAIT_MAX_PER_USER = 3
+WAIT_REQUESTS_KEPT = 10            # mensajes "sin resultados" recientes cuyo botón sigue sirviendo
+
+def wait_keyboard():
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"⏳ Esperar {minutes} min", callback_data=f"wait:{minutes}")
+        for minutes in WAIT_MINUTES_OPTIONS
+    ]])
+
+def remember_wait_request(user_data, message, awaiting, requested_email):
+    """
+    Guarda qué búsqueda mostró cada mensaje "sin resultados" (por message_id,
+    el correo no entra en los 64 bytes del callback_data), así el botón de
+    esperar de un mensaje viejo espera lo que ese mensaje buscó.
+    """
+    if message is None:
+        return
+    requests = user_data.setdefault('wait_requests', {})
+    requests[message.message_id] = (awaiting, requested_email)
+    while len(requests) > WAIT_REQUESTS_KEPT:
+        del requests[next(iter(requests))]
+
+class CodeWatch:
+    __slots__ = ("user_id", "chat_id", "awaiting", "email", "minutes", "expires_at")
+
+    def __init__(self, user_id, chat_id, awaiting, requested_email, minutes):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.awaiting = awaiting
+        self.email = requested_email
+        self.minutes = minutes
+        self.expires_at = time.monotonic() + minutes * 60
+
+class CodeWatchRegistry:
+    """
+    Esperas activas por (servicio, correo). Un único poller refresca los
+    buzones de los servicios con esperas; además cualquier refresh del
+    índice (búsquedas de otros usuarios, prefetch) avisa de los mensajes
+    nuevos, y sólo entonces se vuelve a buscar para los correos afectados,
+    reutilizando ese mismo escaneo. Refrescos y búsquedas pasan por
+    LOOKUP_QUEUE con PRIORITY_BACKGROUND: nunca adelantan a las búsquedas
+    de los usuarios y respetan el límite global de conexiones IMAP.
+    """
+
+    def __init__(self):
+        self._watches = {}
+        self._checks = {}
+        self._bot = None
+        self._loop = None
+        self._poller = None
+        INDEX_LISTENERS.append(self._on_new_messages)
+
+    def __len__(self):
+        return sum(len(watches) for watches in self._watches.values())
+
+    def count_for_user(self, user_id):
+        return sum(1 for watches in self._watches.values() for watch in watches if watch.user_id == user_id)
+
+    def add(self, bot, watch):
+        self._bot = bot
+        self._loop = asyncio.get_running_loop()
+        key = (EMAIL_LOOKUPS[watch.awaiting]["service"], watch.email)
+        self._watches.setdefault(key, []).append(watch)
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll())
+        # El correo pudo llegar entre la búsqueda fallida y el registro.
+        self._schedule_check(key, None)
+
+    def _on_new_messages(self, service, new_entries, refreshed_at):
+        # Se ejecuta en el hilo de la búsqueda: sólo se agenda el chequeo en el loop.
+        loop = self._loop
+        if loop is None:
+            return
+        watched = {email_addr for (svc, email_addr) in list(self._watches) if svc == service}
+        arrived = set()
+        for entry in new_entries:
+            arrived.update(watched & entry.recipients)
+        for email_addr in arrived:
+            loop.call_soon_threadsafe(self._schedule_check, (service, email_addr), refreshed_at)
+
+    def _schedule_check(self, key, refreshed_at):
+        if key in self._checks and not self._checks[key].done():
+            return
+        self._checks[key] = asyncio.create_task(self._check(key, refreshed_at))
+
+    async def _check(self, key, refreshed_at):
+        if refreshed_at is not None:
+            _SCAN_REQUESTED_AT.set(refreshed_at)
+        requested_email = key[1]
+        for awaiting in {watch.awaiting for watch in self._watches.get(key, [])}:
+            lookup = EMAIL_LOOKUPS[awaiting]
+            try:
+                value, minutes = await _run_lookup_job(
+                    lookup["lookup"], (requested_email,), None, PRIORITY_BACKGROUND
+                )
+            except LookupQueueFull:
+                # Cola llena o apagado: el próximo refresh vuelve a intentarlo.
+                continue
+            except Exception as e:
+                logging.error(f"Error revisando la espera de {requested_email} ({awaiting}): {e}")
+                continue
+            if value:
+                resolved = [watch for watch in self._watches.get(key, []) if watch.awaiting == awaiting]
+                self._remove(key, resolved)
+                text = _format_lookup_result(lookup["found_text"], value, minutes, escape=True)
+                for watch in resolved:
+                    user_log(watch.user_id, _format_lookup_result(lookup["found_log"], value, minutes, escape=False),
+                             service=awaiting, email=requested_email, outcome="ok", waited=True)
+                    await self._send(watch.chat_id, text, parse_mode="Markdown")
+
+    def _remove(self, key, watches):
+        remaining = [watch for watch in self._watches.get(key, []) if watch not in watches]
+        if remaining:
+            self._watches[key] = remaining
+        else:
+            self._watches.pop(key, None)
+
+    async def _send(self, chat_id, text, **kwargs):
+        try:
+            await self._bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        except TelegramError as e:
+            count_telegram_failure("sendMessage", e)
+            logging.warning(f"No se pudo avisar a {chat_id}: {e}")
+
+    async def _expire(self):
+        now = time.monotonic()
+        for key, watches in list(self._watches.items()):
+            expired = [watch for watch in watches if watch.expires_at <= now]
+            if not expired:
+                continue
+            self._remove(key, expired)
+            for watch in expired:
+                user_log(watch.user_id, "Espera vencida sin resultados",
+                         service=watch.awaiting, email=watch.email, outcome="espera_vencida")
+                await self._send(
+                    watch.chat_id,
+                    f"⌛ Pasaron {watch.minutes} minutos y no llegó el correo para {watch.email}.\n"
+                    f"{EMAIL_LOOKUPS[watch.awaiting]['not_found_text']}"
+                )
+
+    async def _poll(self):
+        while self._watches:
+            await asyncio.sleep(WAIT_POLL_INTERVAL)
+            await self._expire()
+            for service in {svc for svc, _ in list(self._watches)}:
+                try:
+                    await _run_lookup_job(refresh_service_indexes, (service,), None, PRIORITY_BACKGROUND)
+                except LookupQueueFull:
+                    logging.info(f"Cola llena: se salta la revisión de {SERVICE_NAMES[service]} para esperas")
+
+    async def cancel_all(self):
+        """Avisa a quienes esperaban un código que la espera se cancela (apagado)."""
+        watches = [watch for watches in self._watches.values() for watch in watches]
+        self._watches.clear()
+        for watch in watches:
+            user_log(watch.user_id, "Espera cancelada: el bot se está apagando",
+                     service=watch.awaiting, email=watch.email, outcome="cancelado")
+        await asyncio.gather(*(
+            self._send(watch.chat_id, f"🔧 El bot se está reiniciando; dejé de esperar el correo para "
+                                      f"{watch.email}. Vuelve a pedirlo en un minuto.")
+            for watch in watches
+        ))
+        return len(watches)
+
+    async def stop(self):
+        tasks = [task for task in [self._poller, *self._checks.values()] if task and not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._poller = None
+        self._checks.clear()
+
+CODE_WATCHES = CodeWatchRegistry()
+
+async def wait_for_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    await query.answer()
+
+    request = context.user_data.get('wait_requests', {}).pop(query.message.message_id, None)
+    minutes = int(query.data.split(":", 1)[1])
+    if not request or minutes not in WAIT_MINUTES_OPTIONS:
+        await query.edit_message_text("Esta búsqueda ya no está disponible. Vuelve a buscar desde /start.")
+        return
+
+    awaiting, requested_email = request
+    lookup = EMAIL_LOOKUPS[awaiting]
+    if not user_has_valid_access(user_id, requested_email) or (
+        lookup["permission"] and not lookup["permission"](user_id)
+    ):
+        await query.edit_message_text("❌ No tienes permiso (o expiró tu acceso) para ese correo.")
+        return
+    if CODE_WATCHES.count_for_user(user_id) >= WAIT_MAX_PER_USER:
+        await query.edit_message_text(
+            f"❌ Ya tienes {WAIT_MAX_PER_USER} esperas activas. Espera a que terminen."
+        )
+        return
+    if not is_admin(user_id):
+        # Una espera cuenta como una búsqueda más para el límite por usuario.
+        wait_seconds = LOOKUP_LIMITER.try_consume(user_id)
+        if wait_seconds:
+            context.user_data['wait_requests'][query.message.message_id] = request
+            await query.edit_message_text(
+                f"⏳ Hiciste demasiadas búsquedas seguidas. Intenta de nuevo en {int(wait_seconds) + 1} s.",
+                reply_markup=wait_keyboard()
+            )
+            return
+
+    CODE_WATCHES.add(context.bot, CodeWatch(user_id, query.message.chat_id, awaiting, requested_email, minutes))
+    user_log(user_id, f"Esperando correo hasta {minutes} min", service=awaiting, email=requested_email)
+    await query.edit_message_text(
+        f"⏳ Te aviso aquí apenas llegue el correo para {requested_email} (hasta {minutes} minutos)."
+    )
+
 # =============================================================================
 # COMANDOS PARA DIFUSIÓN (BROADCAST)
 # =============================================================================
 
+BROADCAST_STATE_FILE = "broadcast_state.json"
+BROADCAST_RATE = 25            # mensajes por segundo en total (límite de Telegram: ~30)
+BROADCAST_CONCURRENCY = 8
+BROADCAST_MAX_RETRIES = 5
+BROADCAST_PROGRESS_INTERVAL = 3
+
+class TokenBucket:
+    """
+    Limitador global de envíos: 'rate' tokens por segundo con ráfagas de
+    hasta 'capacity'. pause() detiene todos los envíos (p. ej. tras un
+    RetryAfter, que Telegram aplica a todo el bot).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+def _retry_after_seconds(value):
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+def save_broadcast_state(state):
+    commit_files({BROADCAST_STATE_FILE: [json.dumps(state, ensure_ascii=False)]})
+
+def load_broadcast_state():
+    if not os.path.exists(BROADCAST_STATE_FILE):
+        return None
+    try:
+        with open(BROADCAST_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError as e:
+        logging.error(f"Estado de difusión corrupto, se descarta: {e}")
+        return None
+
+def _broadcast_progress_text(state, finished=False):
+    done = state["sent"] + state["failed"]
+    if finished:
+        return (f"✅ Difusión terminada.\n"
+                f"Enviados: {state['sent']} · Fallidos: {state['failed']} (de {state['total']})")
+    return (f"📣 Difundiendo... {done}/{state['total']}\n"
+            f"✅ {state['sent']} · ❌ {state['failed']}")
+
+async def _edit_broadcast_progress(bot, state, finished=False):
+    if not state.get("progress_message_id"):
+        return
+    try:
+        await bot.edit_message_text(
+            chat_id=state["progress_chat_id"],
+            message_id=state["progress_message_id"],
+            text=_broadcast_progress_text(state, finished)
+        )
+    except BadRequest:
+        # "Message is not modified" u otro problema con el mensaje de progreso.
+        pass
+    except TelegramError as e:
+        logging.warning(f"No se pudo actualizar el progreso de la difusión: {e}")
+
+async def _broadcast_send(bot, bucket, chat_id, text):
+    """Envía un mensaje respetando el limitador; retorna True si se entregó."""
+    for attempt in range(BROADCAST_MAX_RETRIES):
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+            return True
+        except RetryAfter as e:
+            count_telegram_failure("sendMessage", e)
+            delay = _retry_after_seconds(e.retry_after)
+            logging.warning(f"Flood control en difusión, pausando {delay}s")
+            bucket.pause(delay)
+        except (Forbidden, BadRequest) as e:
+            count_telegram_failure("sendMessage", e)
+            logging.warning(f"No se pudo enviar mensaje a {chat_id}: {e}")
+            return False
+        except (TimedOut, NetworkError) as e:
+            count_telegram_failure("sendMessage", e)
+            delay = min(30, 2 ** attempt)
+            logging.warning(f"Error de red enviando a {chat_id} (intento {attempt + 1}), reintento en {delay}s: {e}")
+            await asyncio.sleep(delay)
+        except TelegramError as e:
+            # ChatMigrated y demás errores de Telegram: se cuenta como fallido.
+            count_telegram_failure("sendMessage", e)
+            logging.warning(f"No se pudo enviar mensaje a {chat_id}: {e}")
+            return False
+    logging.warning(f"No se pudo enviar mensaje a {chat_id} tras {BROADCAST_MAX_RETRIES} intentos")
+    return False
+
+async def run_broadcast(bot, state):
+    """
+    Ejecuta (o reanuda) una difusión. El estado se guarda en disco cada
+    BROADCAST_PROGRESS_INTERVAL segundos con los destinatarios pendientes,
+    así un reinicio continúa donde quedó.
+    """
+    remaining = set(state["pending"])
+    chat_queue = asyncio.Queue()
+    for chat_id in state["pending"]:
+        chat_queue.put_nowait(chat_id)
+    bucket = TokenBucket(BROADCAST_RATE)
+
+    async def worker():
+        while True:
+            try:
+                chat_id = chat_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            delivered = cancelled = False
+            try:
+                delivered = await _broadcast_send(bot, bucket, chat_id, state["text"])
+            except asyncio.CancelledError:
+                # Apagado: el chat queda pendiente para reanudar al iniciar.
+                cancelled = True
+                raise
+            except Exception as e:
+                logging.error(f"Error inesperado enviando la difusión a {chat_id}: {e}")
+            finally:
+                if not cancelled:
+                    state["sent" if delivered else "failed"] += 1
+                    remaining.discard(chat_id)
+
+    saving = []
+
+    async def report_progress():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            state["pending"] = sorted(remaining)
+            # Cancelar la tarea no detiene el hilo: se protege y se espera al final.
+            saving[:] = [asyncio.ensure_future(asyncio.to_thread(save_broadcast_state, state))]
+            await asyncio.shield(saving[0])
+            await _edit_broadcast_progress(bot, state)
+
+    reporter = asyncio.create_task(report_progress())
+    try:
+        await asyncio.gather(*(worker() for _ in range(BROADCAST_CONCURRENCY)))
+    finally:
+        reporter.cancel()
+        # Un guardado en curso del reporter no debe pisar el final ni revivir el archivo.
+        await asyncio.gather(reporter, *saving, return_exceptions=True)
+        state["pending"] = sorted(remaining)
+        if remaining:
+            # Cancelado (p. ej. apagado): se guarda para reanudar al iniciar.
+            save_broadcast_state(state)
+
+    if os.path.exists(BROADCAST_STATE_FILE):
+        os.remove(BROADCAST_STATE_FILE)
+    logging.info(f"Difusión terminada: {state['sent']} enviados, {state['failed']} fallidos")
+    await _edit_broadcast_progress(bot, state, finished=True)
+
+def start_broadcast_task(application, state):
+    task = asyncio.create_task(run_broadcast(application.bot, state))
+    application.bot_data['broadcast_task'] = task
+    return task
+
+def broadcast_running(application):
+    task = application.bot_data.get('broadcast_task')
+    return task is not None and not task.done()
+
+async def _start_broadcast(update, context, kind, recipients, message_to_send):
+    if broadcast_running(context.application):
+        await update.message.reply_text("⚠️ Ya hay una difusión en curso. Espera a que termine.")
+        return
+
+    progress_message = await update.message.reply_text(f"📣 Difundiendo... 0/{len(recipients)}")
+    state = {
+        "kind": kind,
+        "text": message_to_send,
+        "pending": sorted(recipients),
+        "total": len(recipients),
+        "sent": 0,
+        "failed": 0,
+        "progress_chat_id": progress_message.chat_id,
+        "progress_message_id": progress_message.message_id,
+    }
+    save_broadcast_state(state)
+    start_broadcast_task(context.application, state)
+
 async def broadcastusers(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin_user_id = update.effective_user.id
     if not is_admin(admin_user_id):
@@ -1212,18 +3411,8 @@ async def broadcastusers(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     message_to_send = " ".join(context.args)
-    users_dict = load_users()
-    all_user_ids = list(users_dict.keys())
-
-    enviados = 0
-    for uid in all_user_ids:
-        try:
-            await context.bot.send_message(chat_id=uid, text=message_to_send)
-            enviados += 1
-        except Exception as e:
-            logging.warning(f"No se pudo enviar mensaje a {uid}: {e}")
-
-    await update.message.reply_text(f"Mensaje enviado a {enviados} usuarios.")
+    all_user_ids = get_user_store().user_ids()
+    await _start_broadcast(update, context, "users", all_user_ids, message_to_send)
 
 async def broadcastadmins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin_user_id = update.effective_user.id
@@ -1236,16 +3425,7 @@ async def broadcastadmins(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     message_to_send = " ".join(context.args)
-
-    enviados = 0
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(chat_id=admin_id, text=message_to_send)
-            enviados += 1
-        except Exception as e:
-            logging.warning(f"No se pudo enviar mensaje al admin {admin_id}: {e}")
-
-    await update.message.reply_text(f"Mensaje enviado a {enviados} administradores.")
+    await _start_broadcast(update, context, "admins", CONFIG.admin_ids, message_to_send)
 
 # =============================================================================
 # 8. COMANDOS DE ADMINISTRACIÓN
@@ -1614,41 +3794,139 @@ async def showuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
     final_text = "\n".join(msg)
     await update.message.reply_text(final_text, parse_mode="Markdown")
 
-async def listusers(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    admin_user_id = update.effective_user.id
-    user_log(admin_user_id, "/listusers")
-
-    if not is_admin(admin_user_id):
-        await update.message.reply_text("❌ No tienes permisos de administrador.")
-        return
+LISTUSERS_PAGE_SIZE = 10
+LISTUSERS_MAX_GRANTS_SHOWN = 5
+LISTUSERS_EXPIRING_DAYS = 7
+TELEGRAM_TEXT_LIMIT = 4096
+# El filtro viaja en el callback_data ("lu:<página>:<filtro>", máx. 64 bytes).
+LISTUSERS_MAX_FILTER_BYTES = 64 - len("lu:99999:")
 
-    users_dict = load_users()
-    if not users_dict:
-        await update.message.reply_text("No hay usuarios en la base de datos.")
-        return
+def _listusers_filter(filter_arg, today_ordinal):
+    """
+    Retorna una función (user_rows) -> bool para el filtro pedido:
+    'expirados', 'porvencer' (vence en LISTUSERS_EXPIRING_DAYS días) o '@dominio'.
+    """
+    if not filter_arg:
+        return None
+    if filter_arg == "expirados":
+        return lambda rows: any(
+            ordinal != UNLIMITED_ORDINAL and ordinal < today_ordinal for _, ordinal in rows
+        )
+    if filter_arg == "porvencer":
+        return lambda rows: any(
+            ordinal != UNLIMITED_ORDINAL and 0 <= ordinal - today_ordinal <= LISTUSERS_EXPIRING_DAYS
+            for _, ordinal in rows
+        )
+    if filter_arg.startswith("@"):
+        return lambda rows: any(mail.endswith(filter_arg) for mail, _ in rows)
+    raise ValueError(filter_arg)
 
-    msg = ["**Lista de Usuarios Autorizados**\n"]
-    for uid, emails_dict in users_dict.items():
-        if not emails_dict:
+def render_listusers_page(page, filter_arg):
+    """
+    Arma sólo la página pedida: recorre el store aplicando el filtro y
+    formatea únicamente los usuarios de esa página.
+    """
+    store = get_user_store()
+    today_ordinal = datetime.now().date().toordinal()
+    matches = _listusers_filter(filter_arg, today_ordinal)
+
+    skip = page * LISTUSERS_PAGE_SIZE
+    page_users = []
+    has_next = False
+    for uid in store.user_ids():
+        rows = store.user_rows(uid)
+        if matches and not matches(rows):
+            continue
+        if skip:
+            skip -= 1
+            continue
+        if len(page_users) == LISTUSERS_PAGE_SIZE:
+            has_next = True
+            break
+        page_users.append((uid, rows))
+
+    title = "**Lista de Usuarios Autorizados**"
+    if filter_arg:
+        title += f" ({escape_markdown(filter_arg)})"
+    msg = [f"{title} · página {page + 1}\n"]
+    if not page_users:
+        msg.append("No hay usuarios para mostrar.")
+
+    for uid, rows in page_users:
+        if not rows:
             msg.append(f"- **UserID**: `{uid}` | (sin correos)")
             continue
 
         detalles = []
-        for mail, exp_date in emails_dict.items():
+        for mail, ordinal in rows[:LISTUSERS_MAX_GRANTS_SHOWN]:
             mail_esc = escape_markdown(mail)
-            if exp_date is None:
+            if ordinal == UNLIMITED_ORDINAL:
                 detalles.append(f"{mail_esc} (ilimitado)")
             else:
-                delta = (exp_date - datetime.now().date()).days
+                exp_date = date.fromordinal(ordinal)
+                delta = ordinal - today_ordinal
                 if delta < 0:
                     detalles.append(f"{mail_esc} (expirado {exp_date.isoformat()})")
                 else:
                     detalles.append(f"{mail_esc} (expira {exp_date.isoformat()}, faltan {delta} días)")
-        detalles_str = "; ".join(detalles)
-        msg.append(f"- **UserID**: `{uid}` | {detalles_str}")
+        if len(rows) > LISTUSERS_MAX_GRANTS_SHOWN:
+            detalles.append(f"+{len(rows) - LISTUSERS_MAX_GRANTS_SHOWN} más")
+        msg.append(f"- **UserID**: `{uid}` | {'; '.join(detalles)}")
 
     final_text = "\n".join(msg)
-    await update.message.reply_text(final_text, parse_mode="Markdown")
+    if len(final_text) > TELEGRAM_TEXT_LIMIT:
+        final_text = final_text[:TELEGRAM_TEXT_LIMIT - 20].rsplit("\n", 1)[0] + "\n…"
+
+    buttons = []
+    filter_data = filter_arg or ""
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"lu:{page - 1}:{filter_data}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"lu:{page + 1}:{filter_data}"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return final_text, reply_markup
+
+async def listusers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Uso: /listusers [expirados | porvencer | @dominio]
+    """
+    admin_user_id = update.effective_user.id
+    user_log(admin_user_id, f"/listusers con args: {context.args}")
+
+    if not is_admin(admin_user_id):
+        await update.message.reply_text("❌ No tienes permisos de administrador.")
+        return
+
+    if not len(get_user_store()):
+        await update.message.reply_text("No hay usuarios en la base de datos.")
+        return
+
+    filter_arg = context.args[0].lower() if context.args else None
+    try:
+        _listusers_filter(filter_arg, 0)
+    except ValueError:
+        await update.message.reply_text("Uso: /listusers [expirados | porvencer | @dominio]")
+        return
+    if filter_arg and len(filter_arg.encode('utf-8')) > LISTUSERS_MAX_FILTER_BYTES:
+        await update.message.reply_text(
+            f"❌ El dominio es demasiado largo (máximo {LISTUSERS_MAX_FILTER_BYTES} caracteres)."
+        )
+        return
+
+    final_text, reply_markup = render_listusers_page(0, filter_arg)
+    await update.message.reply_text(final_text, parse_mode="Markdown", reply_markup=reply_markup)
+
+async def listusers_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if not is_admin(query.from_user.id):
+        return
+
+    # El filtro viene en el propio botón: cada lista pagina con el suyo.
+    _, page, filter_arg = (query.data.split(":", 2) + [""])[:3]
+    page = max(0, int(page))
+    final_text, reply_markup = render_listusers_page(page, filter_arg or None)
+    await query.edit_message_text(final_text, parse_mode="Markdown", reply_markup=reply_markup)
 
 async def addadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin_user_id = update.effective_user.id
@@ -1668,14 +3946,14 @@ async def addadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("El ID debe ser un número entero.")
         return
 
-    if new_admin_id in ADMIN_IDS:
+    if new_admin_id in CONFIG.admin_ids:
         await update.message.reply_text("❌ Este usuario ya es administrador.")
         return
 
     try:
-        with open("admin_ids.txt", "a", encoding="utf-8") as f:
+        with open(ADMIN_IDS_FILE, "a", encoding="utf-8") as f:
             f.write(f"{new_admin_id}\n")
-        ADMIN_IDS.append(new_admin_id)
+        set_admin_ids(CONFIG.admin_ids | {new_admin_id})
     except Exception as e:
         logging.error(f"Error al agregar admin: {e}")
         await update.message.reply_text("❌ Hubo un error al agregar el nuevo administrador.")
@@ -1701,23 +3979,289 @@ async def removeadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("El ID debe ser un número entero.")
         return
 
-    if remove_id not in ADMIN_IDS:
+    if remove_id not in CONFIG.admin_ids:
         await update.message.reply_text("❌ Este usuario no es administrador.")
         return
 
-    ADMIN_IDS.remove(remove_id)
+    remaining_admins = CONFIG.admin_ids - {remove_id}
 
     try:
-        with open("admin_ids.txt", "w", encoding="utf-8") as f:
-            for admin in ADMIN_IDS:
-                f.write(f"{admin}\n")
+        commit_files({ADMIN_IDS_FILE: (f"{admin}\n" for admin in sorted(remaining_admins))})
     except Exception as e:
         logging.error(f"Error al remover admin: {e}")
         await update.message.reply_text("❌ Hubo un error al remover el administrador.")
         return
+    set_admin_ids(remaining_admins)
 
     await update.message.reply_text(f"✅ Se removió a {remove_id} de administradores.")
 
+async def ratelimit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Uso: /ratelimit [<ráfaga> <por_minuto> <simultáneas>]
+    Sin argumentos muestra los límites actuales.
+    """
+    admin_user_id = update.effective_user.id
+    user_log(admin_user_id, f"/ratelimit con args: {context.args}")
+
+    if not is_admin(admin_user_id):
+        await update.message.reply_text("❌ No tienes permisos de administrador.")
+        return
+
+    if context.args:
+        if len(context.args) < 3:
+            await update.message.reply_text("Uso: /ratelimit <ráfaga> <por_minuto> <simultáneas>")
+            return
+        try:
+            capacity, per_minute, max_concurrent = (int(arg) for arg in context.args[:3])
+        except ValueError:
+            await update.message.reply_text("Los tres argumentos deben ser números enteros.")
+            return
+        if capacity < 1 or per_minute < 1 or max_concurrent < 1:
+            await update.message.reply_text("Los límites deben ser mayores que 0.")
+            return
+        LOOKUP_LIMITER.configure(capacity, per_minute)
+        LOOKUP_QUEUE.resize(max_concurrent)
+
+    await update.message.reply_text(
+        f"⚙️ Límites de búsqueda:\n"
+        f"Ráfaga por usuario: {LOOKUP_LIMITER.capacity}\n"
+        f"Por minuto por usuario: {LOOKUP_LIMITER.refill_per_second * 60:g}\n"
+        f"Simultáneas (global): {LOOKUP_QUEUE.target_workers}\n\n"
+        f"En curso: {LOOKUP_QUEUE.active} · En cola: {LOOKUP_QUEUE.queued}"
+    )
+
+def _format_ms(value):
+    if value is None:
+        return "-"
+    return f"{value / 1000:.1f} s" if value >= 1000 else f"{value:.0f} ms"
+
+def render_stats():
+    lines = [
+        "📊 *Estadísticas*",
+        f"En curso: {LOOKUP_QUEUE.active} · En cola: {LOOKUP_QUEUE.queued} · Esperas: {len(CODE_WATCHES)}",
+    ]
+    for label, minutes in STATS_WINDOWS:
+        latency, accounts = LOOKUP_STATS.summary(minutes)
+        total = sum(sketch.count for sketch in latency.values())
+        lines.append("")
+        lines.append(f"*Últimos {label}* — {total / minutes:.2f} búsquedas/min")
+        for service in sorted(latency):
+            sketch = latency[service]
+            lines.append(
+                f"`{service}`: p50 {_format_ms(sketch.quantile(0.5))} · "
+                f"p95 {_format_ms(sketch.quantile(0.95))} · "
+                f"p99 {_format_ms(sketch.quantile(0.99))} (n={sketch.count})"
+            )
+        for account in sorted(accounts):
+            ok, errors = accounts[account]
+            lines.append(f"`{account}`: {100 * errors / (ok + errors):.1f}% errores ({errors}/{ok + errors})")
+        if not latency and not accounts:
+            lines.append("Sin búsquedas.")
+    return "\n".join(lines)
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Uso: /stats
+    Latencia p50/p95/p99 por servicio, búsquedas por minuto y errores por
+    cuenta IMAP en los últimos 5 min, 1 h y 24 h.
+    """
+    admin_user_id = update.effective_user.id
+    user_log(admin_user_id, "/stats")
+
+    if not is_admin(admin_user_id):
+        await update.message.reply_text("❌ No tienes permisos de administrador.")
+        return
+
+    await update.message.reply_text(render_stats(), parse_mode="Markdown")
+
+# =============================================================================
+# PERFILADO POR MUESTREO (/profile)
+# =============================================================================
+
+PROFILES_FOLDER = "profiles"
+PROFILE_INTERVAL = 0.005           # segundos entre muestras
+PROFILE_MAX_SECONDS = 600
+# PROFILE_ON_START=<segundos>: perfila desde el arranque durante ese tiempo.
+PROFILE_ON_START = int(os.environ.get("PROFILE_ON_START", "0"))
+# Sólo se guardan las pilas que pasan por alguna de estas funciones.
+PROFILE_TARGETS = frozenset({
+    "email_input", "email_single_input", "email_batch_input", "lookup_batch",
+    "_search_service_email", "_search_netflix_email", "_search_max_email", "get_disney_code",
+})
+
+class SamplingProfiler:
+    """
+    Hilo que cada PROFILE_INTERVAL toma las pilas de todos los hilos
+    (sys._current_frames) y cuenta las que pasan por PROFILE_TARGETS. No
+    instala hooks: apagado no existe y no cuesta nada.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.samples = {}
+        self.total = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def wait(self):
+        self._thread.join()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                relevant = False
+                while frame is not None:
+                    code = frame.f_code
+                    relevant = relevant or code.co_name in PROFILE_TARGETS
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if relevant:
+                    key = ";".join(reversed(stack))
+                    self.samples[key] = self.samples.get(key, 0) + 1
+                    self.total += 1
+            self._stop.wait(PROFILE_INTERVAL)
+
+    def write_collapsed(self):
+        """Guarda las pilas en formato 'collapsed' (flamegraph.pl, speedscope)."""
+        os.makedirs(PROFILES_FOLDER, exist_ok=True)
+        filename = os.path.join(PROFILES_FOLDER, f"profile-{datetime.now():%Y%m%d-%H%M%S}.collapsed")
+        with open(filename, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.samples.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+        return filename
+
+    def top_functions(self, limit=15):
+        """[(función, muestras propias, muestras incluyendo llamadas)] ordenado por tiempo propio."""
+        own, inclusive = {}, {}
+        for stack, count in self.samples.items():
+            frames = stack.split(";")
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for function in set(frames):
+                inclusive[function] = inclusive.get(function, 0) + count
+        ranked = sorted(own.items(), key=lambda item: -item[1])[:limit]
+        return [(function, count, inclusive[function]) for function, count in ranked]
+
+def render_profile(profiler, filename):
+    if not profiler.total:
+        return f"Sin muestras en {profiler.seconds} s (no hubo búsquedas). Archivo: {filename}"
+    lines = [f"Perfil de {profiler.seconds} s: {profiler.total} muestras → {filename}",
+             "propio%  total%  función"]
+    for function, own, inclusive in profiler.top_functions():
+        lines.append(f"{100 * own / profiler.total:6.1f}  {100 * inclusive / profiler.total:6.1f}  {function}")
+    return "\n".join(lines)
+
+async def run_profile(bot, seconds, chat_id=None):
+    """Perfila 'seconds' segundos, escribe el archivo y avisa a chat_id (si hay)."""
+    profiler = SamplingProfiler(seconds)
+    profiler.start()
+    try:
+        await asyncio.to_thread(profiler.wait)
+    finally:
+        profiler.stop()
+    filename = await asyncio.to_thread(profiler.write_collapsed)
+    text = render_profile(profiler, filename)
+    logging.info(text)
+    if chat_id is not None:
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+        except TelegramError as e:
+            count_telegram_failure("sendMessage", e)
+
+def start_profile_task(application, seconds, chat_id=None):
+    task = asyncio.create_task(run_profile(application.bot, seconds, chat_id))
+    application.bot_data['profile_task'] = task
+    return task
+
+def profile_running(application):
+    task = application.bot_data.get('profile_task')
+    return task is not None and not task.done()
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Uso: /profile <segundos>
+    Perfila por muestreo las búsquedas durante ese tiempo y responde con las
+    funciones más costosas; las pilas quedan en profiles/.
+    """
+    admin_user_id = update.effective_user.id
+    user_log(admin_user_id, f"/profile con args: {context.args}")
+
+    if not is_admin(admin_user_id):
+        await update.message.reply_text("❌ No tienes permisos de administrador.")
+        return
+
+    try:
+        seconds = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("Uso: /profile <segundos>")
+        return
+    if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+        await update.message.reply_text(f"Los segundos deben estar entre 1 y {PROFILE_MAX_SECONDS}.")
+        return
+    if profile_running(context.application):
+        await update.message.reply_text("Ya hay un perfilado en curso.")
+        return
+
+    start_profile_task(context.application, seconds, update.effective_chat.id)
+    await update.message.reply_text(f"⏱️ Perfilando {seconds} s; te envío el resultado al terminar.")
+
+# Alias de /explain para los servicios con una sola búsqueda "típica".
+EXPLAIN_ALIASES = {"netflix": "netflix_access_code", "max": "max_reset_link"}
+
+async def explain(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Uso: /explain <correo> <servicio>   (ejecuta una búsqueda trazada)
+         /explain <trace_id>            (muestra una traza reciente, ver /userlog)
+    Servicios: disney, netflix, max o cualquier tipo de búsqueda
+    (netflix_reset_link, netflix_country_info, ...).
+    """
+    admin_user_id = update.effective_user.id
+    user_log(admin_user_id, f"/explain con args: {context.args}")
+
+    if not is_admin(admin_user_id):
+        await update.message.reply_text("❌ No tienes permisos de administrador.")
+        return
+
+    if len(context.args) == 1:
+        trace = find_trace(context.args[0])
+        if trace is None:
+            await update.message.reply_text("No hay una traza reciente con ese id.")
+            return
+        await update.message.reply_text(render_trace(trace))
+        return
+
+    if len(context.args) < 2:
+        await update.message.reply_text("Uso: /explain <correo> <servicio>  o  /explain <trace_id>")
+        return
+
+    requested_email = context.args[0].lower()
+    awaiting = EXPLAIN_ALIASES.get(context.args[1].lower(), context.args[1].lower())
+    lookup = EMAIL_LOOKUPS.get(awaiting)
+    if lookup is None:
+        await update.message.reply_text(f"Servicio desconocido. Opciones: {', '.join(EMAIL_LOOKUPS)}")
+        return
+
+    with start_trace("explain", servicio=awaiting, correo=requested_email) as trace:
+        try:
+            value, minutes = await run_lookup(lookup["lookup"], requested_email, priority=PRIORITY_ADMIN)
+            trace.attrs["resultado"] = "encontrado" if value else "sin resultados"
+        except LookupQueueClosed:
+            trace.attrs["resultado"] = "cancelada (apagando)"
+        except LookupQueueFull:
+            trace.attrs["resultado"] = "cola llena"
+    await update.message.reply_text(render_trace(trace))
+
 # =============================================================================
 # NUEVO: Comandos para dar/quitar permiso de extraer link de Max
 # =============================================================================
@@ -1799,25 +4343,977 @@ async def removeaccessmax(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"⚠️ El usuario {target_user_id} no tenía permiso para extraer enlaces de Max.")
 
 # =============================================================================
-# 9. MAIN
+# CONSULTA DEL LOG DE AUDITORÍA (/userlog)
 # =============================================================================
 
-if __name__ == "__main__":
-    colorama.init(autoreset=True)
+USERLOG_PAGE_SIZE = 15
+USERLOG_ACTION_MAX_CHARS = 300
 
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.DEBUG)
-    log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    console_handler.setFormatter(ColorfulFormatter(log_format))
+def read_user_log_index(user_id):
+    """Lista [(día, offset), ...] del segmento actual del log del usuario."""
+    entries = []
+    try:
+        with open(USER_LOG_WRITER.index_path(user_id), 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[1].isdigit():
+                    entries.append((parts[0], int(parts[1])))
+    except FileNotFoundError:
+        pass
+    return entries
 
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(console_handler)
+class UserLogRotated(Exception):
+    """El segmento del log que mostraba la página se rotó o se borró."""
+
+def user_log_segment(stat_result):
+    # Un segmento nuevo (tras rotar) es otro archivo: otro inodo.
+    return format(stat_result.st_ino, "x")
+
+def read_user_log_page(user_id, offset, direction, segment=None):
+    """
+    Lee como máximo USERLOG_PAGE_SIZE eventos a partir de 'offset' (direction
+    'n') o justo antes de 'offset' (direction 'p'), sin leer el archivo entero.
+    Si 'segment' no es el del archivo actual los offsets ya no valen y lanza
+    UserLogRotated. Retorna (eventos, offset_inicio, offset_fin, tamaño,
+    segmento); cada evento es (evento, offset_inicio, offset_fin) de su línea.
+    """
+    path = USER_LOG_WRITER.log_path(user_id)
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        raise UserLogRotated()
+    with f:
+        stat_result = os.fstat(f.fileno())
+        current_segment = user_log_segment(stat_result)
+        if segment is not None and segment != current_segment:
+            raise UserLogRotated()
+        size = stat_result.st_size
+        offset = max(0, min(offset, size))
+        if direction == "n":
+            f.seek(offset)
+            lines = []
+            line_start = offset
+            while len(lines) < USERLOG_PAGE_SIZE:
+                line = f.readline()
+                if not line:
+                    break
+                lines.append((line_start, line_start + len(line), line.rstrip(b"\n")))
+                line_start += len(line)
+            start, end = offset, line_start
+        else:
+            pos = offset
+            chunk = b""
+            while pos > 0 and chunk.count(b"\n") <= USERLOG_PAGE_SIZE:
+                read_size = min(4096, pos)
+                pos -= read_size
+                f.seek(pos)
+                chunk = f.read(read_size) + chunk
+            raw_lines = chunk.split(b"\n")[:-1]
+            if pos > 0:
+                raw_lines = raw_lines[1:]
+            lines = []
+            line_end = offset
+            for line in reversed(raw_lines[-USERLOG_PAGE_SIZE:]):
+                lines.append((line_end - len(line) - 1, line_end, line))
+                line_end -= len(line) + 1
+            lines.reverse()
+            start, end = line_end, offset
+
+    events = []
+    for line_start, line_end, line in lines:
+        try:
+            events.append((json.loads(line), line_start, line_end))
+        except ValueError:
+            continue
+    return events, start, end, size, current_segment
+
+def _format_audit_event(event):
+    ts = str(event.get("ts", ""))[:19].replace("T", " ")
+    details = [str(event[key]) for key in ("service", "email", "outcome") if event.get(key)]
+    if event.get("latency_ms") is not None:
+        details.append(f"{event['latency_ms']} ms")
+    action = str(event.get('action', ''))
+    if len(action) > USERLOG_ACTION_MAX_CHARS:
+        # Enlaces de Netflix y argumentos largos: la página tiene que caber en un mensaje.
+        action = action[:USERLOG_ACTION_MAX_CHARS - 1] + "…"
+    line = f"`{ts}` {escape_markdown(action)}"
+    if details:
+        line += " · " + escape_markdown(" · ".join(details))
+    return line
+
+def render_user_log_page(user_id, offset, direction, segment=None):
+    try:
+        events, start, end, size, segment = read_user_log_page(user_id, offset, direction, segment)
+    except UserLogRotated:
+        return "⚠️ El log se rotó desde que se mostró esta página. Vuelve a pedir /userlog.", None
+    if not events:
+        return "No hay eventos en ese rango.", None
+
+    # Se muestran eventos desde el lado de 'offset' hasta llenar el mensaje;
+    # los botones siguen desde el último que entró.
+    formatted = [(_format_audit_event(event), line_start, line_end) for event, line_start, line_end in events]
+    if direction != "n":
+        formatted.reverse()
+    header = f"📜 *Log de* `{user_id}`\n"
+    shown = []
+    length = len(header)
+    for text, line_start, line_end in formatted:
+        if shown and length + 1 + len(text) > TELEGRAM_TEXT_LIMIT - 20:
+            break
+        shown.append((text, line_start, line_end))
+        length += 1 + len(text)
+    if len(shown) < len(formatted):
+        if direction == "n":
+            end = shown[-1][2]
+        else:
+            start = shown[-1][1]
+    if direction != "n":
+        shown.reverse()
+    lines = [header] + [text for text, _, _ in shown]
+
+    buttons = []
+    if start > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"ul:{user_id}:{start}:p:{segment}"))
+    if end < size:
+        buttons.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"ul:{user_id}:{end}:n:{segment}"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return "\n".join(lines), reply_markup
+
+async def userlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    admin_user_id = update.effective_user.id
+    user_log(admin_user_id, f"/userlog con args: {context.args}")
+
+    if not is_admin(admin_user_id):
+        await update.message.reply_text("❌ No tienes permisos de administrador.")
+        return
+
+    if len(context.args) < 1:
+        await update.message.reply_text("Uso: /userlog <user_id> [desde YYYY-MM-DD]")
+        return
+
+    try:
+        target_user_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("El primer argumento debe ser un número (user_id).")
+        return
+
+    since = None
+    if len(context.args) > 1:
+        try:
+            since = datetime.strptime(context.args[1], "%Y-%m-%d").date().isoformat()
+        except ValueError:
+            await update.message.reply_text("La fecha debe tener el formato YYYY-MM-DD.")
+            return
+
+    await asyncio.to_thread(USER_LOG_WRITER.flush)
+    index = await asyncio.to_thread(read_user_log_index, target_user_id)
+    if not index:
+        await update.message.reply_text(f"⚠️ No hay eventos registrados para {target_user_id}.")
+        return
+
+    if since is None:
+        offset = index[-1][1]
+    else:
+        offsets = [entry_offset for day, entry_offset in index if day >= since]
+        if not offsets:
+            await update.message.reply_text(f"⚠️ No hay eventos de {target_user_id} desde {since}.")
+            return
+        offset = offsets[0]
+
+    text, reply_markup = await asyncio.to_thread(render_user_log_page, target_user_id, offset, "n")
+    await update.message.reply_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+
+async def userlog_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if not is_admin(query.from_user.id):
+        return
+
+    # Los botones anteriores a este formato no traen el segmento.
+    _, target_user_id, offset, direction, *segment = query.data.split(":")
+    text, reply_markup = await asyncio.to_thread(
+        render_user_log_page, int(target_user_id), int(offset), direction, segment[0] if segment else None
+    )
+    await query.edit_message_text(text, parse_mode="Markdown", reply_markup=reply_markup)
+
+# =============================================================================
+# IMPORTACIÓN / EXPORTACIÓN MASIVA DE USUARIOS (CSV)
+# =============================================================================
+
+# Formato (una fila por permiso):  user_id,tipo,correo,expira
+#   tipo:   correo | disney | netflix | max
+#   correo: sólo para tipo 'correo'
+#   expira: YYYY-MM-DD, un número de días desde hoy, o vacío/'ilimitado'
+CSV_HEADER = ["user_id", "tipo", "correo", "expira"]
+CSV_PERMISSION_TYPES = ("disney", "netflix", "max")
+IMPORT_ERRORS_SHOWN = 15
+
+def _parse_csv_expiry(value, today):
+    value = value.strip()
+    if not value or value.lower() in ("none", "ilimitado"):
+        return None
+    if value.lstrip("-").isdigit():
+        days = int(value)
+        if days <= 0:
+            return None
+        return today + timedelta(days=days)
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+def parse_users_csv(data: bytes, encoding='utf-8-sig'):
+    """
+    Lee el CSV fila por fila (sin cargarlo entero en memoria como texto).
+    Retorna (filas_validas, errores) donde cada fila válida es
+    (user_id, tipo, correo, fecha_o_None) y cada error es (nro_fila, motivo).
+    Lanza UnicodeDecodeError si el archivo no está en 'encoding' y csv.Error
+    si no es un CSV legible.
+    """
+    rows = []
+    errors = []
+    today = datetime.now().date()
+    text_stream = io.TextIOWrapper(io.BytesIO(data), encoding=encoding, newline='')
+    reader = csv.reader(text_stream)
+
+    for row_number, row in enumerate(reader, start=1):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        if row_number == 1 and row[0].strip().lower() == "user_id":
+            continue
+        if len(row) < 2:
+            errors.append((row_number, "faltan columnas (user_id,tipo,correo,expira)"))
+            continue
+
+        row = [cell.strip() for cell in row] + [""] * (4 - len(row))
+        uid_str, kind, mail, expiry_str = row[:4]
+        kind = kind.lower()
+
+        try:
+            uid = int(uid_str)
+        except ValueError:
+            errors.append((row_number, f"user_id inválido: '{uid_str}'"))
+            continue
+
+        if kind == "correo":
+            mail = mail.lower()
+            if "@" not in mail or " " in mail or ":" in mail:
+                errors.append((row_number, f"correo inválido: '{mail}'"))
+                continue
+        elif kind in CSV_PERMISSION_TYPES:
+            mail = ""
+        else:
+            errors.append((row_number, f"tipo desconocido: '{kind}'"))
+            continue
+
+        try:
+            exp_date = _parse_csv_expiry(expiry_str, today)
+        except ValueError:
+            errors.append((row_number, f"fecha inválida: '{expiry_str}'"))
+            continue
+
+        rows.append((uid, kind, mail, exp_date))
+    return rows, errors
+
+def apply_users_import(rows):
+    """
+    Aplica todas las filas en memoria y guarda los cuatro archivos en una sola
+    transacción; luego actualiza las copias en memoria (como save_users y los
+    save_*), así los cambios rigen sin esperar al vigilante de archivos.
+    Retorna la cantidad de filas aplicadas.
+    """
+    global _USER_STORE, _USER_STORE_SIGNATURE
+    users_dict = load_users()
+    permission_dicts = {
+        "disney": load_disney_code_access(),
+        "netflix": load_netflix_code_access(),
+        "max": load_max_link_access(),
+    }
+
+    for uid, kind, mail, exp_date in rows:
+        if kind == "correo":
+            users_dict.setdefault(uid, {})[mail] = exp_date
+        else:
+            permission_dicts[kind][uid] = exp_date
+
+    commit_files({
+        USERS_DB_FILE: _format_users_lines(users_dict),
+        DISNEY_CODE_FILE: _format_expiry_lines(permission_dicts["disney"]),
+        NETFLIX_CODE_FILE: _format_expiry_lines(permission_dicts["netflix"]),
+        MAX_LINK_FILE: _format_expiry_lines(permission_dicts["max"]),
+    })
+    _USER_STORE = UserGrantStore.from_users_dict(users_dict)
+    _USER_STORE_SIGNATURE = _file_signature(USERS_DB_FILE)
+    for kind, code_dict in permission_dicts.items():
+        _PERMISSION_CACHE[kind] = code_dict
+    return len(rows)
+
+def export_users_csv(stream):
+    """
+    Escribe en 'stream' (binario) todos los accesos a correos y permisos,
+    en el mismo formato que acepta /importusers.
+    """
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8', newline='', write_through=True)
+    writer = csv.writer(text_stream)
+    writer.writerow(CSV_HEADER)
+    total = 0
+
+    for uid, emails_dict in load_users().items():
+        for mail, exp_date in emails_dict.items():
+            writer.writerow([uid, "correo", mail, exp_date.isoformat() if exp_date else ""])
+            total += 1
+
+    for kind, loader in (("disney", load_disney_code_access),
+                         ("netflix", load_netflix_code_access),
+                         ("max", load_max_link_access)):
+        for uid, exp_date in loader().items():
+            writer.writerow([uid, kind, "", exp_date.isoformat() if exp_date else ""])
+            total += 1
+
+    text_stream.detach()
+    return total
+
+async def importusers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    admin_user_id = update.effective_user.id
+    user_log(admin_user_id, "/importusers")
+
+    if not is_admin(admin_user_id):
+        await update.message.reply_text("❌ No tienes permisos de administrador.")
+        return
+
+    context.user_data['awaiting_import'] = True
+    await update.message.reply_text(
+        "📄 Envía ahora el archivo CSV con las columnas:\n"
+        "`user_id,tipo,correo,expira`\n\n"
+        "tipo: correo, disney, netflix o max.\n"
+        "expira: YYYY-MM-DD, número de días, o vacío para ilimitado.\n"
+        "Si alguna fila tiene errores no se aplica ningún cambio.",
+        parse_mode="Markdown"
+    )
+
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    admin_user_id = update.effective_user.id
+    if not context.user_data.get('awaiting_import'):
+        return
+    if not is_admin(admin_user_id):
+        await update.message.reply_text("❌ No tienes permisos de administrador.")
+        return
+
+    context.user_data['awaiting_import'] = False
+    document = update.message.document
+    user_log(admin_user_id, f"Importación CSV: {document.file_name} ({document.file_size} bytes)")
+
+    telegram_file = await document.get_file()
+    data = bytes(await telegram_file.download_as_bytearray())
+
+    # Excel con configuración regional en español guarda en cp1252.
+    encoding_note = ""
+    try:
+        try:
+            rows, errors = await asyncio.to_thread(parse_users_csv, data)
+        except UnicodeDecodeError:
+            rows, errors = await asyncio.to_thread(parse_users_csv, data, 'cp1252')
+            encoding_note = "ℹ️ El archivo no estaba en UTF-8; se leyó como Windows-1252 (cp1252).\n\n"
+    except (UnicodeDecodeError, csv.Error) as e:
+        user_log(admin_user_id, f"Importación rechazada: archivo ilegible ({e})")
+        await update.message.reply_text(
+            "❌ No se pudo leer el archivo. Debe ser un CSV en UTF-8 con las columnas "
+            "user_id,tipo,correo,expira. No se aplicó ningún cambio."
+        )
+        return
+
+    if errors:
+        user_log(admin_user_id, f"Importación rechazada: {len(errors)} errores")
+        shown = "\n".join(f"Fila {row_number}: {reason}" for row_number, reason in errors[:IMPORT_ERRORS_SHOWN])
+        await update.message.reply_text(
+            f"{encoding_note}❌ Se encontraron {len(errors)} filas con errores. "
+            f"No se aplicó ningún cambio.\n\n{shown}"
+        )
+        if len(errors) > IMPORT_ERRORS_SHOWN:
+            report = io.StringIO()
+            writer = csv.writer(report)
+            writer.writerow(["fila", "error"])
+            writer.writerows(errors)
+            await update.message.reply_document(
+                document=io.BytesIO(report.getvalue().encode('utf-8')),
+                filename="errores_importacion.csv"
+            )
+        return
+
+    try:
+        applied = await asyncio.to_thread(apply_users_import, rows)
+    except Exception as e:
+        logging.error(f"Error al importar usuarios: {e}")
+        await update.message.reply_text("❌ Hubo un error al guardar la importación. No se aplicó ningún cambio.")
+        return
+
+    user_log(admin_user_id, f"Importación aplicada: {applied} filas")
+    await update.message.reply_text(f"{encoding_note}✅ Importación completada: {applied} filas aplicadas.")
+
+async def exportusers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    admin_user_id = update.effective_user.id
+    user_log(admin_user_id, "/exportusers")
+
+    if not is_admin(admin_user_id):
+        await update.message.reply_text("❌ No tienes permisos de administrador.")
+        return
+
+    buffer = io.BytesIO()
+    total = export_users_csv(buffer)
+    buffer.seek(0)
+    filename = f"usuarios_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    await update.message.reply_document(
+        document=buffer,
+        filename=filename,
+        caption=f"📦 {total} filas exportadas."
+    )
+
+# =============================================================================
+# MODO WEBHOOK, SERVIDOR HTTP LOCAL Y LATENCIA DE UPDATES
+# =============================================================================
+
+# BOT_MODE: 'polling' (por defecto) o 'webhook'.
+BOT_MODES = ("polling", "webhook")
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# Si no se define, se genera uno al iniciar y se registra con setWebhook.
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "") or secrets.token_urlsafe(32)
+# Certificado para escuchar en HTTPS directamente (sin proxy delante).
+WEBHOOK_CERT = os.environ.get("WEBHOOK_CERT", "")
+WEBHOOK_KEY = os.environ.get("WEBHOOK_KEY", "")
+WEBHOOK_SELF_SIGNED = os.environ.get("WEBHOOK_SELF_SIGNED", "") == "1"
+# Permite apuntar el bot a una API de Telegram local (ver benchmarks/fake_telegram.py).
+TELEGRAM_BASE_URL = os.environ.get("TELEGRAM_BASE_URL", "")
+
+HTTP_MAX_BODY = 1_000_000
+HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable",
+}
+
+async def start_http_server(handle_request, host, port, ssl_context=None):
+    """
+    Servidor HTTP/1.1 mínimo (con keep-alive) sobre asyncio.start_server.
+    handle_request(method, path, headers, body) -> (status, content_type, bytes)
+    """
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", "0"))
+                if length > HTTP_MAX_BODY:
+                    status, content_type, payload = 413, "text/plain", b"too large"
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    path = target.split("?", 1)[0]
+                    status, content_type, payload = await handle_request(method, path, headers, body)
+                    keep_alive = headers.get("connection", "").lower() != "close"
+
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1')
+                    + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.error(f"Error en el servidor HTTP: {e}")
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_connection, host, port, ssl=ssl_context)
+
+def make_webhook_handler(application):
+    async def handle_request(method, path, headers, body):
+        if path == "/healthz":
+            return 200, "text/plain", b"ok"
+        if path == "/readyz":
+            if application.bot_data.get('shutting_down'):
+                return 503, "text/plain", b"stopping"
+            if application.running:
+                return 200, "text/plain", b"ready"
+            return 503, "text/plain", b"starting"
+        if path != WEBHOOK_PATH:
+            return 404, "text/plain", b"not found"
+        if method != "POST":
+            return 405, "text/plain", b"method not allowed"
+
+        if application.bot_data.get('shutting_down'):
+            # Telegram reintenta la entrega: la atiende el próximo proceso.
+            return 503, "text/plain", b"stopping"
+
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            logging.warning("Webhook rechazado: secret token inválido")
+            return 403, "text/plain", b"forbidden"
+
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logging.warning(f"Webhook con cuerpo inválido: {e}")
+            return 400, "text/plain", b"bad request"
+
+        await application.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+
+    return handle_request
+
+def check_bot_mode():
+    """Retorna el motivo por el que BOT_MODE/WEBHOOK_URL no sirven, o None."""
+    if BOT_MODE not in BOT_MODES:
+        return f"BOT_MODE desconocido: '{BOT_MODE}' (opciones: {', '.join(BOT_MODES)})"
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        # setWebhook con url vacía borra el webhook: el bot no recibiría nada.
+        return "BOT_MODE=webhook requiere WEBHOOK_URL (la URL pública del webhook)"
+    return None
+
+async def run_webhook(application: Application):
+    """
+    Equivalente a application.run_polling() pero recibiendo los updates por
+    webhook en nuestro propio servidor (con /healthz y /readyz).
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("run_webhook requiere WEBHOOK_URL")
+    ssl_context = None
+    if WEBHOOK_CERT and WEBHOOK_KEY:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(WEBHOOK_CERT, WEBHOOK_KEY)
+
+    stop_event = asyncio.Event()
+    application.bot_data['stop_function'] = stop_event.set
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+
+    server = await start_http_server(make_webhook_handler(application), WEBHOOK_LISTEN, WEBHOOK_PORT, ssl_context)
+    logging.info(f"Webhook escuchando en {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        certificate = open(WEBHOOK_CERT, 'rb') if WEBHOOK_SELF_SIGNED and WEBHOOK_CERT else None
+        try:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                certificate=certificate,
+                allowed_updates=Update.ALL_TYPES
+            )
+        finally:
+            if certificate:
+                certificate.close()
+
+        await application.start()
+        await stop_event.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# Momento (perf_counter) en que llegó cada update, por update_id.
+UPDATE_RECEIVED_AT = {}
+UPDATE_LATENCIES_MS = deque(maxlen=1000)
+LATENCY_REPORT_EVERY = 100
+_latency_samples = 0
+
+class TimedUpdateQueue(asyncio.Queue):
+    """Cola de updates que anota cuándo llegó cada uno (polling o webhook)."""
+
+    def put_nowait(self, item):
+        if isinstance(item, Update):
+            if len(UPDATE_RECEIVED_AT) > 10000:
+                UPDATE_RECEIVED_AT.clear()
+            UPDATE_RECEIVED_AT[item.update_id] = time.perf_counter()
+        super().put_nowait(item)
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def record_update_latency(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mide cuánto tarda un update desde que llega hasta que empieza su handler."""
+    global _latency_samples
+    received = UPDATE_RECEIVED_AT.pop(update.update_id, None)
+    if received is None:
+        return
+    UPDATE_LATENCIES_MS.append((time.perf_counter() - received) * 1000)
+    _latency_samples += 1
+    if _latency_samples % LATENCY_REPORT_EVERY == 0:
+        logging.info(
+            f"Latencia update→handler ({BOT_MODE}): "
+            f"p50 {_percentile(UPDATE_LATENCIES_MS, 0.5):.2f} ms, "
+            f"p95 {_percentile(UPDATE_LATENCIES_MS, 0.95):.2f} ms"
+        )
+
+# =============================================================================
+# PROCESAMIENTO CONCURRENTE DE UPDATES
+# =============================================================================
+
+# Hilos para las búsquedas IMAP (bloqueantes), que corren fuera del event loop.
+LOOKUP_THREADS = int(os.environ.get("LOOKUP_THREADS", "32"))
+
+def _update_user_key(update):
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+class PerUserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Procesa en paralelo updates de usuarios distintos (como máximo
+    max_concurrent_updates a la vez), pero los de un mismo usuario uno tras
+    otro y en orden de llegada: 'awaiting_email_for' en user_data depende del
+    orden botón -> correo.
+
+    El semáforo de BaseUpdateProcessor sólo acota los updates pendientes; el
+    límite real se aplica después de tomar el lock del usuario, así un
+    usuario con muchos mensajes en cola no ocupa varios cupos.
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending_updates=None):
+        super().__init__(max_pending_updates or max_concurrent_updates * 16)
+        self._worker_limit = max_concurrent_updates
+        self._workers = asyncio.Semaphore(max_concurrent_updates)
+        # user_id -> [lock, updates en espera]; sólo usuarios con updates en curso.
+        self._user_locks = {}
+
+    @property
+    def active_users(self):
+        return len(self._user_locks)
+
+    async def do_process_update(self, update, coroutine):
+        key = _update_user_key(update)
+        if key is None:
+            async with self._workers:
+                await coroutine
+            return
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._workers:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# =============================================================================
+# CALENTAMIENTO IMAP AL ARRANCAR
+# =============================================================================
+
+# Proporción de cuentas que deben quedar listas antes de empezar a recibir
+# updates (0 = no esperar; el calentamiento sigue en segundo plano).
+WARMUP_QUORUM = float(os.environ.get("WARMUP_QUORUM", "0.5"))
+WARMUP_RETRY_INTERVAL = 15     # s entre reintentos de las cuentas que fallaron
+# Si no hay quórum en este tiempo (s) el bot arranca igual, degradado (0 = sin límite).
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", "120"))
+WARMUP_BACKGROUND_RETRY_INTERVAL = 60  # s entre reintentos una vez que el bot ya atiende
+
+class AccountReadiness:
+    def __init__(self, acc_email):
+        self.acc_email = acc_email
+        self.ok = False
+        self.attempts = 0
+        self.elapsed_ms = 0.0
+        self.messages = 0
+        self.error = None
+
+# { cuenta: AccountReadiness } del último intento de calentamiento.
+ACCOUNT_READINESS = {}
+
+CallbackGauge(
+    "bot_imap_account_ready",
+    "1 si la cuenta completó el calentamiento; las que fallan se reintentan en segundo plano",
+    lambda: {(acc,): int(r.ok) for acc, r in ACCOUNT_READINESS.items()}, ("account",)
+)
+
+def warm_up_account(acc_email, acc_password):
+    """Login y refresh del índice de cada servicio; deja la conexión en el pool."""
+    readiness = ACCOUNT_READINESS.setdefault(acc_email, AccountReadiness(acc_email))
+    readiness.attempts += 1
+    started = time.perf_counter()
+    try:
+        messages = 0
+        for service in SERVICE_SEARCH_CRITERIA:
+            messages += len(refresh_mailbox_index(acc_email, acc_password, service, purpose="warmup"))
+        readiness.ok, readiness.messages, readiness.error = True, messages, None
+    except Exception as e:
+        # imaplib trae la respuesta del servidor como bytes en args[0].
+        if e.args and isinstance(e.args[0], bytes):
+            error = e.args[0].decode(errors="replace")
+        else:
+            error = str(e) or type(e).__name__
+        readiness.ok, readiness.error = False, error
+    readiness.elapsed_ms = (time.perf_counter() - started) * 1000
+    LOOKUP_STATS.record_account(acc_email, ok=readiness.ok)
+    return readiness
+
+def warmup_quorum(total_accounts):
+    if WARMUP_QUORUM <= 0 or not total_accounts:
+        return 0
+    return min(total_accounts, max(1, math.ceil(WARMUP_QUORUM * total_accounts)))
+
+def _ready_count(accounts):
+    return sum(1 for acc_email, _ in accounts if acc_email in ACCOUNT_READINESS and ACCOUNT_READINESS[acc_email].ok)
+
+def render_readiness(accounts, needed):
+    ready = _ready_count(accounts)
+    lines = [f"🔌 IMAP al arrancar: {ready}/{len(accounts)} cuentas listas (quórum {needed})"]
+    for acc_email, _ in accounts:
+        readiness = ACCOUNT_READINESS.get(acc_email)
+        if readiness is None:
+            continue
+        if readiness.ok:
+            lines.append(f"✅ {acc_email}: {_format_ms(readiness.elapsed_ms)}, {readiness.messages} mensajes")
+        else:
+            lines.append(f"❌ {acc_email}: {readiness.error} ({readiness.attempts} intentos)")
+    if ready < needed:
+        limit = f"; arranca igual a los {WARMUP_TIMEOUT:.0f} s" if WARMUP_TIMEOUT > 0 else ""
+        lines.append(f"⏳ Sin quórum: el bot no atiende y se reintenta cada {WARMUP_RETRY_INTERVAL} s{limit}.")
+    return "\n".join(lines)
+
+async def notify_admins(bot, text):
+    for admin_id in CONFIG.admin_ids:
+        try:
+            await bot.send_message(chat_id=admin_id, text=text)
+        except TelegramError as e:
+            count_telegram_failure("sendMessage", e)
+            logging.warning(f"No se pudo avisar al admin {admin_id}: {e}")
+
+async def _report_readiness(bot, accounts, needed, first_round, quorum):
+    await first_round.wait()
+    text = render_readiness(accounts, needed)
+    logging.info(text)
+    await notify_admins(bot, text)
+    if not quorum.is_set():
+        await quorum.wait()
+        text = f"✅ Quórum IMAP alcanzado: {_ready_count(accounts)}/{len(accounts)} cuentas listas."
+        logging.info(text)
+        await notify_admins(bot, text)
+
+async def warm_up_imap(bot):
+    """
+    Calienta todas las cuentas a la vez y retorna cuando hay quórum o pasó
+    WARMUP_TIMEOUT (el bot arranca degradado y se avisa a los admins). Las
+    cuentas que fallan se siguen reintentando en segundo plano hasta que
+    responden. El resumen por cuenta se manda a los admins cuando todas
+    respondieron una vez. Retorna las tareas que siguen corriendo, para
+    cancelarlas al apagar.
+    """
+    accounts = list(CONFIG.email_accounts)
+    needed = warmup_quorum(len(accounts))
+    quorum = asyncio.Event()
+    first_round = asyncio.Event()
+    remaining = len(accounts)
+    if not accounts:
+        first_round.set()
+
+    async def warm(acc_email, acc_password):
+        nonlocal remaining
+        readiness = await asyncio.to_thread(warm_up_account, acc_email, acc_password)
+        remaining -= 1
+        if not remaining:
+            first_round.set()
+        while True:
+            if _ready_count(accounts) >= needed:
+                quorum.set()
+            if readiness.ok:
+                if readiness.attempts > 1:
+                    text = f"✅ {acc_email} quedó lista tras {readiness.attempts} intentos."
+                    logging.info(text)
+                    await notify_admins(bot, text)
+                return
+            # Con el bot ya atendiendo, los reintentos se espacian.
+            await asyncio.sleep(WARMUP_RETRY_INTERVAL if not quorum.is_set() else WARMUP_BACKGROUND_RETRY_INTERVAL)
+            readiness = await asyncio.to_thread(warm_up_account, acc_email, acc_password)
+
+    if needed == 0:
+        quorum.set()
+    logging.info(f"Calentando {len(accounts)} cuentas IMAP (quórum {needed})")
+    tasks = [asyncio.create_task(warm(acc_email, acc_password)) for acc_email, acc_password in accounts]
+    tasks.append(asyncio.create_task(_report_readiness(bot, accounts, needed, first_round, quorum)))
+    try:
+        await asyncio.wait_for(quorum.wait(), WARMUP_TIMEOUT if WARMUP_TIMEOUT > 0 else None)
+    except asyncio.TimeoutError:
+        text = (f"⚠️ Sin quórum IMAP tras {WARMUP_TIMEOUT:.0f} s: el bot arranca degradado con "
+                f"{_ready_count(accounts)}/{len(accounts)} cuentas listas y sigue reintentando las demás.")
+        logging.warning(text)
+        tasks.append(asyncio.create_task(notify_admins(bot, text)))
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+    return tasks
+
+# =============================================================================
+# APAGADO ORDENADO
+# =============================================================================
+
+# Tiempo que se espera a las búsquedas en curso antes de cancelarlas.
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get("SHUTDOWN_DRAIN_SECONDS", "20"))
+
+async def graceful_stop(application, stop_function):
+    """
+    Ante SIGINT/SIGTERM: deja de pedir updates y de aceptar búsquedas, espera
+    hasta SHUTDOWN_DRAIN_SECONDS a las que están en curso y cancela el resto
+    avisando a cada usuario. Después stop_function() sigue con el apagado
+    normal (application.stop y post_shutdown).
+    """
+    if application.bot_data.get('shutting_down'):
+        return
+    application.bot_data['shutting_down'] = True
+    logging.info("Apagando: no se aceptan búsquedas nuevas")
+
+    warmup = application.bot_data.get('warmup')
+    if warmup and not warmup.done():
+        warmup.cancel()
+    # Los mensajes que lleguen desde ahora quedan en Telegram para el próximo arranque.
+    if application.updater and application.updater.running:
+        await application.updater.stop()
+    LOOKUP_QUEUE.close()
+
+    remaining = await LOOKUP_QUEUE.drain(SHUTDOWN_DRAIN_SECONDS)
+    if remaining:
+        logging.warning(f"Cancelando {remaining} búsquedas sin terminar tras {SHUTDOWN_DRAIN_SECONDS:.0f} s")
+        LOOKUP_QUEUE.cancel_all()
+        aborted = await asyncio.to_thread(IMAP_POOL.abort_busy)
+        if aborted:
+            logging.info(f"Cerradas {aborted} conexiones IMAP en uso")
+    watches = await CODE_WATCHES.cancel_all()
+    if watches:
+        logging.info(f"Canceladas {watches} esperas de códigos")
+    stop_function()
+
+def install_stop_signals(application, stop_function):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(
+                sig, lambda: asyncio.ensure_future(graceful_stop(application, stop_function))
+            )
+        except NotImplementedError:
+            pass
+
+# =============================================================================
+# CICLO DE VIDA DE LA APLICACIÓN
+# =============================================================================
+
+async def post_init(application: Application):
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=LOOKUP_THREADS, thread_name_prefix="lookup")
+    )
+    # main() y run_webhook indican cómo detener el bucle; sin eso (p. ej. en
+    # los benchmarks) se dejan las señales como están.
+    stop_function = application.bot_data.get('stop_function')
+    if stop_function:
+        install_stop_signals(application, stop_function)
+    application.bot_data['config_watcher'] = asyncio.create_task(watch_config_files())
+    LOOKUP_QUEUE.start()
+    start_parse_pool()
+    if PROFILE_ON_START:
+        start_profile_task(application, min(PROFILE_ON_START, PROFILE_MAX_SECONDS))
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await start_http_server(
+            make_metrics_handler(), METRICS_LISTEN, METRICS_PORT
+        )
+        logging.info(f"Métricas en http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+    state = load_broadcast_state()
+    if state and state.get("pending"):
+        logging.info(f"Reanudando difusión pendiente: {len(state['pending'])} destinatarios")
+        start_broadcast_task(application, state)
+
+    # Se espera el quórum acá: run_polling (y run_webhook) recién piden
+    # updates cuando post_init termina.
+    warmup = asyncio.ensure_future(warm_up_imap(application.bot))
+    application.bot_data['warmup'] = warmup
+    try:
+        application.bot_data['warmup_tasks'] = await warmup
+    except asyncio.CancelledError:
+        if not application.bot_data.get('shutting_down'):
+            raise
+        logging.info("Calentamiento IMAP interrumpido por el apagado")
+
+async def post_shutdown(application: Application):
+    watcher = application.bot_data.pop('config_watcher', None)
+    if watcher:
+        watcher.cancel()
+    metrics_server = application.bot_data.pop('metrics_server', None)
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    warmup_tasks = application.bot_data.pop('warmup_tasks', [])
+    for task in warmup_tasks:
+        task.cancel()
+    await asyncio.gather(*warmup_tasks, return_exceptions=True)
+    await LOOKUP_QUEUE.stop()
+    await CODE_WATCHES.stop()
+    profile_task = application.bot_data.pop('profile_task', None)
+    if profile_task and not profile_task.done():
+        profile_task.cancel()
+        await asyncio.gather(profile_task, return_exceptions=True)
+
+    broadcast_task = application.bot_data.pop('broadcast_task', None)
+    if broadcast_task and not broadcast_task.done():
+        broadcast_task.cancel()
+        try:
+            await broadcast_task
+        except asyncio.CancelledError:
+            pass
+
+    await asyncio.to_thread(IMAP_POOL.abort_busy)
+    await asyncio.to_thread(IMAP_POOL.close_all)
+    await asyncio.to_thread(shutdown_parse_pool)
+    await asyncio.to_thread(USER_LOG_WRITER.stop)
+    logging.info("Apagado completo")
+
+# =============================================================================
+# 9. MAIN
+# =============================================================================
+
+def add_handlers(application):
+    application.add_handler(TypeHandler(Update, record_update_latency), group=-1)
 
     # Handlers principales
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CallbackQueryHandler(userlog_page, pattern=r"^ul:"))
+    application.add_handler(CallbackQueryHandler(listusers_page, pattern=r"^lu:"))
+    application.add_handler(CallbackQueryHandler(wait_for_code, pattern=r"^wait:"))
     application.add_handler(CallbackQueryHandler(handle_buttons))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, email_input))
     application.add_handler(CommandHandler("cancel", cancel))
@@ -1844,5 +5340,60 @@ if __name__ == "__main__":
     application.add_handler(CommandHandler("listusers", listusers))
     application.add_handler(CommandHandler("addadmin", addadmin))
     application.add_handler(CommandHandler("removeadmin", removeadmin))
+    application.add_handler(CommandHandler("userlog", userlog))
+    application.add_handler(CommandHandler("ratelimit", ratelimit))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("explain", explain))
+    application.add_handler(CommandHandler("profile", profile))
+
+    # Importación / exportación masiva
+    application.add_handler(CommandHandler("importusers", importusers))
+    application.add_handler(CommandHandler("exportusers", exportusers))
+    application.add_handler(MessageHandler(filters.Document.ALL, import_document))
+
+if __name__ == "__main__":
+    mode_error = check_bot_mode()
+    if mode_error:
+        sys.exit(f"❌ {mode_error}")
+    configure(load_config())
+    atexit.register(USER_LOG_WRITER.stop)
+    colorama.init(autoreset=True)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.DEBUG)
+    log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    console_handler.setFormatter(ColorfulFormatter(log_format))
+
+    # La consola (con colores) se escribe desde el hilo del QueueListener,
+    # así los handlers sólo encolan el registro.
+    log_queue = queue.Queue(-1)
+    log_listener = logging.handlers.QueueListener(log_queue, console_handler, respect_handler_level=True)
+    log_listener.start()
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    builder = (
+        Application.builder()
+        .token(CONFIG.token)
+        .update_queue(TimedUpdateQueue())
+        .concurrent_updates(PerUserOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_BASE_URL}/bot").base_file_url(f"{TELEGRAM_BASE_URL}/file/bot")
+    application = builder.build()
+
+    add_handlers(application)
 
-    application.run_polling()
+    try:
+        if BOT_MODE == "webhook":
+            asyncio.run(run_webhook(application))
+        else:
+            # Las señales las maneja graceful_stop (ver install_stop_signals).
+            application.bot_data['stop_function'] = application.stop_running
+            application.run_polling(stop_signals=None)
+    finally:
+        log_listener.stop()